@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""Compare server-side copy strategies on a local S3 stand-in.
+
+Two shapes are timed: many small objects (CopyObject fan-out) and one large
+object (concurrent UploadPartCopy), against the previous implementation, a
+managed copy with use_threads=False. By default the copies run against moto;
+pass --endpoint_url to use a local minio server instead.
+
+e.g. python benchmarks/copy_benchmark.py --n_small 500 --large_mb 512
+"""
+
+import argparse
+import itertools
+import os
+import time
+
+import utilities.s3_util as s3u
+
+
+def old_copy_file(bucket, new_bucket, key, new_key, *, callback=None):
+    s3u.get_client().copy(
+        CopySource={"Bucket": bucket, "Key": key},
+        Bucket=new_bucket,
+        Key=new_key,
+        Callback=callback,
+        Config=s3u.transfer_config(use_threads=False),
+    )
+
+
+def timed(label, fn, *args, **kwargs):
+    start = time.monotonic()
+    fn(*args, **kwargs)
+    print(f"{label:40s} {time.monotonic() - start:8.2f}s")
+
+
+def run(args):
+    client = s3u.get_client()
+    for bucket in ("bench-src", "bench-dest"):
+        client.create_bucket(Bucket=bucket)
+
+    small_keys = [f"small/{i:06d}" for i in range(args.n_small)]
+    s3u.run_transfers(
+        lambda key, callback: s3u.get_client().put_object(
+            Bucket="bench-src", Key=key, Body=os.urandom(args.small_kb * 1024)
+        ),
+        small_keys,
+    )
+    client.upload_file(
+        Filename=make_large_file(args.large_mb), Bucket="bench-src", Key="large"
+    )
+
+    timed(
+        "small objects, managed copy (old)",
+        s3u.run_transfers,
+        old_copy_file,
+        itertools.repeat("bench-src"),
+        itertools.repeat("bench-dest"),
+        small_keys,
+        [f"old/{k}" for k in small_keys],
+    )
+    timed(
+        "small objects, CopyObject fan-out",
+        s3u.copy_files,
+        small_keys,
+        [f"new/{k}" for k in small_keys],
+        b="bench-src",
+        nb="bench-dest",
+    )
+
+    timed(
+        "large object, managed copy (old)",
+        old_copy_file,
+        "bench-src",
+        "bench-dest",
+        "large",
+        "old/large",
+    )
+    timed(
+        "large object, UploadPartCopy",
+        s3u.copy_file,
+        "bench-src",
+        "bench-dest",
+        "large",
+        "new/large",
+        part_size=args.part_mb * 2 ** 20,
+    )
+
+
+def make_large_file(size_mb):
+    path = os.path.abspath("copy_benchmark_large.bin")
+    with open(path, "wb") as fh:
+        for _ in range(size_mb):
+            fh.write(os.urandom(2 ** 20))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_small", type=int, default=200)
+    parser.add_argument("--small_kb", type=int, default=64)
+    parser.add_argument("--large_mb", type=int, default=256)
+    parser.add_argument("--part_mb", type=int, default=16)
+    parser.add_argument("--endpoint_url", help="S3 endpoint, e.g. a local minio")
+
+    args = parser.parse_args()
+
+    try:
+        if args.endpoint_url:
+            s3u.configure(endpoint_url=args.endpoint_url)
+            run(args)
+        else:
+            from moto import mock_aws
+
+            os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+            with mock_aws():
+                run(args)
+    finally:
+        if os.path.exists("copy_benchmark_large.bin"):
+            os.remove("copy_benchmark_large.bin")
+
+
+if __name__ == "__main__":
+    main()
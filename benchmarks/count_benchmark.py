@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""Check gene_counter against htseq-count on synthetic BAM/GTF fixtures.
+
+A random GTF (genes with overlapping exons, attributes with quoted ';') and a
+name-sorted BAM of --n_reads reads or pairs (spliced, clipped, unaligned,
+multimapped, low-quality and orphaned mates, reads on chromosomes without
+features) are written to a temporary folder. Both counters run on them and
+the outputs must be identical; the time of each is reported.
+
+e.g. python benchmarks/count_benchmark.py --n_reads 1000000 --n_proc 8
+"""
+
+import argparse
+import filecmp
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+import pysam
+
+import utilities.alignment.gene_counter as gene_counter
+
+
+CHROMOSOMES = [("chr1", 2_000_000), ("chr2", 2_000_000), ("chrUn", 100_000)]
+READ_LENGTH = 100
+
+
+def write_gtf(path, n_genes, rng):
+    with open(path, "w") as out:
+        out.write("#!synthetic\n")
+        for i in range(n_genes):
+            chrom, length = rng.choice(CHROMOSOMES[:2])
+            start = rng.randrange(1, length - 5000)
+            attrs = f'gene_id "G{i:05d}"; gene_name "N{i % 97}";'
+            out.write(
+                f"{chrom}\tsynthetic\tgene\t{start}\t{start + 4000}\t.\t+\t.\t{attrs}\n"
+            )
+            for _ in range(rng.randrange(1, 5)):
+                exon_start = start + rng.randrange(0, 3500)
+                exon_end = exon_start + rng.randrange(20, 500)
+                out.write(
+                    f"{chrom}\tsynthetic\texon\t{exon_start}\t{exon_end}\t.\t+\t."
+                    f'\t{attrs} note "a;b";\n'
+                )
+
+
+def random_cigar(rng):
+    n = rng.randrange(10, 90)
+    return rng.choice(
+        [
+            f"{READ_LENGTH}M",
+            f"{n}M{rng.randrange(50, 3000)}N{READ_LENGTH - n}M",
+            f"5S{n}M2I{READ_LENGTH - n - 7}M",
+            f"{n}M3D{READ_LENGTH - n}M",
+            f"{n}=1X{READ_LENGTH - n - 1}=",
+        ]
+    )
+
+
+def write_bam(path, n_reads, paired, rng):
+    header = {
+        "HD": {"VN": "1.6", "SO": "queryname"},
+        "SQ": [{"SN": name, "LN": length} for name, length in CHROMOSOMES],
+    }
+
+    with pysam.AlignmentFile(path, "wb", header=header) as out:
+
+        def alignment(name, first, unmapped, mate_unmapped, pos, mate_pos):
+            a = pysam.AlignedSegment(out.header)
+            a.query_name = name
+            a.query_sequence = "A" * READ_LENGTH
+            a.query_qualities = pysam.qualitystring_to_array("I" * READ_LENGTH)
+            a.flag = 0x4 if unmapped else 0
+            if paired:
+                a.flag |= 0x1 | (0x40 if first else 0x80)
+                if mate_unmapped:
+                    a.flag |= 0x8
+            if not unmapped:
+                a.reference_name, a.reference_start = pos
+                a.cigarstring = random_cigar(rng)
+                a.mapping_quality = rng.choice([255] * 9 + [3])
+                if rng.random() > 0.01:
+                    a.set_tag("NH", rng.choice([1] * 9 + [2]))
+            if paired and not mate_unmapped:
+                a.next_reference_name, a.next_reference_start = mate_pos
+            return a
+
+        for i in range(n_reads):
+            name = f"read{i:09d}"
+            chrom, length = rng.choice(CHROMOSOMES)
+            pos = (chrom, rng.randrange(0, length - 5000))
+            if rng.random() < 0.95:
+                mate_pos = (chrom, max(pos[1] + rng.randrange(-500, 500), 0))
+            else:
+                mate_pos = (rng.choice(CHROMOSOMES)[0], pos[1])
+
+            unmapped = rng.random() < 0.05
+            mate_unmapped = rng.random() < 0.05
+            reads = [alignment(name, True, unmapped, mate_unmapped, pos, mate_pos)]
+            if paired and rng.random() > 0.03:
+                reads.append(
+                    alignment(name, False, mate_unmapped, unmapped, mate_pos, pos)
+                )
+
+            rng.shuffle(reads)
+            for a in reads:
+                out.write(a)
+
+
+def timed(label, fn, *args):
+    start = time.monotonic()
+    fn(*args)
+    print(f"{label:40s} {time.monotonic() - start:8.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_reads", type=int, default=200_000)
+    parser.add_argument("--n_genes", type=int, default=2000)
+    parser.add_argument("--n_proc", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk_size", type=int, default=gene_counter.CHUNK_SIZE)
+    parser.add_argument("--single_end", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        gtf_path = os.path.join(tmp_dir, "features.gtf")
+        bam_path = os.path.join(tmp_dir, "Aligned.out.sorted-byname.bam")
+        write_gtf(gtf_path, args.n_genes, rng)
+        write_bam(bam_path, args.n_reads, not args.single_end, rng)
+
+        htseq_path = os.path.join(tmp_dir, "htseq-count.txt")
+        native_path = os.path.join(tmp_dir, "gene_counter.txt")
+
+        def htseq():
+            with open(htseq_path, "w") as out:
+                subprocess.run(
+                    [
+                        "htseq-count",
+                        "-r",
+                        "name",
+                        "-s",
+                        "no",
+                        "-f",
+                        "bam",
+                        "--idattr=gene_id",
+                        "-m",
+                        "intersection-nonempty",
+                        bam_path,
+                        gtf_path,
+                    ],
+                    stdout=out,
+                    stderr=subprocess.DEVNULL,
+                    check=True,
+                )
+
+        def native():
+            index = gene_counter.FeatureIndex.from_gtf(gtf_path, "gene_id")
+            counts = gene_counter.count_reads(
+                bam_path, index, n_proc=args.n_proc, chunk_size=args.chunk_size
+            )
+            gene_counter.write_counts(counts, index, native_path)
+
+        timed("htseq-count", htseq)
+        timed(f"gene_counter, {args.n_proc} processes", native)
+
+        if not filecmp.cmp(htseq_path, native_path, shallow=False):
+            subprocess.run(["diff", htseq_path, native_path])
+            raise SystemExit("outputs differ")
+
+        print("outputs are identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""Simulate jobs sharing a host's STAR genomes, with a fake STAR binary.
+
+The fake STAR keeps the set of "loaded" genomes in a state file, sleeps
+--load_seconds per load and fails if a load would put the host over
+--host_gb. --n_jobs concurrent jobs each acquire a genome (round-robin over
+--n_genomes), align for --align_seconds and release it. The previous
+behaviour, LoadAndExit in every job and never Remove, is run for comparison.
+Loads, removes, the peak and the leftover shared memory are reported.
+
+e.g. python benchmarks/genome_residency_benchmark.py --n_jobs 8 --n_genomes 2
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import stat
+import tempfile
+import time
+
+import utilities.alignment.genome_residency as genome_residency
+import utilities.log_util as ut_log
+
+
+FAKE_STAR = """#!/usr/bin/env python
+import fcntl, json, os, sys, time
+
+genome_dir = sys.argv[sys.argv.index("--genomeDir") + 1]
+mode = sys.argv[sys.argv.index("--genomeLoad") + 1]
+size = sum(os.path.getsize(os.path.join(genome_dir, fn)) for fn in {files!r})
+
+with open({state!r}, "r+") as fh:
+    fcntl.flock(fh, fcntl.LOCK_EX)
+    state = json.load(fh)
+    if mode == "LoadAndExit" and genome_dir not in state["loaded"]:
+        if sum(state["loaded"].values()) + size > {host_bytes}:
+            sys.exit("not enough shared memory")
+        time.sleep({load_seconds})
+        state["loaded"][genome_dir] = size
+        state["loads"] += 1
+    elif mode == "Remove" and genome_dir in state["loaded"]:
+        del state["loaded"][genome_dir]
+        state["removes"] += 1
+    state["peak"] = max(state["peak"], sum(state["loaded"].values()))
+    fh.seek(0)
+    fh.truncate()
+    json.dump(state, fh)
+"""
+
+
+def make_genomes(root, n_genomes, size_mb):
+    genome_dirs = []
+    for i in range(n_genomes):
+        genome_dir = os.path.join(root, "genomes", f"genome{i}")
+        os.makedirs(genome_dir)
+        for fn in genome_residency.GENOME_FILES:
+            with open(os.path.join(genome_dir, fn), "wb") as out:
+                out.truncate(size_mb * 2 ** 20 // len(genome_residency.GENOME_FILES))
+        genome_dirs.append(genome_dir)
+
+    return genome_dirs
+
+
+def old_job(star, genome_dir, registry, budget, align_seconds):
+    """Return whether the job got its genome loaded"""
+    logger = logging.getLogger("old_job")
+    command = [star, "--genomeDir", genome_dir, "--genomeLoad", "LoadAndExit"]
+    if ut_log.log_command(logger, command, shell=True):
+        return False
+
+    time.sleep(align_seconds)
+    return True
+
+
+def new_job(star, genome_dir, registry, budget, align_seconds):
+    logger = logging.getLogger("new_job")
+    genomes = genome_residency.GenomeResidency(
+        logger, registry, budget=budget, star=star
+    )
+    try:
+        genomes.acquire(genome_dir)
+    except RuntimeError:
+        return False
+
+    time.sleep(align_seconds)
+    genomes.release(genome_dir)
+    return True
+
+
+def run_jobs(label, job, args, tmp_dir, genome_dirs):
+    state_path = os.path.join(tmp_dir, f"{job.__name__}.json")
+    with open(state_path, "w") as out:
+        out.write('{"loaded": {}, "loads": 0, "removes": 0, "peak": 0}')
+
+    star = os.path.join(tmp_dir, f"STAR_{job.__name__}")
+    with open(star, "w") as out:
+        out.write(
+            FAKE_STAR.format(
+                files=genome_residency.GENOME_FILES,
+                state=state_path,
+                host_bytes=int(args.host_gb * 2 ** 30),
+                load_seconds=args.load_seconds,
+            )
+        )
+    os.chmod(star, os.stat(star).st_mode | stat.S_IEXEC)
+
+    registry = os.path.join(tmp_dir, f"registry_{job.__name__}")
+    start = time.monotonic()
+    budget = int(args.host_gb * 2 ** 30)
+    with multiprocessing.Pool(args.n_jobs) as pool:
+        loaded = pool.starmap(
+            job,
+            [
+                (star, genome_dir, registry, budget, args.align_seconds)
+                for genome_dir, _ in zip(
+                    itertools.cycle(genome_dirs), range(args.n_jobs)
+                )
+            ],
+        )
+    elapsed = time.monotonic() - start
+
+    with open(state_path) as fh:
+        state = json.load(fh)
+
+    print(
+        f"{label:24s} {elapsed:6.1f}s  refused {loaded.count(False):3d}"
+        f"  loads {state['loads']:3d}"
+        f"  removes {state['removes']:3d}"
+        f"  peak {state['peak'] / 2 ** 30:5.1f} GB"
+        f"  left loaded {sum(state['loaded'].values()) / 2 ** 30:5.1f} GB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_jobs", type=int, default=8)
+    parser.add_argument("--n_genomes", type=int, default=2)
+    parser.add_argument("--genome_mb", type=int, default=30 * 1024)
+    parser.add_argument("--host_gb", type=float, default=128)
+    parser.add_argument("--load_seconds", type=float, default=1.0)
+    parser.add_argument("--align_seconds", type=float, default=2.0)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        genome_dirs = make_genomes(tmp_dir, args.n_genomes, args.genome_mb)
+        run_jobs("LoadAndExit (old)", old_job, args, tmp_dir, genome_dirs)
+        run_jobs("GenomeResidency", new_job, args, tmp_dir, genome_dirs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Measure how long it takes to import the modules behind the CLIs.
+
+Each module is imported in a fresh interpreter with -X importtime, and the
+cumulative import time of the module itself is reported (best of --repeat).
+
+e.g. python benchmarks/import_time.py --repeat 5
+"""
+
+import argparse
+import subprocess
+import sys
+
+
+MODULES = [
+    "utilities.s3_util",
+    "utilities.scripts.aws_star",
+    "utilities.scripts.aws_10x",
+    "utilities.scripts.evros",
+    "utilities.scripts.gene_cell_table",
+]
+
+
+def import_time(module):
+    """Return the cumulative import time of module in microseconds"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    for line in proc.stderr.splitlines():
+        fields = [f.strip() for f in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1])
+
+    raise ValueError(f"no import time reported for {module}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeat", type=int, default=3)
+
+    args = parser.parse_args()
+
+    for module in args.modules:
+        best = min(import_time(module) for _ in range(args.repeat))
+        print(f"{module:40s} {best / 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
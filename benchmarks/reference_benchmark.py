@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Compare ways of fetching a reference genome on a local S3 stand-in.
+
+A synthetic reference (a few large index files and some small ones) is stored
+as a .tgz, as a .tar.zst (if zstd is installed) and unpacked. The previous
+fetch, one streamed GET through Python's tarfile, is timed against
+reference_cache.Reference.fetch for each layout: parallel ranged GETs piped
+through pigz/gzip or zstd into tar, or a parallel download of the unpacked
+files. By default this runs against moto; pass --endpoint_url to use a local
+minio server instead.
+
+e.g. python benchmarks/reference_benchmark.py --size_mb 2048
+"""
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+
+import utilities.reference_cache as reference_cache
+import utilities.s3_util as s3u
+
+
+BUCKET = "bench-reference"
+
+
+def old_fetch(bucket, key, dest_dir):
+    s3_object = s3u.get_resource().Object(bucket, key)
+
+    with tarfile.open(fileobj=s3_object.get()["Body"], mode="r|gz") as tf:
+        tf.extractall(path=dest_dir)
+
+
+def make_reference(root, size_mb):
+    """Write a reference folder of about size_mb, as compressible as a genome"""
+    ref_dir = os.path.join(root, "genome", "STAR")
+    os.makedirs(ref_dir)
+
+    rng = random.Random(0)
+    block = "".join(rng.choices("ACGT", k=2 ** 20)).encode()
+    for name, share in (("SA", 0.6), ("Genome", 0.3), ("SAindex", 0.1)):
+        with open(os.path.join(ref_dir, name), "wb") as out:
+            for _ in range(max(int(size_mb * share), 1)):
+                out.write(block)
+
+    for i in range(20):
+        with open(os.path.join(ref_dir, f"info{i}.txt"), "w") as out:
+            out.write(f"small file {i}\n")
+
+    return os.path.join(root, "genome")
+
+
+def timed(label, fn, *args):
+    with tempfile.TemporaryDirectory() as dest_dir:
+        start = time.monotonic()
+        fn(*args, dest_dir)
+        print(f"{label:40s} {time.monotonic() - start:8.2f}s")
+
+
+def run(args, tmp_dir):
+    client = s3u.get_client()
+    client.create_bucket(Bucket=BUCKET)
+
+    ref_dir = make_reference(tmp_dir, args.size_mb)
+    tgz_path = os.path.join(tmp_dir, "genome.tgz")
+    subprocess.run(["tar", "-czf", tgz_path, "-C", tmp_dir, "genome"], check=True)
+    client.upload_file(Filename=tgz_path, Bucket=BUCKET, Key="gzip/genome.tgz")
+
+    layouts = ["gzip"]
+    if shutil.which("zstd"):
+        zst_path = os.path.join(tmp_dir, "genome.tar.zst")
+        subprocess.run(
+            f"tar -cf - -C {tmp_dir} genome | zstd -q -T0 -o {zst_path}",
+            shell=True,
+            check=True,
+        )
+        client.upload_file(
+            Filename=zst_path, Bucket=BUCKET, Key="zstd/genome.tar.zst"
+        )
+        client.upload_file(Filename=tgz_path, Bucket=BUCKET, Key="zstd/genome.tgz")
+        layouts.append("zstd")
+
+    paths = [
+        os.path.join(dirpath, fn)
+        for dirpath, _, filenames in os.walk(ref_dir)
+        for fn in filenames
+    ]
+    s3u.run_transfers(
+        lambda path, callback: s3u.get_client().upload_file(
+            Filename=path,
+            Bucket=BUCKET,
+            Key=f"unpacked/{os.path.relpath(path, tmp_dir)}",
+        ),
+        paths,
+    )
+    client.upload_file(Filename=tgz_path, Bucket=BUCKET, Key="unpacked/genome.tgz")
+    layouts.append("unpacked")
+
+    print(f"{args.size_mb} MB reference, {os.path.getsize(tgz_path) / 1e6:.1f} MB tgz")
+
+    timed("streamed tarfile (old)", old_fetch, BUCKET, "gzip/genome.tgz")
+    for layout in layouts:
+        reference = reference_cache.Reference.find(BUCKET, f"{layout}/genome.tgz")
+        assert reference.layout == layout
+        timed(f"Reference.fetch, {layout}", reference.fetch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size_mb", type=int, default=512)
+    parser.add_argument("--endpoint_url", help="S3 endpoint, e.g. a local minio")
+    parser.add_argument("--tmp_dir", default=None)
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        if args.endpoint_url:
+            s3u.configure(endpoint_url=args.endpoint_url)
+            run(args, tmp_dir)
+        else:
+            from moto import mock_aws
+
+            os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+            with mock_aws():
+                run(args, tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
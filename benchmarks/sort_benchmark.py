@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Compare the BAM post-processing of run_sample on a synthetic alignment.
+
+The previous sequence sorted Aligned.out.bam by coordinate, indexed it and
+then name-sorted the coordinate-sorted file, single threaded. The new stage
+(sort_alignments) runs both sorts from the unsorted file concurrently with
+threads. A paired-end BAM of --n_pairs random pairs, in the read order STAR
+writes (mates together, unsorted), is made with samtools in a temporary
+folder and each plan runs on its own copy.
+
+e.g. python benchmarks/sort_benchmark.py --n_pairs 5000000 --threads 16
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import utilities.alignment.run_star_and_htseq as star
+
+
+CHROMOSOMES = [(f"chr{i}", 100_000_000) for i in range(1, 11)]
+READ_LENGTH = 100
+
+
+def write_sam(path, n_pairs, seed=0):
+    rng = random.Random(seed)
+    seq = "A" * READ_LENGTH
+    qual = "I" * READ_LENGTH
+
+    with open(path, "w") as out:
+        out.write("@HD\tVN:1.6\tSO:unsorted\n")
+        for name, length in CHROMOSOMES:
+            out.write(f"@SQ\tSN:{name}\tLN:{length}\n")
+
+        for i in range(n_pairs):
+            chrom, length = rng.choice(CHROMOSOMES)
+            pos = rng.randrange(1, length - 1000)
+            mate_pos = pos + rng.randrange(100, 500)
+            qname = f"read{rng.getrandbits(40):x}.{i}"
+            out.write(
+                f"{qname}\t99\t{chrom}\t{pos}\t255\t{READ_LENGTH}M\t=\t{mate_pos}"
+                f"\t{mate_pos + READ_LENGTH - pos}\t{seq}\t{qual}\tNH:i:1\n"
+                f"{qname}\t147\t{chrom}\t{mate_pos}\t255\t{READ_LENGTH}M\t=\t{pos}"
+                f"\t{pos - mate_pos - READ_LENGTH}\t{seq}\t{qual}\tNH:i:1\n"
+            )
+
+
+def old_sort(pass1_dir, logger):
+    """The samtools steps of run_sample before sort_alignments"""
+    commands = [
+        [
+            star.SAMTOOLS,
+            "sort",
+            "-m",
+            "6000000000",
+            "-o",
+            "Aligned.out.sorted.bam",
+            "Aligned.out.bam",
+        ],
+        [star.SAMTOOLS, "index", "-b", "Aligned.out.sorted.bam"],
+        [
+            star.SAMTOOLS,
+            "sort",
+            "-m",
+            "6000000000",
+            "-n",
+            "-o",
+            "Aligned.out.sorted-byname.bam",
+            "Aligned.out.sorted.bam",
+        ],
+    ]
+    for command in commands:
+        if star.ut_log.log_command(logger, command, shell=True, cwd=pass1_dir):
+            raise RuntimeError(f"{command[1]} failed")
+
+
+def new_sort(pass1_dir, logger, threads):
+    if star.sort_alignments(pass1_dir, threads, logger):
+        raise RuntimeError("sort_alignments failed")
+
+
+def timed(label, fn, *args):
+    start = time.monotonic()
+    fn(*args)
+    print(f"{label:40s} {time.monotonic() - start:8.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_pairs", type=int, default=1_000_000)
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    parser.add_argument("--tmp_dir", default=None)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger("sort_benchmark")
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        sam_path = os.path.join(tmp_dir, "Aligned.out.sam")
+        write_sam(sam_path, args.n_pairs)
+
+        bam_path = os.path.join(tmp_dir, "Aligned.out.bam")
+        subprocess.run(
+            [star.SAMTOOLS, "view", "-b", "-o", bam_path, sam_path], check=True
+        )
+        os.remove(sam_path)
+        print(f"{args.n_pairs} pairs, {os.path.getsize(bam_path) / 1e6:.1f} MB BAM")
+
+        for label, fn, extra in (
+            ("coordinate, index, name (old)", old_sort, ()),
+            (f"sort_alignments, {args.threads} threads", new_sort, (args.threads,)),
+        ):
+            pass1_dir = os.path.join(tmp_dir, fn.__name__)
+            os.mkdir(pass1_dir)
+            shutil.copy(bam_path, pass1_dir)
+            timed(label, fn, pass1_dir, logger, *extra)
+            shutil.rmtree(pass1_dir)
+
+
+if __name__ == "__main__":
+    main()
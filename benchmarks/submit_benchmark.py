@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Submit jobs to a local stub of the AWS Batch API, one at a time and with
+evros.submit_jobs.
+
+The stub answers SubmitJob after --latency seconds and throttles (HTTP 429,
+TooManyRequestsException) past --limit requests per second, like Batch does
+per account. --n_jobs jobs are submitted one after another, as the evros
+scripts printed by aws_star do (without their sleep 10), and then concurrently
+with submit_jobs. The time taken, throttled requests and jobs missing or
+submitted twice are reported.
+
+e.g. python benchmarks/submit_benchmark.py --n_jobs 400
+"""
+
+import argparse
+import collections
+import http.server
+import json
+import os
+import threading
+import time
+import uuid
+
+import utilities.scripts.evros as evros
+
+
+class StubBatch(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, limit):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.latency = latency
+        self.limit = limit
+
+        self.lock = threading.Lock()
+        self.window = collections.deque()  # times of the last second's requests
+        self.jobs = collections.Counter()  # job name -> times submitted
+        self.throttled = 0
+
+    def admit(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.window and self.window[0] < now - 1:
+                self.window.popleft()
+            if len(self.window) >= self.limit:
+                self.throttled += 1
+                return False
+            self.window.append(now)
+            return True
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path != "/v1/submitjob":
+            self.reply(404, {"message": f"not stubbed: {self.path}"})
+        elif not self.server.admit():
+            self.reply(
+                429,
+                {"message": "Too Many Requests"},
+                [("x-amzn-ErrorType", "TooManyRequestsException")],
+            )
+        else:
+            time.sleep(self.server.latency)
+            with self.server.lock:
+                self.server.jobs[request["jobName"]] += 1
+
+            job_id = str(uuid.uuid4())
+            self.reply(
+                200,
+                {
+                    "jobArn": f"arn:aws:batch:us-east-1:000000000000:job/{job_id}",
+                    "jobName": request["jobName"],
+                    "jobId": job_id,
+                },
+            )
+
+
+def one_at_a_time(requests, client):
+    return [client.submit_job(**request)["jobId"] for request in requests]
+
+
+def run(label, submit, requests, args):
+    stub = StubBatch(args.latency, args.limit)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    client = evros.batch_client(endpoint_url=f"http://127.0.0.1:{stub.server_port}")
+
+    start = time.monotonic()
+    job_ids = submit(requests, client)
+    elapsed = time.monotonic() - start
+    stub.shutdown()
+
+    names = {request["jobName"] for request in requests}
+    print(
+        f"{label:24s} {elapsed:6.1f}s  {len(requests) / elapsed:6.1f} jobs/s"
+        f"  throttled {stub.throttled:4d}"
+        f"  failed {job_ids.count(None):3d}"
+        f"  missing {len(names - set(stub.jobs)):3d}"
+        f"  duplicated {sum(n > 1 for n in stub.jobs.values()):3d}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n_jobs", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.15)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=evros.SUBMIT_RATE)
+    parser.add_argument("--n_threads", type=int, default=evros.SUBMIT_THREADS)
+
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "stub")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "stub")
+
+    requests = [
+        evros.job_request(
+            evros.job_name("alignment.run_star_and_htseq", i),
+            evros.job_command(
+                "alignment.run_star_and_htseq",
+                [f"--partition_id {i}", f"--num_partitions {args.n_jobs}"],
+            ),
+            queue="aegea_batch",
+            job_definition="utilities",
+            vcpus=16,
+            memory=64000,
+        )
+        for i in range(args.n_jobs)
+    ]
+
+    run("one at a time (old)", one_at_a_time, requests, args)
+    run(
+        "submit_jobs",
+        lambda requests, client: evros.submit_jobs(
+            requests, client=client, n_threads=args.n_threads, rate=args.rate
+        ),
+        requests,
+        args,
+    )
+    run(
+        "submit_jobs, no limit",
+        lambda requests, client: evros.submit_jobs(
+            requests, client=client, n_threads=args.n_threads, rate=10 ** 6
+        ),
+        requests,
+        args,
+    )
+
+
+if __name__ == "__main__":
+    main()
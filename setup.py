@@ -34,6 +34,7 @@ setuptools.setup(
     extras_require={
         "evros": ["aegea >= 3.6", "awscli >= 1.15.41", "awscli-cwlogs >= 1.4.4"],
         "h5ad": ["anndata"],
+        "counter": ["numpy", "pysam"],
     },
     entry_points={
         "console_scripts": [
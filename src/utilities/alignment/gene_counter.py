@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""In-process replacement for
+
+    htseq-count -r name -s no -f bam --idattr=ID_ATTR -m intersection-nonempty
+
+Reads are counted on the features of a FeatureIndex (see feature_index), which
+is built from the GTF once and reused for every sample of a job. The BAM is
+split into chunks at read-name boundaries, and the chunks are counted in
+parallel by worker processes that memory-map the saved index. The output of
+write_counts is the same as the htseq-count.txt file htseq-count writes.
+"""
+
+import argparse
+import collections
+import multiprocessing
+import shutil
+import tempfile
+
+from utilities.feature_index import FeatureIndex, cached_index
+
+
+# reads per chunk of the BAM file given to a worker process
+CHUNK_SIZE = 500_000
+
+# alignments with a lower mapping quality are counted as __too_low_aQual
+MIN_AQUAL = 10
+
+# pysam CIGAR operations that are matched to the reference: M, = and X
+MATCH_OPS = (0, 7, 8)
+
+SPECIAL_COUNTERS = (
+    "__no_feature",
+    "__ambiguous",
+    "__too_low_aQual",
+    "__not_aligned",
+    "__alignment_not_unique",
+)
+
+# the index of a worker process, loaded by _load_worker_index
+_worker_index = None
+
+
+def import_pysam():
+    try:
+        import pysam
+    except ImportError:
+        raise ImportError(
+            "Please install the pysam package to count reads in-process\n"
+            "    conda install -c bioconda pysam"
+        )
+
+    return pysam
+
+
+def _blocks(read):
+    """Generator of (chrom, start, end) for the matched blocks of a read"""
+    pos = read.reference_start
+    for op, length in read.cigartuples:
+        if op in MATCH_OPS:
+            if length > 0:
+                yield read.reference_name, pos, pos + length
+            pos += length
+        elif op in (2, 3):  # D and N
+            pos += length
+
+
+def _is_mate(a1, a2):
+    """Mate test of HTSeq's pair_SAM_alignments. Returns None to stop
+    looking, as HTSeq does when an unaligned candidate fits."""
+
+    if a1.is_read1 == a2.is_read1:
+        return False
+    if a1.is_unmapped != a2.mate_is_unmapped or a1.mate_is_unmapped != a2.is_unmapped:
+        return False
+    if a1.is_unmapped or a2.is_unmapped:
+        return None
+
+    return (
+        a1.reference_name == a2.next_reference_name
+        and a1.reference_start == a2.next_reference_start
+        and a2.reference_name == a1.next_reference_name
+        and a2.reference_start == a1.next_reference_start
+    )
+
+
+def _pairs(reads):
+    """Pair up the alignments of one read name as (first, second), with None
+    for a missing mate"""
+
+    reads = list(reads)
+    while reads:
+        a1 = reads.pop(0)
+        a2 = None
+        for candidate in reads:
+            is_mate = _is_mate(a1, candidate)
+            if is_mate is None or is_mate:
+                a2 = candidate
+                break
+
+        if a2 is not None:
+            reads.remove(a2)
+
+        yield (a1, a2) if a1.is_read1 else (a2, a1)
+
+
+def _check_paired(read):
+    if not read.is_paired:
+        raise ValueError(f"single-end read {read.query_name} in a paired-end BAM")
+    if read.is_read1 == read.is_read2:
+        raise ValueError(f"can't tell which mate {read.query_name} is")
+
+
+def _classify(reads, index, min_aqual):
+    """Return the counter for one read or pair, as htseq-count assigns it"""
+    aligned = [r for r in reads if r is not None and not r.is_unmapped]
+    if not aligned:
+        return "__not_aligned"
+
+    try:
+        for read in reads:
+            if read is not None and read.get_tag("NH") > 1:
+                return "__alignment_not_unique"
+    except KeyError:
+        pass  # htseq-count skips the whole check at the first missing NH
+
+    if any(r is not None and r.mapping_quality < min_aqual for r in reads):
+        return "__too_low_aQual"
+
+    feature_ids = None
+    for read in aligned:
+        for chrom, start, end in _blocks(read):
+            if chrom not in index.chroms:
+                return "__no_feature"
+            for step in index.overlapping(chrom, start, end):
+                if feature_ids is None:
+                    feature_ids = set(step)
+                else:
+                    feature_ids &= step
+
+    if not feature_ids:
+        return "__no_feature"
+    elif len(feature_ids) > 1:
+        return "__ambiguous"
+    else:
+        return index.feature_ids[next(iter(feature_ids))]
+
+
+def _count_chunk(bam_path, offset, n_reads, paired, min_aqual, index):
+    pysam = import_pysam()
+
+    counts = collections.Counter()
+
+    def records():
+        with pysam.AlignmentFile(bam_path, "rb", check_sq=False) as bam:
+            bam.seek(offset)
+            for _ in range(n_reads):
+                yield next(bam)
+
+    if not paired:
+        for read in records():
+            counts[_classify((read,), index, min_aqual)] += 1
+        return counts
+
+    group = []
+    for read in records():
+        _check_paired(read)
+        if group and read.query_name != group[0].query_name:
+            for pair in _pairs(group):
+                counts[_classify(pair, index, min_aqual)] += 1
+            group = []
+        group.append(read)
+
+    for pair in _pairs(group):
+        counts[_classify(pair, index, min_aqual)] += 1
+
+    return counts
+
+
+def _load_worker_index(index_dir):
+    global _worker_index
+    _worker_index = FeatureIndex.load(index_dir)
+
+
+def _count_chunk_in_worker(*args):
+    return _count_chunk(*args, _worker_index)
+
+
+def bam_chunks(bam_path, chunk_size=CHUNK_SIZE):
+    """Split a name-sorted BAM into chunks that don't split a read name.
+
+    Return (PAIRED, CHUNKS): whether the first read is paired, which decides
+    how the whole file is counted (as in htseq-count), and a list of
+    (virtual offset, number of reads).
+    """
+
+    pysam = import_pysam()
+
+    chunks = []
+    paired = False
+    with pysam.AlignmentFile(bam_path, "rb", check_sq=False) as bam:
+        offset = bam.tell()
+        n_reads = 0
+        name = None
+        while True:
+            next_offset = bam.tell()
+            try:
+                read = next(bam)
+            except StopIteration:
+                break
+
+            if name is None:
+                paired = read.is_paired
+            elif n_reads >= chunk_size and read.query_name != name:
+                chunks.append((offset, n_reads))
+                offset = next_offset
+                n_reads = 0
+
+            name = read.query_name
+            n_reads += 1
+
+        if n_reads:
+            chunks.append((offset, n_reads))
+
+    return paired, chunks
+
+
+def count_reads(
+    bam_path, index, *, n_proc=1, chunk_size=CHUNK_SIZE, min_aqual=MIN_AQUAL
+):
+    """Count the reads of a name-sorted BAM on the features of a FeatureIndex.
+
+    Return a Counter of feature id (or special counter) -> number of reads.
+    """
+
+    paired, chunks = bam_chunks(bam_path, chunk_size)
+    args = [(bam_path, offset, n, paired, min_aqual) for offset, n in chunks]
+
+    counts = collections.Counter()
+    if n_proc > 1 and len(chunks) > 1:
+        # workers memory-map the saved index, so its pages are shared instead
+        # of copied. They're started by a forkserver, as forking this process
+        # while other threads run (e.g. uploads) can deadlock the children
+        tmp_dir = None
+        index_dir = index.index_dir
+        if index_dir is None:
+            index_dir = tmp_dir = tempfile.mkdtemp()
+            index.save(index_dir)
+
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload([__name__])
+        try:
+            with ctx.Pool(
+                min(n_proc, len(chunks)),
+                initializer=_load_worker_index,
+                initargs=(index_dir,),
+            ) as pool:
+                for chunk_counts in pool.starmap(_count_chunk_in_worker, args):
+                    counts.update(chunk_counts)
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+    else:
+        for chunk_args in args:
+            counts.update(_count_chunk(*chunk_args, index))
+
+    return counts
+
+
+def write_counts(counts, index, output_path):
+    """Write counts in the format of htseq-count's output"""
+    with open(output_path, "w") as out:
+        for feature_id in index.feature_ids:
+            out.write(f"{feature_id}\t{counts[feature_id]}\n")
+        for counter in SPECIAL_COUNTERS:
+            out.write(f"{counter}\t{counts[counter]}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="gene_counter.py",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__.splitlines()[0],
+    )
+    parser.add_argument("bam", help="Name-sorted BAM file")
+    parser.add_argument("gtf", help="GTF file of the features to count")
+    parser.add_argument("output", help="Where to write the counts")
+    parser.add_argument("--idattr", default="gene_id")
+    parser.add_argument("--n_proc", type=int, default=1)
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE)
+
+    args = parser.parse_args()
+
+    index = cached_index(args.gtf, args.idattr)
+    counts = count_reads(
+        args.bam, index, n_proc=args.n_proc, chunk_size=args.chunk_size
+    )
+    write_counts(counts, index, args.output)
+
+
+if __name__ == "__main__":
+    main()
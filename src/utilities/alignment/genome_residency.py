@@ -0,0 +1,220 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+
+import utilities.log_util as ut_log
+
+
+# shared by every job on the instance, like the reference cache. STAR keys its
+# shared memory segment on the genome folder, so jobs share a loaded genome
+# only when they use the same folder (e.g. from the reference cache) and run
+# in the host's IPC namespace
+GENOME_REGISTRY_DIR = "/mnt/star_genomes"
+
+# share of physical memory that loaded genomes may use, when no budget is given;
+# the rest is left for STAR's per-thread buffers and samtools sort
+GENOME_MEMORY_FRACTION = 0.5
+
+# the files STAR loads into shared memory
+GENOME_FILES = ("Genome", "SA", "SAindex")
+
+
+def genome_size(genome_dir):
+    """Bytes of shared memory STAR needs to load a genome"""
+    return sum(os.path.getsize(os.path.join(genome_dir, fn)) for fn in GENOME_FILES)
+
+
+def physical_memory():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def shm_limit():
+    """The largest shared memory segment the kernel allows, or None if unknown"""
+    try:
+        with open("/proc/sys/kernel/shmmax") as fh:
+            shmmax = int(fh.read())
+        with open("/proc/sys/kernel/shmall") as fh:
+            shmall = int(fh.read()) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+    return min(shmmax, shmall)
+
+
+def _flock(fd, operation):
+    try:
+        fcntl.flock(fd, operation)
+    except BlockingIOError:
+        return False
+
+    return True
+
+
+class GenomeResidency:
+    """Tracks the STAR genomes loaded in shared memory on a host.
+
+    Every loaded genome has a record and a lock file in root. Jobs using a
+    genome hold its lock shared (acquire) until they release it or exit; the
+    job that finds no other holder when it releases a genome removes it from
+    shared memory with --genomeLoad Remove. A genome whose last user died
+    without releasing it is removed by the next job that loads a genome.
+    Loads that would put the loaded genomes over budget bytes raise
+    RuntimeError. All changes happen under one registry lock.
+    """
+
+    def __init__(
+        self, logger, root=GENOME_REGISTRY_DIR, *, budget=None, star="STAR"
+    ):
+        self.logger = logger
+        self.root = root
+        self.star = star
+
+        if budget is None:
+            budget = int(physical_memory() * GENOME_MEMORY_FRACTION)
+        self.budget = budget
+
+        self.locks_dir = os.path.join(root, "locks")
+        os.makedirs(self.locks_dir, exist_ok=True)
+
+        self._held = {}  # genome name -> fd of its shared lock
+
+    @staticmethod
+    def _name(genome_dir):
+        genome_dir = os.path.realpath(genome_dir)
+        digest = hashlib.md5(genome_dir.encode()).hexdigest()[:10]
+        return f"{os.path.basename(genome_dir)}-{digest}"
+
+    def _lock_fd(self, name):
+        return os.open(
+            os.path.join(self.locks_dir, f"{name}.lock"), os.O_RDWR | os.O_CREAT
+        )
+
+    def _record_path(self, name):
+        return os.path.join(self.root, f"{name}.json")
+
+    @contextlib.contextmanager
+    def _registry_lock(self):
+        fd = self._lock_fd("_registry")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def loaded(self):
+        """Return {name: record} of the genomes loaded on the host"""
+        records = {}
+        for fn in os.listdir(self.root):
+            if fn.endswith(".json"):
+                with open(os.path.join(self.root, fn)) as fh:
+                    records[fn[: -len(".json")]] = json.load(fh)
+
+        return records
+
+    def _star(self, genome_dir, mode):
+        command = [self.star, "--genomeDir", genome_dir, "--genomeLoad", mode]
+        return ut_log.log_command(
+            self.logger,
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            shell=True,
+            cwd=self.root,
+        )
+
+    def _remove(self, name, record):
+        self.logger.info(f"Removing genome {record['genome_dir']} from shared memory")
+        if self._star(record["genome_dir"], "Remove"):
+            self.logger.warning(f"Failed to remove genome {record['genome_dir']}")
+        os.remove(self._record_path(name))
+
+    def _remove_idle(self, keep):
+        """Remove the loaded genomes that no job holds, except keep"""
+        for name, record in self.loaded().items():
+            if name == keep or name in self._held:
+                continue
+
+            fd = self._lock_fd(name)
+            try:
+                if _flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                    self._remove(name, record)
+            finally:
+                os.close(fd)
+
+    def acquire(self, genome_dir):
+        """Make sure genome_dir is loaded in shared memory and hold it until
+        release() is called or the process exits"""
+
+        name = self._name(genome_dir)
+        if name in self._held:
+            return
+
+        with self._registry_lock():
+            fd = self._lock_fd(name)
+            try:
+                if name in self.loaded():
+                    self.logger.info(f"Genome {genome_dir} is already loaded")
+                else:
+                    self._remove_idle(keep=name)
+                    self._load(name, genome_dir)
+
+                fcntl.flock(fd, fcntl.LOCK_SH)
+            except BaseException:
+                os.close(fd)
+                raise
+
+        self._held[name] = fd
+
+    def _load(self, name, genome_dir):
+        size = genome_size(genome_dir)
+        in_use = sum(record["size"] for record in self.loaded().values())
+        if in_use + size > self.budget:
+            raise RuntimeError(
+                f"Loading {genome_dir} ({size / 2 ** 30:.1f} GB) would use"
+                f" {(in_use + size) / 2 ** 30:.1f} GB of shared memory,"
+                f" over the budget of {self.budget / 2 ** 30:.1f} GB"
+            )
+
+        limit = shm_limit()
+        if limit is not None and size > limit:
+            raise RuntimeError(
+                f"{genome_dir} needs {size} bytes of shared memory but the kernel"
+                f" allows {limit} (kernel.shmmax / kernel.shmall)"
+            )
+
+        if self._star(genome_dir, "LoadAndExit"):
+            raise RuntimeError("Failed to load genome into memory")
+
+        with open(f"{self._record_path(name)}.tmp", "w") as out:
+            json.dump({"genome_dir": os.path.realpath(genome_dir), "size": size}, out)
+        os.replace(f"{self._record_path(name)}.tmp", self._record_path(name))
+
+    def release(self, genome_dir):
+        """Stop using genome_dir, and remove it if no other job is using it"""
+        name = self._name(genome_dir)
+        fd = self._held.pop(name, None)
+        if fd is None:
+            return
+
+        with self._registry_lock():
+            try:
+                # nobody else can take the lock while the registry is locked,
+                # so an exclusive lock means this was the last user
+                if _flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                    record = self.loaded().get(name)
+                    if record is not None:
+                        self._remove(name, record)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        """Release every genome this process holds"""
+        for name in list(self._held):
+            record = self.loaded().get(name)
+            if record is not None:
+                self.release(record["genome_dir"])
+            else:
+                os.close(self._held.pop(name))
@@ -2,17 +2,18 @@
 
 # Example: TAXON=homo CELL_COUNT=3000 S3_DIR=s3://biohub-spyros/data/10X_data/CK_Healthy/ ./10x_count.py
 import argparse
+import collections
 import os
 import pathlib
+import re
 import sys
 import subprocess
-import tarfile
 import posixpath
 
 from utilities.log_util import get_logger, log_command
-
-
-import boto3
+import utilities.reference_cache as reference_cache
+import utilities.s3_util as s3u
+import utilities.work_queue as work_queue
 
 
 # reference genome bucket name for different regions
@@ -49,6 +50,10 @@ deprecated = {
 CELLRANGER = "cellranger"
 S3_RETRY = 5
 
+# 10x fastq names, e.g. Sample1_S1_L001_R1_001.fastq.gz; the lane is left out
+# when lanes are merged
+FASTQ_NAME = re.compile(r"(?P<sample>.+)_S\d+(_L\d+)?_[RI]\d_\d+\.fastq\.gz$")
+
 
 def get_default_requirements():
     return argparse.Namespace(
@@ -131,82 +136,89 @@ def get_parser():
     )
 
     parser.add_argument("--glacier", action="store_true")
+    parser.add_argument(
+        "--reference_cache",
+        nargs="?",
+        const=reference_cache.REFERENCE_CACHE_DIR,
+        default=None,
+        help="Share one extracted copy of the reference with the other jobs on"
+        " this host, in this folder (default path if no value)",
+    )
+    parser.add_argument(
+        "--reference_cache_gb",
+        type=float,
+        default=reference_cache.REFERENCE_CACHE_GB,
+        help="Disk quota of the reference cache; least recently used references"
+        " are removed to stay under it",
+    )
     parser.add_argument("--root_dir", default="/mnt")
+    parser.add_argument(
+        "--claim_queue",
+        default=None,
+        help="Instead of running --sample_prefix, claim the samples of the input"
+        " folder from a queue shared by all jobs of the run (an s3:// prefix,"
+        " or a local SQLite file)",
+    )
 
     return parser
 
 
-def main(logger):
-    """ Download reference genome, run alignment jobs, and upload results to S3.
+def fastq_sample(key):
+    """Return the sample prefix of a 10x fastq file, or None for other files"""
+    m = FASTQ_NAME.match(posixpath.basename(key))
+    return m and m.group("sample")
 
-        logger - Logger object that exposes the interface the code directly uses
-    """
 
-    parser = get_parser()
-
-    args = parser.parse_args()
-
-    args.root_dir = pathlib.Path(args.root_dir)
+def list_fastqs(s3_input_path):
+    """Return {sample prefix: fastq.gz keys} for the files under s3_input_path"""
+    s3_input_bucket, s3_input_prefix = s3u.s3_bucket_and_key(s3_input_path)
 
-    if os.environ.get("AWS_BATCH_JOB_ID"):
-        args.root_dir = args.root_dir / os.environ["AWS_BATCH_JOB_ID"]
+    sample_fastqs = collections.defaultdict(list)
+    for fn in s3u.get_files(s3_input_bucket, s3_input_prefix):
+        sample_prefix = fastq_sample(fn)
+        if sample_prefix is not None and sample_prefix != "Undetermined":
+            sample_fastqs[sample_prefix].append(fn)
 
-    # local directories
-    if args.s3_input_path.endswith("/"):
-        args.s3_input_path = args.s3_input_path[:-1]
+    return dict(sample_fastqs)
 
-    sample_id = os.path.basename(args.s3_input_path)
-    result_path = args.root_dir / "data" / sample_id
-    if args.legacy:
-        fastq_path = result_path / "fastqs"
-    else:
-        fastq_path = result_path
-    fastq_path.mkdir(parents=True)
 
-    genome_base_dir = args.root_dir / "genome" / "cellranger"
-    genome_base_dir.mkdir(parents=True)
+def list_samples(s3_input_path):
+    """Return the sample prefixes of the fastq.gz files under s3_input_path"""
+    return sorted(list_fastqs(s3_input_path))
 
-    # check if the input genome and region are valid
-    if args.taxon in reference_genomes:
-        if args.taxon in deprecated:
-            logger.warn(
-                f"The name '{args.taxon}' will be removed in the future,"
-                f" start using '{deprecated[args.taxon]}'"
-            )
 
-        genome_name = reference_genomes[args.taxon]
+def fastq_includes(sample_prefix, by_folder):
+    """aws s3 cp --include patterns for the fastq files of a sample. With
+    by_folder the prefix can be any part of the path, otherwise it must be
+    the whole sample name, so S1 doesn't match S10"""
+    if by_folder:
+        return ["--include", f"'*{sample_prefix}*'"]
     else:
-        raise ValueError(f"unknown taxon {args.taxon}")
-
-    genome_dir = genome_base_dir / genome_name
-    ref_genome_10x_file = f"cellranger/{genome_name}.tgz"
-
-    #if args.region != "west" and genome_name not in ("HG38-PLUS", "MM10-PLUS"):
-    #    raise ValueError(f"you must use --region west for {genome_name}")
-
-    if args.region == "east":
-        ref_genome_10x_file = f"ref-genome/{ref_genome_10x_file}"
-
-    logger.info(
-        f"""Run Info: partition {args.partition_id} out of {args.num_partitions}
-                   genome_dir:\t{genome_dir}
-         ref_genome_10x_file:\t{ref_genome_10x_file}
-                        taxon:\t{args.taxon}
-                s3_input_path:\t{args.s3_input_path}"""
-    )
+        return [
+            "--include",
+            f"'{sample_prefix}_S*'",
+            "--include",
+            f"'*/{sample_prefix}_S*'",
+        ]
 
-    s3 = boto3.resource("s3")
 
-    # download the reference genome data
-    logger.info(f"Downloading and extracting genome data {genome_name}")
+def sample_fastqs(s3_input_path, sample_prefix, by_folder):
+    """Return the keys under s3_input_path that fastq_includes downloads"""
+    if not by_folder:
+        return list_fastqs(s3_input_path).get(sample_prefix, [])
 
-    s3_genome_object = s3.Object(S3_REFERENCE[args.region], ref_genome_10x_file)
-
-    with tarfile.open(fileobj=s3_genome_object.get()["Body"], mode="r|gz") as tf:
-        tf.extractall(path=genome_base_dir)
+    s3_input_bucket, s3_input_prefix = s3u.s3_bucket_and_key(s3_input_path)
+    return [
+        key
+        for key in s3u.get_files(s3_input_bucket, s3_input_prefix)
+        if (sample_prefix or "") in key[len(s3_input_prefix) :]
+    ]
 
 
-    sys.stdout.flush()
+def run_sample(args, sample_prefix, fastq_path, result_path, genome_dir, logger):
+    """ Download the fastq files of one sample, run cellranger count on them and
+        sync the outs folder to S3. Raise RuntimeError if any step fails.
+    """
 
     # download the fastq files
     command = [
@@ -217,23 +229,13 @@ def main(logger):
         "--recursive",
         "--exclude",
         "'*'",
-        "--include",
-        f"'*{args.sample_prefix}*'",
+        *fastq_includes(sample_prefix, args.by_folder),
         "--force-glacier-transfer" if args.glacier else "",
         args.s3_input_path,
         f"{fastq_path}",
     ]
     log_command(logger, command, shell=True)
 
-    logger.info(f"Running partition {args.partition_id} of {args.num_partitions}")
-
-    # check the input folder for existing runs
-    #sample_name = {
-    #    os.path.basename(fn).rsplit("_", 4)[0] for fn in fastq_path.glob("*fastq.gz")
-    #}
-    #assert len(sample_name) == 1, "Should only have one sample name to process"
-    #sample_name = sample_name.pop()
-
     # Run cellranger
     os.chdir(result_path)
 
@@ -246,7 +248,7 @@ def main(logger):
         "--nosecondary",
         "--disable-ui",
         f"--expect-cells={args.cell_count}",
-        f"--id={args.sample_prefix}",
+        f"--id={sample_prefix}",
         f"--fastqs={fastq_path}",
         f"--transcriptome={genome_dir}" # no sample_prefix: run all samples in folder
         ]
@@ -260,10 +262,10 @@ def main(logger):
             "--nosecondary",
             "--disable-ui",
             f"--expect-cells={args.cell_count}",
-            f"--id={args.sample_prefix}",
+            f"--id={sample_prefix}",
             f"--fastqs={fastq_path}",
             f"--transcriptome={genome_dir}",
-            f"--sample={args.sample_prefix}",
+            f"--sample={sample_prefix}",
         ]
 
     failed = log_command(
@@ -284,8 +286,8 @@ def main(logger):
         "s3",
         "sync",
         "--no-progress",
-        os.path.join(result_path, args.sample_prefix, "outs"),
-        posixpath.join(args.s3_output_path, args.sample_prefix),
+        os.path.join(result_path, sample_prefix, "outs"),
+        posixpath.join(args.s3_output_path, sample_prefix),
     ]
     for i in range(S3_RETRY):
         if not log_command(logger, command, shell=True):
@@ -295,6 +297,158 @@ def main(logger):
         raise RuntimeError(f"couldn't sync output")
 
 
+def main(logger):
+    """ Download reference genome, run alignment jobs, and upload results to S3.
+
+        logger - Logger object that exposes the interface the code directly uses
+    """
+
+    parser = get_parser()
+
+    args = parser.parse_args()
+
+    if args.claim_queue and args.by_folder:
+        parser.error("--claim_queue claims single samples, it can't run --by_folder")
+
+    args.root_dir = pathlib.Path(args.root_dir)
+
+    if os.environ.get("AWS_BATCH_JOB_ID"):
+        args.root_dir = args.root_dir / os.environ["AWS_BATCH_JOB_ID"]
+
+    # local directories
+    if args.s3_input_path.endswith("/"):
+        args.s3_input_path = args.s3_input_path[:-1]
+
+    sample_id = os.path.basename(args.s3_input_path)
+    result_path = args.root_dir / "data" / sample_id
+    if args.legacy:
+        fastq_path = result_path / "fastqs"
+    else:
+        fastq_path = result_path
+    fastq_path.mkdir(parents=True)
+
+    genome_base_dir = args.root_dir / "genome" / "cellranger"
+
+    # check if the input genome and region are valid
+    if args.taxon in reference_genomes:
+        if args.taxon in deprecated:
+            logger.warn(
+                f"The name '{args.taxon}' will be removed in the future,"
+                f" start using '{deprecated[args.taxon]}'"
+            )
+
+        genome_name = reference_genomes[args.taxon]
+    else:
+        raise ValueError(f"unknown taxon {args.taxon}")
+
+    genome_dir = genome_base_dir / genome_name
+    ref_genome_10x_file = f"cellranger/{genome_name}.tgz"
+
+    #if args.region != "west" and genome_name not in ("HG38-PLUS", "MM10-PLUS"):
+    #    raise ValueError(f"you must use --region west for {genome_name}")
+
+    if args.region == "east":
+        ref_genome_10x_file = f"ref-genome/{ref_genome_10x_file}"
+
+    logger.info(
+        f"""Run Info: partition {args.partition_id} out of {args.num_partitions}
+                   genome_dir:\t{genome_dir}
+         ref_genome_10x_file:\t{ref_genome_10x_file}
+                        taxon:\t{args.taxon}
+                s3_input_path:\t{args.s3_input_path}"""
+    )
+
+    if args.glacier:
+        # request restores first, so they thaw while the genome downloads
+        s3_input_bucket, _ = s3u.s3_bucket_and_key(args.s3_input_path)
+        if args.claim_queue is None:
+            sample_restores = {
+                args.sample_prefix: sample_fastqs(
+                    args.s3_input_path, args.sample_prefix, args.by_folder
+                )
+            }
+        else:
+            sample_restores = list_fastqs(args.s3_input_path)
+        watcher = s3u.RestoreWatcher(
+            args.root_dir / "restores.json", bucket=s3_input_bucket
+        )
+        watcher.request(key for keys in sample_restores.values() for key in keys)
+
+    def wait_for_restore(sample_prefix):
+        """Wait until the archived fastq files of sample_prefix are readable.
+        Files that weren't listed, e.g. uploaded since, aren't archived"""
+        if args.glacier:
+            logger.info(f"Waiting for {sample_prefix}'s fastq files to be restored")
+            for _ in watcher.watch_groups(
+                {sample_prefix: sample_restores.get(sample_prefix, [])}
+            ):
+                pass
+
+    # download the reference genome data
+    if args.reference_cache:
+        cache = reference_cache.ReferenceCache(
+            args.reference_cache,
+            quota=args.reference_cache_gb * 2 ** 30,
+            logger=logger,
+        )
+        genome_dir = (
+            pathlib.Path(cache.get(S3_REFERENCE[args.region], ref_genome_10x_file))
+            / genome_name
+        )
+    else:
+        logger.info(f"Downloading and extracting genome data {genome_name}")
+        genome_base_dir.mkdir(parents=True, exist_ok=True)
+        reference_cache.fetch_reference(
+            S3_REFERENCE[args.region], ref_genome_10x_file, genome_base_dir
+        )
+
+
+    sys.stdout.flush()
+
+    logger.info(f"Running partition {args.partition_id} of {args.num_partitions}")
+
+    if args.claim_queue is None:
+        wait_for_restore(args.sample_prefix)
+        run_sample(args, args.sample_prefix, fastq_path, result_path, genome_dir, logger)
+        return
+
+    # each claimed sample is removed from local disk once it is synced, so a
+    # job can work through any number of them
+    claim_queue = work_queue.open_queue(args.claim_queue)
+    logger.info(f"Claiming samples from {args.claim_queue}")
+
+    failed_samples = []
+    for sample_prefix in claim_queue.claim_items(list_samples(args.s3_input_path)):
+        # each sample downloads into its own folder, removed once it's synced
+        sample_fastq_path = args.root_dir / "fastqs" / sample_prefix
+        sample_fastq_path.mkdir(parents=True)
+        try:
+            # claimed first, so jobs wait for different samples to thaw
+            wait_for_restore(sample_prefix)
+            run_sample(
+                args, sample_prefix, sample_fastq_path, result_path, genome_dir, logger
+            )
+        except RuntimeError as e:
+            # not retried by other jobs, as when the job runs a single sample
+            logger.error(f"{sample_prefix} failed: {e}")
+            failed_samples.append(sample_prefix)
+
+        claim_queue.complete(sample_prefix)
+
+        command = [
+            "rm",
+            "-rf",
+            f"{sample_fastq_path}",
+            f"{result_path / sample_prefix}",
+        ]
+        log_command(logger, command, shell=True)
+
+    claim_queue.close()
+
+    if failed_samples:
+        raise RuntimeError(f"samples failed: {', '.join(failed_samples)}")
+
+
 if __name__ == "__main__":
     mainlogger, log_file, file_handler = get_logger(__name__)
 
@@ -1,19 +1,26 @@
 #!/usr/bin/env python
 import argparse
 import datetime
+import functools
+import json
 import os
+import queue
 import re
+import shutil
 import subprocess
-import tarfile
+import threading
 import time
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
+import utilities.alignment.genome_residency as genome_residency
+import utilities.completion_index as completion_index
 import utilities.log_util as ut_log
+import utilities.partition_util as partition_util
+import utilities.reference_cache as reference_cache
 import utilities.s3_util as s3u
-
-import boto3
-from boto3.s3.transfer import TransferConfig
+import utilities.work_queue as work_queue
 
 
 # reference genome bucket name for different regions
@@ -39,6 +46,14 @@ STAR = "STAR"
 HTSEQ = "htseq-count"
 SAMTOOLS = "samtools"
 
+# memory shared by the coordinate and name sorts of a sample; samtools sort
+# spills to temporary files when its share runs out
+SORT_MEMORY = 12 * 2 ** 30
+
+# memory a sample needs besides its sorts, for STAR's buffers (the genome is in
+# shared memory) and counting; used to decide how many samples fit at once
+SAMPLE_MEMORY = 4 * 2 ** 30
+
 COMMON_PARS = [
     STAR,
     "--outFilterType",
@@ -79,6 +94,13 @@ COMMON_PARS = [
 
 CURR_MIN_VER = datetime.datetime(2017, 3, 1, tzinfo=datetime.timezone.utc)
 
+# the sample name of a fastq file
+SAMPLE_RE = re.compile(r"([^/]+)_R\d(?:_\d+)?.fastq.gz$")
+
+# threads and part size for each multipart upload of the results
+UPLOAD_CONCURRENCY = 8
+UPLOAD_CHUNK_SIZE = 64 * 2 ** 20
+
 
 def get_default_requirements():
     return argparse.Namespace(vcpus=16, memory=64000, storage=500, ecr_image="aligner")
@@ -161,33 +183,116 @@ def get_parser():
         default=50000,
         help="Minimum file size (in bytes) for a sample to be aligned.",
     )
+    parser.add_argument(
+        "--listing_cache",
+        nargs="?",
+        const=s3u.LISTING_CACHE_PATH,
+        default=None,
+        help="Cache S3 listings in this SQLite file (default path if no value)",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="Number of samples (or batches, see --batch_bytes) to download ahead of"
+        " the one being aligned",
+    )
+    parser.add_argument(
+        "--prefetch_disk_gb",
+        type=float,
+        default=100,
+        help="Maximum size (in GB) of fastq files held on disk at once",
+    )
+    parser.add_argument(
+        "--upload_queue",
+        type=int,
+        default=1,
+        help="Number of finished samples that can wait for upload"
+        " before alignment pauses",
+    )
+    parser.add_argument(
+        "--plan",
+        default=None,
+        help="S3 path of a sample plan made by aws_star (see make_plan), used"
+        " instead of listing and grouping the input fastq files",
+    )
+    parser.add_argument(
+        "--claim_queue",
+        default=None,
+        help="Instead of the static partition, claim samples from a queue shared"
+        " by all jobs of the run (an s3:// prefix, or a local SQLite file)."
+        " --partition_id and --num_partitions are ignored",
+    )
+    parser.add_argument(
+        "--reference_cache",
+        nargs="?",
+        const=reference_cache.REFERENCE_CACHE_DIR,
+        default=None,
+        help="Share one extracted copy of the reference with the other jobs on"
+        " this host, in this folder (default path if no value)",
+    )
+    parser.add_argument(
+        "--reference_cache_gb",
+        type=float,
+        default=reference_cache.REFERENCE_CACHE_GB,
+        help="Disk quota of the reference cache; least recently used references"
+        " are removed to stay under it",
+    )
+    parser.add_argument(
+        "--counter",
+        default="htseq",
+        choices=("htseq", "native"),
+        help="Count reads with htseq-count, or in-process with gene_counter"
+        " (same output, needs pysam)",
+    )
+    parser.add_argument(
+        "--concurrent_samples",
+        type=int,
+        default=1,
+        help="Number of samples (or batches) to align and count at once. They"
+        " split --star_proc threads and the sort memory, and no more start than"
+        " fit in the memory available to the job",
+    )
+    parser.add_argument(
+        "--batch_bytes",
+        type=int,
+        default=0,
+        help="Align samples with less than this many bytes of fastq files together,"
+        " in batches of up to this size, with one STAR run per batch. Their"
+        " Log.final.out and SJ.out.tab describe the whole batch and are uploaded"
+        " with a .batch suffix. --outFilterType BySJout filters on the junctions"
+        " of the whole batch, so alignments can differ from per-sample runs",
+    )
+    parser.add_argument(
+        "--genome_registry",
+        default=genome_residency.GENOME_REGISTRY_DIR,
+        help="Folder where the jobs on this host track the STAR genomes loaded"
+        " in shared memory",
+    )
+    parser.add_argument(
+        "--genome_memory_gb",
+        type=float,
+        default=None,
+        help="Shared memory that loaded STAR genomes may use on this host"
+        " (default: half of physical memory)",
+    )
 
     return parser
 
 
-def run_sample(
-    s3_input_bucket, sample_name, sample_fns, genome_dir, run_dir, star_proc, logger
-):
-    """ Run alignment jobs with STAR.
+def download_sample(s3_input_bucket, sample_name, sample_fns, run_dir):
+    """ Download the fastq files of one sample.
 
         s3_input_bucket - Name of the bucket with input fastq files to align
         sample_name - Sequenced sample name (joined by "_")
-        sample_fns - Sample file names. Each file name is concatenated by sample_name,
-                     "_R1_" or"_R2_", a number, and ".fastq.gz"
-        genome_dir - Path to reference genome
+        sample_fns - Sample file names
         run_dir - Path local to the machine on EC2 under which alignment results
                   are stored before uploaded to S3
-        star_proc - Number of processes to give to each STAR run
-        logger - Logger object that exposes the interface the code directly uses
 
-        Return two values. FAILED is a boolean value of whether the alignment run
-        fails. DEST_DIR is the path under which STAR alignment results are stored.
-        This path is local to the machine on EC2 running the alignment, and that's
-        where we copy the alignment results to upload to S3 later.
+        Return DEST_DIR, the path the files were downloaded to, where run_sample
+        will store the alignment results.
     """
 
-    t_config = TransferConfig(use_threads=False, num_download_attempts=25)
-
     dest_dir = os.path.join(run_dir, sample_name)
 
     if not os.path.exists(dest_dir):
@@ -197,31 +302,195 @@ def run_sample(
         os.mkdir(os.path.join(dest_dir, "results", "Pass1"))
 
     for sample_fn in sample_fns:
-        s3c.download_file(
-            Bucket=s3_input_bucket,
-            Key=sample_fn,
-            Filename=os.path.join(dest_dir, os.path.basename(sample_fn)),
-            Config=t_config,
+        s3u.download_file(
+            s3_input_bucket,
+            sample_fn,
+            os.path.join(dest_dir, os.path.basename(sample_fn)),
         )
 
-    # start running STAR
-    # getting input files first
+    return dest_dir
 
-    reads = sorted(
-        os.path.join(dest_dir, os.path.basename(sample_fn)) for sample_fn in sample_fns
-    )
 
-    input_command = COMMON_PARS[:]
-    input_command.extend(
+class SamplePrefetcher:
+    """ Download the fastq files of upcoming batches of samples on a background
+        thread.
+
+        Iterating yields (batch, size, download_time) in the order of batches,
+        where batch is a list of (sample_name, sample_fns, size) and size is its
+        total. Up to depth batches are downloaded ahead of the one being
+        processed, as long as the fastq files of every sample that hasn't been
+        released fit in disk_budget bytes. A batch bigger than the budget is
+        downloaded once nothing else is held. abort() stops the downloads and
+        makes the iteration raise, e.g. when held samples will never be
+        released.
+    """
+
+    def __init__(self, s3_input_bucket, batches, run_dir, *, depth, disk_budget):
+        self.s3_input_bucket = s3_input_bucket
+        self.batches = batches  # lists of (sample_name, sample_fns, size) tuples
+        self.run_dir = run_dir
+        self.depth = max(depth, 1)
+        self.disk_budget = disk_budget
+
+        self._cond = threading.Condition()
+        self._ahead = 0
+        self._held = 0
+        self._error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._download, daemon=True)
+        self._thread.start()
+
+    def _has_room(self, size):
+        return self._ahead < self.depth and (
+            self._held == 0 or self._held + size <= self.disk_budget
+        )
+
+    def _download(self):
+        try:
+            for batch in self.batches:
+                size = sum(sample_size for _, _, sample_size in batch)
+                with self._cond:
+                    self._cond.wait_for(
+                        lambda: self._error is not None or self._has_room(size)
+                    )
+                    if self._error is not None:
+                        return
+                    self._ahead += 1
+                    self._held += size
+
+                start = time.monotonic()
+                for sample_name, sample_fns, _ in batch:
+                    download_sample(
+                        self.s3_input_bucket, sample_name, sample_fns, self.run_dir
+                    )
+                self._queue.put((batch, size, time.monotonic() - start))
+        except Exception as e:
+            self._queue.put(e)
+        else:
+            self._queue.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if self._error is not None:
+                raise self._error
+            elif item is None:
+                return
+            elif isinstance(item, Exception):
+                raise item
+
+            with self._cond:
+                self._ahead -= 1
+                self._cond.notify_all()
+
+            yield item
+
+    def release(self, size):
+        """Mark a sample's files, of the given size, as removed from disk"""
+        with self._cond:
+            self._held -= size
+            self._cond.notify_all()
+
+    def abort(self, error):
+        """Stop downloading and raise error from the iteration"""
+        with self._cond:
+            self._error = error
+            self._cond.notify_all()
+        self._queue.put(error)  # wakes the iteration if it's waiting
+
+
+def batch_samples(samples, batch_bytes):
+    """ Group samples to be aligned together by run_batch.
+
+        samples - Iterable of (sample_name, sample_fns, size)
+        batch_bytes - Samples smaller than this are put in batches of up to this
+                      total size. Larger samples, or every sample if it's 0, are
+                      batches of their own
+
+        Yield lists of (sample_name, sample_fns, size). The samples of a batch
+        all have the same number of fastq files, i.e. are all single-end or all
+        paired-end.
+    """
+
+    batch = []
+    for sample in samples:
+        _, sample_fns, size = sample
+        if size >= batch_bytes:
+            yield [sample]
+            continue
+
+        if batch and (
+            len(batch[0][1]) != len(sample_fns)
+            or sum(s for _, _, s in batch) + size > batch_bytes
+        ):
+            yield batch
+            batch = []
+
+        batch.append(sample)
+
+    if batch:
+        yield batch
+
+
+def star_command(genome_dir, star_proc, read_files):
+    """ The STAR command of run_sample and run_batch, reading read_files: one
+        argument for each mate, with a comma-separated list of files per mate to
+        align several samples in one run.
+    """
+
+    command = COMMON_PARS[:]
+    command.extend(
         (
             "--runThreadN",
             str(star_proc),
             "--genomeDir",
             genome_dir,
             "--readFilesIn",
-            " ".join(reads),
+            *read_files,
         )
     )
+
+    return command
+
+
+def run_sample(
+    sample_name,
+    sample_fns,
+    genome_dir,
+    run_dir,
+    star_proc,
+    logger,
+    *,
+    sort_memory=SORT_MEMORY,
+):
+    """ Run alignment jobs with STAR on the fastq files from download_sample.
+
+        sample_name - Sequenced sample name (joined by "_")
+        sample_fns - Sample file names. Each file name is concatenated by sample_name,
+                     "_R1_" or"_R2_", a number, and ".fastq.gz"
+        genome_dir - Path to reference genome
+        run_dir - Path local to the machine on EC2 under which alignment results
+                  are stored before uploaded to S3
+        star_proc - Number of processes to give to each STAR run
+        logger - Logger object that exposes the interface the code directly uses
+        sort_memory - Number of bytes shared by the two sorts of sort_alignments
+
+        Return two values. FAILED is a boolean value of whether the alignment run
+        fails. DEST_DIR is the path under which STAR alignment results are stored.
+        This path is local to the machine on EC2 running the alignment, and that's
+        where we copy the alignment results to upload to S3 later.
+    """
+
+    dest_dir = os.path.join(run_dir, sample_name)
+
+    # start running STAR
+    # getting input files first
+
+    reads = sorted(
+        os.path.join(dest_dir, os.path.basename(sample_fn)) for sample_fn in sample_fns
+    )
+
+    input_command = star_command(genome_dir, star_proc, reads)
     failed = ut_log.log_command(
         logger,
         input_command,
@@ -231,57 +500,190 @@ def run_sample(
         cwd=os.path.join(dest_dir, "results", "Pass1"),
     )
 
-    # running sam tools
-    sample_command = [
-        SAMTOOLS,
-        "sort",
-        "-m",
-        "6000000000",
-        "-o",
-        "./Pass1/Aligned.out.sorted.bam",
-        "./Pass1/Aligned.out.bam",
-    ]
-    failed = failed or ut_log.log_command(
+    failed = failed or sort_alignments(
+        os.path.join(dest_dir, "results", "Pass1"),
+        star_proc,
         logger,
-        sample_command,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        cwd=os.path.join(dest_dir, "results"),
+        memory=sort_memory,
+    )
+
+    return failed, dest_dir
+
+
+def run_batch(
+    batch, genome_dir, run_dir, star_proc, logger, *, sort_memory=SORT_MEMORY
+):
+    """ Align a batch of small samples (from batch_samples) in one STAR run, so
+        that they share its startup and genome attach, then split the
+        alignments back into the per-sample folders run_sample would use.
+
+        batch - List of (sample_name, sample_fns, size), downloaded with
+                download_sample
+        genome_dir - Path to reference genome
+        run_dir - Path local to the machine on EC2 under which alignment results
+                  are stored before uploaded to S3
+        star_proc - Number of processes to give to the STAR run
+        logger - Logger object that exposes the interface the code directly uses
+        sort_memory - Number of bytes shared by the sorts of each sample
+
+        Every read is tagged with a read group named after its sample, and
+        samtools split writes each sample's Aligned.out.bam from them, which is
+        then sorted as in run_sample. Log.final.out and SJ.out.tab are made by
+        STAR for the batch as a whole, so each sample gets a copy named with a
+        .batch suffix (see upload_results). These samples have no per-sample
+        log, so gene_cell_table leaves their QC columns empty.
+        --outFilterType BySJout filters reads on the junctions found in the
+        whole batch, so a sample's alignments can differ slightly from a run
+        of that sample alone.
+
+        Return a list of (FAILED, DEST_DIR), as run_sample, in the order of batch.
+    """
+
+    batch_dir = os.path.join(run_dir, "_batches", batch[0][0])
+    os.makedirs(batch_dir)
+
+    # the manifest of the run: one line per sample with its read group and
+    # fastq files, in the order STAR reads them
+    mates = defaultdict(list)
+    with open(os.path.join(batch_dir, "manifest.tsv"), "w") as out:
+        for sample_name, sample_fns, _ in batch:
+            reads = sorted(
+                os.path.join(run_dir, sample_name, os.path.basename(sample_fn))
+                for sample_fn in sample_fns
+            )
+            for i, read in enumerate(reads):
+                mates[i].append(read)
+            print(sample_name, *reads, sep="\t", file=out)
+
+    input_command = star_command(
+        genome_dir, star_proc, [",".join(mates[i]) for i in sorted(mates)]
+    )
+    input_command.extend(
+        (
+            "--outSAMattrRGline",
+            " , ".join(f"ID:{sample_name}" for sample_name, _, _ in batch),
+        )
     )
 
-    # running samtools index -b
-    sample_index_command = [SAMTOOLS, "index", "-b", "Aligned.out.sorted.bam"]
-    failed = failed or ut_log.log_command(
+    # the read group ID is the sample name, so %! puts every sample's reads in
+    # its own folder
+    split_command = [
+        SAMTOOLS,
+        "split",
+        "-@",
+        str(star_proc),
+        "-f",
+        f"'{os.path.join(run_dir, '%!', 'results', 'Pass1', 'Aligned.out.bam')}'",
+        "Aligned.out.bam",
+    ]
+
+    run = functools.partial(
+        ut_log.log_command,
         logger,
-        sample_index_command,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         shell=True,
-        cwd=os.path.join(dest_dir, "results", "Pass1"),
+        cwd=batch_dir,
     )
+    batch_failed = run(input_command) or run(split_command)
 
-    # generating files for htseq-count
-    output_command = [
-        SAMTOOLS,
-        "sort",
-        "-m",
-        "6000000000",
-        "-n",
-        "-o",
-        "./Pass1/Aligned.out.sorted-byname.bam",
-        "./Pass1/Aligned.out.sorted.bam",
-    ]
-    failed = failed or ut_log.log_command(
+    results = []
+    for sample_name, _, _ in batch:
+        dest_dir = os.path.join(run_dir, sample_name)
+        pass1_dir = os.path.join(dest_dir, "results", "Pass1")
+
+        failed = batch_failed or not os.path.exists(
+            os.path.join(pass1_dir, "Aligned.out.bam")
+        )
+        if not failed:
+            for fn in ("Log.final.out", "SJ.out.tab"):
+                shutil.copy(
+                    os.path.join(batch_dir, fn), os.path.join(pass1_dir, f"{fn}.batch")
+                )
+            failed = sort_alignments(
+                pass1_dir, star_proc, logger, memory=sort_memory
+            )
+
+        results.append((failed, dest_dir))
+
+    shutil.rmtree(batch_dir)
+
+    return results
+
+
+def sort_commands(threads, memory=SORT_MEMORY):
+    """ Return the commands that sort STAR's unsorted Aligned.out.bam by
+        coordinate and by name, to be run side by side in the Pass1 folder.
+
+        threads - Number of threads shared by the two sorts
+        memory - Number of bytes shared by the two sorts
+
+        Return (COORDINATE_COMMAND, NAME_COMMAND).
+    """
+
+    sort_threads = max(threads // 2, 1)
+    # samtools sort -m is per thread
+    thread_memory = max(memory // (2 * sort_threads) // 2 ** 20, 1)
+
+    def sort_command(*options, output):
+        return [
+            SAMTOOLS,
+            "sort",
+            "-@",
+            str(sort_threads),
+            "-m",
+            f"{thread_memory}M",
+            *options,
+            "-o",
+            output,
+            "Aligned.out.bam",
+        ]
+
+    return (
+        sort_command("-T", "sort-coord", output="Aligned.out.sorted.bam"),
+        sort_command("-n", "-T", "sort-name", output="Aligned.out.sorted-byname.bam"),
+    )
+
+
+def sort_alignments(pass1_dir, star_proc, logger, *, memory=SORT_MEMORY):
+    """ Sort STAR's unsorted Aligned.out.bam by coordinate (then index it) and by
+        name for htseq. Both sorts read the unsorted file at the same time, so
+        neither waits for the other, and they split star_proc threads and memory
+        bytes between them.
+
+        pass1_dir - Path of the STAR output folder
+        star_proc - Number of processes given to STAR, reused for sorting
+        logger - Logger object that exposes the interface the code directly uses
+
+        Return FAILED, a boolean value of whether any step failed
+    """
+
+    run = functools.partial(
+        ut_log.log_command,
         logger,
-        output_command,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         shell=True,
-        cwd=os.path.join(dest_dir, "results"),
+        cwd=pass1_dir,
     )
 
-    return failed, dest_dir
+    coordinate_command, name_command = sort_commands(star_proc, memory)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        name_sort = executor.submit(run, name_command)
+
+        # running samtools index -b
+        index_command = [
+            SAMTOOLS,
+            "index",
+            "-@",
+            str(max(star_proc // 2, 1)),
+            "-b",
+            "Aligned.out.sorted.bam",
+        ]
+        failed = run(coordinate_command) or run(index_command)
+
+        return name_sort.result() or failed
 
 
 def run_htseq(dest_dir, sjdb_gtf, id_attr, logger):
@@ -324,6 +726,38 @@ def run_htseq(dest_dir, sjdb_gtf, id_attr, logger):
     return failed
 
 
+def run_gene_counter(dest_dir, feature_index, n_proc, logger):
+    """ Count reads in-process with gene_counter, in place of run_htseq.
+
+        dest_dir - Path local to the machine on EC2 under which alignment results
+                   are stored before uploaded to S3. Child path of run_dir/sample_name
+        feature_index - FeatureIndex of the reference genome .gtf file
+        n_proc - Number of worker processes that count chunks of the BAM file
+        logger - Logger object that exposes the interface the code directly uses
+
+        Return FAILED, a boolean value of whether counting fails
+    """
+
+    bam_path = os.path.join(
+        dest_dir, "results", "Pass1", "Aligned.out.sorted-byname.bam"
+    )
+    logger.info(f"Counting reads of {bam_path}")
+
+    # needs the "counter" extra (numpy and pysam), so only imported for it
+    import utilities.alignment.gene_counter as gene_counter
+
+    try:
+        counts = gene_counter.count_reads(bam_path, feature_index, n_proc=n_proc)
+        gene_counter.write_counts(
+            counts, feature_index, os.path.join(dest_dir, "results", "htseq-count.txt")
+        )
+    except Exception as e:
+        logger.error(f"Counting failed: {e}")
+        return True
+
+    return False
+
+
 def upload_results(sample_name, taxon, dest_dir, s3_output_path, logger):
     """ Upload alignment results copied from EC2 machine directory onto S3.
 
@@ -335,7 +769,9 @@ def upload_results(sample_name, taxon, dest_dir, s3_output_path, logger):
         logger - Logger object that exposes the interface the code directly uses
     """
 
-    t_config = TransferConfig(use_threads=False)
+    t_config = s3u.transfer_config(
+        max_concurrency=UPLOAD_CONCURRENCY, multipart_chunksize=UPLOAD_CHUNK_SIZE
+    )
 
     s3_output_bucket, s3_output_prefix = s3u.s3_bucket_and_key(s3_output_path)
 
@@ -355,15 +791,245 @@ def upload_results(sample_name, taxon, dest_dir, s3_output_path, logger):
         "{}.{}.Aligned.out.sorted.bam.bai".format(sample_name, taxon),
     ]
 
-    for src_file, dest_name in zip(src_files, dest_names):
+    # a sample aligned in a batch has the batch's log and junctions instead
+    # (see run_batch); the suffix marks them as not the sample's own
+    for i in (1, 2):
+        if os.path.exists(f"{src_files[i]}.batch"):
+            src_files[i] += ".batch"
+            dest_names[i] += ".batch"
+
+    def upload(src_file, dest_name):
         logger.info("Uploading {}".format(dest_name))
-        s3c.upload_file(
+        s3u.get_client().upload_file(
             Filename=src_file,
             Bucket=s3_output_bucket,
             Key=os.path.join(s3_output_prefix, dest_name),
             Config=t_config,
         )
 
+    # the files go up concurrently, each as a concurrent multipart upload
+    with ThreadPoolExecutor(max_workers=len(src_files)) as executor:
+        list(executor.map(upload, src_files, dest_names))
+
+
+class ResultUploader:
+    """ Upload finished samples with upload_results on a background thread.
+
+        A sample's local directory is removed only after all of its files are
+        uploaded. submit() blocks while max_pending samples are waiting to be
+        uploaded, so alignment can't run arbitrarily far ahead of the uploads.
+        If an upload fails, its files are kept, on_error(error) is called and
+        the error is raised from the next call to submit() or close().
+    """
+
+    def __init__(
+        self, taxon, s3_output_path, logger, *, max_pending=1, on_error=None
+    ):
+        self.taxon = taxon
+        self.s3_output_path = s3_output_path
+        self.logger = logger
+        self.on_error = on_error
+
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._upload, daemon=True)
+        self._thread.start()
+
+    def _upload(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            elif self._error is not None:
+                continue  # keep draining so submit() never blocks forever
+
+            sample_name, dest_dir, on_done = item
+            try:
+                start = time.monotonic()
+                upload_results(
+                    sample_name, self.taxon, dest_dir, self.s3_output_path, self.logger
+                )
+                self.logger.info(
+                    f"{sample_name} uploaded in {time.monotonic() - start:.1f}s"
+                )
+            except Exception as e:
+                self.logger.error(f"Upload of {sample_name} failed, keeping {dest_dir}")
+                self._error = e
+                if self.on_error is not None:
+                    self.on_error(e)
+                continue
+
+            command = ["rm", "-rf", dest_dir]
+            ut_log.log_command(self.logger, command, shell=True)
+            if on_done is not None:
+                on_done()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, sample_name, dest_dir, on_done=None):
+        """Queue a sample for upload; on_done() is called after its cleanup"""
+        self._check()
+        self._queue.put((sample_name, dest_dir, on_done))
+
+    def close(self):
+        """Wait for every queued upload to finish"""
+        self._queue.put(None)
+        self._thread.join()
+        self._check()
+
+
+def make_plan(
+    s3_input_bucket, s3_input_prefix, *, min_size, num_partitions, cache=None
+):
+    """ List the fastq files of a run once and plan its samples.
+
+        s3_input_bucket - Name of the bucket with input fastq files to align
+        s3_input_prefix - The folder with the fastq files
+        min_size - Minimum total size (in bytes) of a sample to be aligned
+        num_partitions - Number of partitions to divide the samples into
+        cache - ListingCache for the listing, if any
+
+        Return the plan, a dict with the samples to align ({sample_name:
+        {"keys": [...], "size": total bytes}}), the samples that were skipped
+        and why, the fastq files that don't match SAMPLE_RE and the partitions
+        (lists of sample names) from partition_util.lpt_partition.
+    """
+
+    sample_lists = defaultdict(list)
+    sample_sizes = defaultdict(int)
+    unmatched = []
+
+    for fn, size in s3u.get_size(s3_input_bucket, s3_input_prefix, cache=cache):
+        if not fn.endswith("fastq.gz"):
+            continue
+
+        matched = SAMPLE_RE.search(os.path.basename(fn))
+        if matched:
+            sample_lists[matched.group(1)].append(fn)
+            sample_sizes[matched.group(1)] += size
+        else:
+            unmatched.append(fn)
+
+    samples = {}
+    skipped = {}
+    for sample_name in sorted(sample_lists):
+        if sample_sizes[sample_name] < min_size:
+            skipped[sample_name] = f"below min_size ({sample_sizes[sample_name]} bytes)"
+        else:
+            samples[sample_name] = {
+                "keys": sorted(sample_lists[sample_name]),
+                "size": sample_sizes[sample_name],
+            }
+
+    partitions = partition_util.lpt_partition(
+        {sample_name: sample["size"] for sample_name, sample in samples.items()},
+        num_partitions,
+    )
+
+    return {
+        "s3_input_path": f"s3://{s3_input_bucket}/{s3_input_prefix}",
+        "min_size": min_size,
+        "num_partitions": num_partitions,
+        "samples": samples,
+        "skipped": skipped,
+        "unmatched": unmatched,
+        "partitions": partitions,
+    }
+
+
+def save_plan(plan, s3_path):
+    """Upload a plan from make_plan to s3_path, as compact JSON"""
+    bucket, key = s3u.s3_bucket_and_key(s3_path)
+    s3u.get_client().put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(plan, separators=(",", ":")).encode(),
+        ContentType="application/json",
+    )
+
+
+def load_plan(s3_path):
+    bucket, key = s3u.s3_bucket_and_key(s3_path)
+    return json.load(s3u.get_client().get_object(Bucket=bucket, Key=key)["Body"])
+
+
+def available_memory():
+    """ Bytes of memory this job can use: the kernel's MemAvailable, capped by
+        the room left under the container's cgroup limit, if any.
+    """
+
+    with open("/proc/meminfo") as fh:
+        meminfo = dict(line.split(":", 1) for line in fh)
+    available = int(meminfo["MemAvailable"].split()[0]) * 1024
+
+    # cgroup v2, then v1
+    for limit_path, usage_path in (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+        (
+            "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+            "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+        ),
+    ):
+        try:
+            with open(limit_path) as fh:
+                limit = fh.read().strip()
+            with open(usage_path) as fh:
+                usage = int(fh.read())
+        except OSError:
+            continue
+
+        if limit != "max":
+            available = min(available, int(limit) - usage)
+        break
+
+    return max(available, 0)
+
+
+class ResourceGate:
+    """ Hand out a job's threads and memory to the samples it runs at once.
+
+        acquire() blocks until the requested threads and bytes are free.
+        Anything bigger than the totals is granted once nothing else is held,
+        so one sample can always run.
+    """
+
+    def __init__(self, threads, memory):
+        self.threads = threads
+        self.memory = memory
+
+        self._cond = threading.Condition()
+        self._threads = 0
+        self._memory = 0
+
+    def _fits(self, threads, memory):
+        return (self._threads == 0 and self._memory == 0) or (
+            self._threads + threads <= self.threads
+            and self._memory + memory <= self.memory
+        )
+
+    def acquire(self, threads, memory):
+        with self._cond:
+            self._cond.wait_for(lambda: self._fits(threads, memory))
+            self._threads += threads
+            self._memory += memory
+
+    def release(self, threads, memory):
+        with self._cond:
+            self._threads -= threads
+            self._memory -= memory
+            self._cond.notify_all()
+
+
+def sample_done(prefetcher, claim_queue, done_index, sample_name, taxon, size):
+    """Free a sample's disk budget, record it in the completion index and, if
+    claimed, mark it done in the queue"""
+    prefetcher.release(size)
+    done_index.add(sample_name, taxon)
+    if claim_queue is not None:
+        claim_queue.complete(sample_name)
+
 
 def main(logger):
     """ Download reference genome, run alignment jobs, and upload results to S3.
@@ -426,8 +1092,6 @@ def main(logger):
                 s3_input_path:\t{args.s3_input_path}"""
     )
 
-    s3 = boto3.resource("s3")
-
     # download the reference genome data
     os.mkdir(os.path.join(root_dir, "genome"))
     logger.info("Downloading and extracting gtf data {}".format(sjdb_gtf))
@@ -438,96 +1102,320 @@ def main(logger):
         Filename=sjdb_gtf,
     )
 
-    os.mkdir(os.path.join(root_dir, "genome", "STAR"))
-    logger.info("Downloading and extracting STAR data {}".format(ref_genome_star_file))
-
-    s3_object = s3.Object(S3_REFERENCE[args.region], ref_genome_star_file)
-
-    with tarfile.open(fileobj=s3_object.get()["Body"], mode="r|gz") as tf:
-        tf.extractall(path=os.path.join(root_dir, "genome", "STAR"))
-
-    # Load Genome Into Memory
-    command = [STAR, "--genomeDir", genome_dir, "--genomeLoad", "LoadAndExit"]
-    if ut_log.log_command(
-        logger, command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True
-    ):
-        raise RuntimeError("Failed to load genome into memory")
-
-    sample_re = re.compile("([^/]+)_R\d(?:_\d+)?.fastq.gz$")
-    s3_output_bucket, s3_output_prefix = s3u.s3_bucket_and_key(args.s3_output_path)
-
-    logger.info(
-        "Running partition {} of {}".format(args.partition_id, args.num_partitions)
-    )
-
-    # Check the input folder for existing runs
-    if not args.force_realign:
-        output = s3u.prefix_gen(
-            s3_output_bucket, s3_output_prefix, lambda r: (r["LastModified"], r["Key"])
+    if args.reference_cache:
+        cache = reference_cache.ReferenceCache(
+            args.reference_cache,
+            quota=args.reference_cache_gb * 2 ** 30,
+            logger=logger,
+        )
+        genome_dir = os.path.join(
+            cache.get(S3_REFERENCE[args.region], ref_genome_star_file), genome_name
         )
     else:
-        output = []
+        os.mkdir(os.path.join(root_dir, "genome", "STAR"))
+        logger.info(
+            "Downloading and extracting STAR data {}".format(ref_genome_star_file)
+        )
 
-    output_files = {
-        tuple(os.path.basename(fn).rsplit(".", 2)[0].split(".", 1)[:2])
-        for dt, fn in output
-        if fn.endswith(".htseq-count.txt") and dt > CURR_MIN_VER
-    }
+        reference_cache.fetch_reference(
+            S3_REFERENCE[args.region],
+            ref_genome_star_file,
+            os.path.join(root_dir, "genome", "STAR"),
+        )
 
-    logger.info("Skipping {} existing results".format(len(output_files)))
+    # Load Genome Into Memory, unless another job on the host already has. It's
+    # removed when the last job using it releases it
+    if args.genome_memory_gb is None:
+        genome_budget = None
+    else:
+        genome_budget = int(args.genome_memory_gb * 2 ** 30)
+    genomes = genome_residency.GenomeResidency(
+        logger, args.genome_registry, budget=genome_budget, star=STAR
+    )
+    genomes.acquire(genome_dir)
+    try:
+        if args.counter == "native":
+            import utilities.alignment.gene_counter as gene_counter
+
+            # loaded once, then shared by every sample of the job. The index is
+            # built from the gtf by the first job that needs it and kept in S3
+            # next to the gtf for the others
+            feature_index = gene_counter.cached_index(
+                sjdb_gtf,
+                id_attr,
+                bucket=S3_REFERENCE["west"],
+                key=f"velocyto/{genome_name}.gtf",
+                logger=logger,
+            )
+        else:
+            feature_index = None
 
-    sample_files = [
-        (fn, s)
-        for fn, s in s3u.get_size(s3_input_bucket, s3_input_prefix)
-        if fn.endswith("fastq.gz")
-    ]
+        s3_output_bucket, s3_output_prefix = s3u.s3_bucket_and_key(args.s3_output_path)
 
-    sample_lists = defaultdict(list)
-    sample_sizes = defaultdict(list)
+        logger.info(
+            "Running partition {} of {}".format(args.partition_id, args.num_partitions)
+        )
 
-    for fn, s in sample_files:
-        matched = sample_re.search(os.path.basename(fn))
-        if matched:
-            sample_lists[matched.group(1)].append(fn)
-            sample_sizes[matched.group(1)].append(s)
+        if args.listing_cache:
+            # only used for the input fastq files, which are never rewritten
+            listing_cache = s3u.ListingCache(args.listing_cache, incremental=True)
+        else:
+            listing_cache = None
+
+        def list_outputs():
+            """(sample, taxon) of the results in the output folder, to seed its
+            completion index the first time. Listed without the cache, which may
+            be stale"""
+            logger.info("No completion index yet, listing the output folder")
+            output = s3u.prefix_gen(
+                s3_output_bucket,
+                s3_output_prefix,
+                lambda r: (r["LastModified"], r["Key"]),
+            )
 
-    logger.info(f"number of samples: {len(sample_lists)}")
+            return {
+                tuple(os.path.basename(fn).rsplit(".", 2)[0].split(".", 1)[:2])
+                for dt, fn in output
+                if fn.endswith(".htseq-count.txt") and dt > CURR_MIN_VER
+            }
 
-    for sample_name in sorted(sample_lists)[args.partition_id :: args.num_partitions]:
-        if (sample_name, args.taxon) in output_files:
-            logger.debug(f"{sample_name} already exists, skipping")
-            continue
+        # Check the output folder for existing runs. Jobs record the samples they
+        # finish in the folder's completion index, so there's no need to list it
+        done_index = completion_index.CompletionIndex(
+            s3_output_bucket, s3_output_prefix
+        )
+        if args.force_realign:
+            done_index.load()  # only to keep this job's earlier entries
+            output_files = set()
+        else:
+            output_files = done_index.load(seed=list_outputs)
+
+        logger.info("Skipping {} existing results".format(len(output_files)))
+
+        if args.plan:
+            # listed and grouped once for the whole run by aws_star
+            logger.info(f"Using the sample plan {args.plan}")
+            plan = load_plan(args.plan)
+            if plan["num_partitions"] != args.num_partitions:
+                raise ValueError(
+                    f"the plan has {plan['num_partitions']} partitions,"
+                    f" not {args.num_partitions}"
+                )
+            s3_input_path = f"s3://{s3_input_bucket}/{s3_input_prefix}"
+            if plan["s3_input_path"].rstrip("/") != s3_input_path.rstrip("/"):
+                raise ValueError(
+                    f"the plan is for {plan['s3_input_path']}, not {s3_input_path}"
+                )
+            if plan["min_size"] != args.min_size:
+                raise ValueError(
+                    f"the plan has a min_size of {plan['min_size']},"
+                    f" not {args.min_size}"
+                )
+        else:
+            plan = make_plan(
+                s3_input_bucket,
+                s3_input_prefix,
+                min_size=args.min_size,
+                num_partitions=args.num_partitions,
+                cache=listing_cache,
+            )
 
-        if sum(sample_sizes[sample_name]) < args.min_size:
-            logger.info(f"{sample_name} is below min_size, skipping")
-            continue
+        sample_lists = {
+            name: sample["keys"] for name, sample in plan["samples"].items()
+        }
+        sample_totals = {
+            name: sample["size"] for name, sample in plan["samples"].items()
+        }
+
+        logger.info(f"number of samples: {len(sample_totals) + len(plan['skipped'])}")
+        logger.info(f"{len(plan['skipped'])} samples are below min_size, skipping")
+
+        if args.claim_queue:
+            # every job works through all the samples, largest first, and takes
+            # the ones no live job has claimed
+            claim_queue = work_queue.open_queue(args.claim_queue)
+            logger.info(f"Claiming samples from {args.claim_queue}")
+            sample_names = claim_queue.claim_items(
+                sample_name
+                for sample_name in sorted(
+                    sample_totals, key=sample_totals.get, reverse=True
+                )
+                if (sample_name, args.taxon) not in output_files
+            )
+        else:
+            claim_queue = None
+
+            # the partitions are balanced by the total fastq size of their samples
+            partitions = plan["partitions"]
+            logger.info(
+                "Partition plan:\n"
+                + partition_util.partition_report(sample_totals, partitions)
+            )
 
-        failed, dest_dir = run_sample(
+            sample_names = []
+            for sample_name in partitions[args.partition_id]:
+                if (sample_name, args.taxon) in output_files:
+                    logger.debug(f"{sample_name} already exists, skipping")
+                else:
+                    sample_names.append(sample_name)
+
+        # a generator, so that with a claim queue samples are claimed only when
+        # the prefetcher is ready to download them
+        samples = (
+            (sample_name, sorted(sample_lists[sample_name]), sample_totals[sample_name])
+            for sample_name in sample_names
+        )
+
+        # download upcoming batches while the current one is aligned
+        prefetcher = SamplePrefetcher(
             s3_input_bucket,
-            sample_name,
-            sorted(sample_lists[sample_name]),
-            genome_dir,
+            batch_samples(samples, args.batch_bytes),
             run_dir,
-            args.star_proc,
+            depth=args.prefetch,
+            disk_budget=args.prefetch_disk_gb * 1e9,
+        )
+
+        # results are uploaded in the background while the next sample aligns. A
+        # failed upload never releases its disk budget, so it stops the prefetcher
+        uploader = ResultUploader(
+            args.taxon,
+            args.s3_output_path,
             logger,
+            max_pending=args.upload_queue,
+            on_error=prefetcher.abort,
         )
 
-        failed = failed or run_htseq(dest_dir, sjdb_gtf, id_attr, logger)
+        # samples run concurrently, each with an equal share of the threads and
+        # sort memory. The gate holds back the next sample while the running ones
+        # would leave it short of threads or memory
+        n_concurrent = max(args.concurrent_samples, 1)
+        sample_threads = max(args.star_proc // n_concurrent, 1)
+        sort_memory = SORT_MEMORY // n_concurrent
+        sample_memory = SAMPLE_MEMORY + sort_memory
+        gate = ResourceGate(args.star_proc, available_memory())
+        logger.info(
+            f"Running up to {n_concurrent} samples at once, with {sample_threads}"
+            f" threads and {sample_memory / 2 ** 30:.1f} GB each, in"
+            f" {gate.memory / 2 ** 30:.1f} GB"
+        )
 
-        if not failed:
-            upload_results(
-                sample_name, args.taxon, dest_dir, args.s3_output_path, logger
+        def process_batch(batch, timings):
+            try:
+                stage_start = time.monotonic()
+                if len(batch) == 1:
+                    sample_name, sample_fns, _ = batch[0]
+                    results = [
+                        run_sample(
+                            sample_name,
+                            sample_fns,
+                            genome_dir,
+                            run_dir,
+                            sample_threads,
+                            logger,
+                            sort_memory=sort_memory,
+                        )
+                    ]
+                else:
+                    results = run_batch(
+                        batch,
+                        genome_dir,
+                        run_dir,
+                        sample_threads,
+                        logger,
+                        sort_memory=sort_memory,
+                    )
+                timings["align"] = time.monotonic() - stage_start
+
+                stage_start = time.monotonic()
+                for i, (failed, dest_dir) in enumerate(results):
+                    if feature_index is None:
+                        failed = failed or run_htseq(
+                            dest_dir, sjdb_gtf, id_attr, logger
+                        )
+                    else:
+                        failed = failed or run_gene_counter(
+                            dest_dir, feature_index, sample_threads, logger
+                        )
+                    results[i] = (failed, dest_dir)
+                timings["count"] = time.monotonic() - stage_start
+            except BaseException as e:
+                # the batch's disk budget is never released, so stop the prefetcher
+                # rather than let it wait for room
+                prefetcher.abort(e)
+                raise
+            finally:
+                gate.release(sample_threads, sample_memory)
+
+            stage_start = time.monotonic()
+            for (sample_name, _, size), (failed, dest_dir) in zip(batch, results):
+                if failed:
+                    command = ["rm", "-rf", dest_dir]
+                    ut_log.log_command(logger, command, shell=True)
+                    prefetcher.release(size)
+                    # not retried by other jobs, as with a static partition
+                    if claim_queue is not None:
+                        claim_queue.complete(sample_name)
+                else:
+                    uploader.submit(
+                        sample_name,
+                        dest_dir,
+                        functools.partial(
+                            sample_done,
+                            prefetcher,
+                            claim_queue,
+                            done_index,
+                            sample_name,
+                            args.taxon,
+                            size,
+                        ),
+                    )
+            timings["wait for upload queue"] = time.monotonic() - stage_start
+
+            logger.info(
+                f"{', '.join(sample_name for sample_name, _, _ in batch)}"
+                " stage timings: "
+                + ", ".join(f"{stage} {t:.1f}s" for stage, t in timings.items())
             )
 
-        command = ["rm", "-rf", dest_dir]
-        ut_log.log_command(logger, command, shell=True)
-
-        time.sleep(30)
+        try:
+            with ThreadPoolExecutor(max_workers=n_concurrent) as executor:
+                running = []
+                wait_start = time.monotonic()
+                for batch, _, download_time in prefetcher:
+                    timings = {
+                        "download": download_time,
+                        "wait for download": time.monotonic() - wait_start,
+                    }
+
+                    stage_start = time.monotonic()
+                    gate.acquire(sample_threads, sample_memory)
+                    timings["wait for resources"] = time.monotonic() - stage_start
+
+                    # raise the error of any sample that failed unexpectedly
+                    for future in [f for f in running if f.done()]:
+                        future.result()
+                        running.remove(future)
+
+                    running.append(executor.submit(process_batch, batch, timings))
+
+                    wait_start = time.monotonic()
+
+                for future in running:
+                    future.result()
+
+            uploader.close()
+            if claim_queue is not None:
+                claim_queue.close()
+        except BaseException as e:
+            prefetcher.abort(e)  # stop any downloads in progress
+            raise
+    finally:
+        genomes.release(genome_dir)
 
     logger.info("Job completed")
 
 
 if __name__ == "__main__":
     mainlogger, log_file, file_handler = ut_log.get_logger(__name__)
-    s3c = boto3.client("s3")
+    s3c = s3u.get_client()
     main(mainlogger)
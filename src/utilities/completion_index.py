@@ -0,0 +1,75 @@
+import posixpath
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import utilities.s3_util as s3u
+from utilities.work_queue import default_worker_id
+
+
+# the index of an output path is kept in this folder under it
+INDEX_FOLDER = "_completed"
+
+
+class CompletionIndex:
+    """Record of the finished items, e.g. (sample, taxon), under an S3 path.
+
+    Each job writes its own object, {prefix}/_completed/{job id}.tsv, with one
+    line per item it finished. add() puts the whole object again, so every
+    write is atomic and no two jobs write the same key. load() reads the
+    objects of every job, a few requests instead of listing all outputs.
+
+    An output path without an index (written before it existed) is indexed
+    from a listing once: load() calls seed(), and saves what it returns as
+    the job's first entries. Outputs deleted later stay in the index.
+    """
+
+    def __init__(self, bucket, prefix, *, job_id=None):
+        self.bucket = bucket
+        self.index_prefix = posixpath.join(prefix, INDEX_FOLDER, "")
+        self.key = posixpath.join(
+            self.index_prefix, f"{job_id or default_worker_id()}.tsv"
+        )
+
+        self._lock = threading.Lock()
+        self._entries = []  # the items this job recorded, in order
+
+    def _read(self, key):
+        body = s3u.get_client().get_object(Bucket=self.bucket, Key=key)["Body"]
+        return [tuple(line.split("\t")) for line in body.read().decode().splitlines()]
+
+    def _write(self):
+        s3u.get_client().put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body="".join("\t".join(entry) + "\n" for entry in self._entries).encode(),
+        )
+
+    def load(self, seed=None):
+        """Return the set of items every job has recorded.
+
+        If there is no index yet and seed is given, seed() is called for the
+        items that already exist, e.g. from a listing, and they're recorded.
+        """
+
+        keys = [r["Key"] for r in s3u.list_prefix(self.bucket, self.index_prefix)]
+
+        with ThreadPoolExecutor(max_workers=s3u.N_THREADS) as executor:
+            entries = dict(zip(keys, executor.map(self._read, keys)))
+
+        with self._lock:
+            # a retried job picks up where its previous attempt stopped
+            self._entries = entries.get(self.key, [])
+
+            if not entries and seed is not None:
+                self._entries = [tuple(entry) for entry in seed()]
+                self._write()
+                entries[self.key] = self._entries
+
+        return {entry for job_entries in entries.values() for entry in job_entries}
+
+    def add(self, *item):
+        """Record that item is finished"""
+        with self._lock:
+            self._entries.append(tuple(item))
+            self._write()
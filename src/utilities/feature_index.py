@@ -0,0 +1,273 @@
+import bisect
+import collections
+import json
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+
+import numpy as np
+
+import utilities.s3_util as s3u
+
+
+# local copies of built indexes, one folder per GTF checksum and id attribute
+INDEX_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "czb-util", "feature_index"
+)
+
+ARRAYS = ("step_starts", "step_sets", "set_offsets", "set_members")
+META_FILE = "meta.json"
+
+_attr_split_re = re.compile(r';(?=(?:[^"]*"[^"]*")*[^"]*$)')
+_attr_re = re.compile(r"\s*([^\s=]+)[\s=]+(.*)")
+
+
+def parse_gtf_attributes(attr_str):
+    """Parse the attribute column of a GTF line the way HTSeq does"""
+    attrs = {}
+    for attr in _attr_split_re.split(attr_str.rstrip("\n")):
+        if not attr.strip():
+            continue
+        if attr.count('"') not in (0, 2):
+            raise ValueError(f"mismatched quotes in GTF attributes: {attr_str}")
+
+        matched = _attr_re.match(attr)
+        if not matched:
+            raise ValueError(f"can't parse GTF attributes: {attr_str}")
+
+        key, value = matched.groups()
+        if value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        attrs[key] = value
+
+    return attrs
+
+
+def read_gtf_features(gtf_path, id_attr, feature_type="exon"):
+    """Generator of (chrom, start, end, feature_id) for the features of
+    feature_type in a GTF file, with 0-based, half-open coordinates"""
+
+    with open(gtf_path) as fh:
+        for line in fh:
+            if line == "\n" or line.startswith("#"):
+                continue
+
+            fields = line.split("\t", 8)
+            if len(fields) < 9:
+                raise ValueError(f"GTF line doesn't have 9 fields: {line!r}")
+            if fields[2] != feature_type:
+                continue
+
+            attrs = parse_gtf_attributes(fields[8])
+            if id_attr not in attrs:
+                raise ValueError(
+                    f"Feature at {fields[0]}:{fields[3]} does not contain"
+                    f" a '{id_attr}' attribute"
+                )
+
+            yield fields[0], int(fields[3]) - 1, int(fields[4]), attrs[id_attr]
+
+
+class FeatureIndex:
+    """The features of a GTF as steps along each chromosome, in NumPy arrays.
+
+    The steps of every chromosome are concatenated; chroms maps a chromosome
+    to its [lo, hi) slice. Step i covers [step_starts[i], step_starts[i + 1])
+    of its chromosome and holds feature set step_sets[i], like HTSeq's
+    GenomicArrayOfSets. Set j is the feature indices
+    set_members[set_offsets[j]:set_offsets[j + 1]], and feature_ids[k] is the
+    id of feature k. The arrays can be saved and loaded memory-mapped;
+    index_dir is the folder a loaded index came from.
+    """
+
+    def __init__(
+        self, feature_ids, chroms, step_starts, step_sets, set_offsets, set_members
+    ):
+        self.feature_ids = feature_ids  # sorted list of every feature id
+        self.chroms = chroms  # chrom -> (lo, hi) slice of the step arrays
+        self.step_starts = step_starts
+        self.step_sets = step_sets
+        self.set_offsets = set_offsets
+        self.set_members = set_members
+
+        self.index_dir = None
+        self._sets = {}
+
+    @classmethod
+    def from_features(cls, features):
+        """Build the index from (chrom, start, end, feature_id) tuples"""
+        events = collections.defaultdict(lambda: collections.defaultdict(list))
+        feature_ids = set()
+        for chrom, start, end, feature_id in features:
+            feature_ids.add(feature_id)
+            if start < end:
+                events[chrom][start].append((feature_id, 1))
+                events[chrom][end].append((feature_id, -1))
+
+        feature_ids = sorted(feature_ids)
+        feature_index = {feature_id: i for i, feature_id in enumerate(feature_ids)}
+
+        chroms = {}
+        step_starts = []
+        step_sets = []
+        set_numbers = {(): 0}
+        for chrom in sorted(events):
+            chrom_events = events[chrom]
+            chroms[chrom] = (len(step_starts), len(step_starts) + len(chrom_events))
+
+            active = collections.Counter()
+            for pos in sorted(chrom_events):
+                for feature_id, change in chrom_events[pos]:
+                    active[feature_index[feature_id]] += change
+                    if not active[feature_index[feature_id]]:
+                        del active[feature_index[feature_id]]
+
+                step_starts.append(pos)
+                step_sets.append(
+                    set_numbers.setdefault(tuple(sorted(active)), len(set_numbers))
+                )
+
+        set_offsets = np.zeros(len(set_numbers) + 1, dtype=np.int64)
+        set_members = []
+        for members, j in sorted(set_numbers.items(), key=lambda item: item[1]):
+            set_members.extend(members)
+            set_offsets[j + 1] = len(set_members)
+
+        return cls(
+            feature_ids,
+            chroms,
+            np.array(step_starts, dtype=np.int64),
+            np.array(step_sets, dtype=np.int32),
+            set_offsets,
+            np.array(set_members, dtype=np.int32),
+        )
+
+    @classmethod
+    def from_gtf(cls, gtf_path, id_attr, feature_type="exon"):
+        return cls.from_features(read_gtf_features(gtf_path, id_attr, feature_type))
+
+    def save(self, index_dir):
+        """Write the arrays as .npy files, and the ids and chroms as json"""
+        os.makedirs(index_dir, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(index_dir, f"{name}.npy"), getattr(self, name))
+
+        with open(os.path.join(index_dir, META_FILE), "w") as out:
+            json.dump({"feature_ids": self.feature_ids, "chroms": self.chroms}, out)
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode="r"):
+        """Load a saved index, memory-mapping its arrays by default"""
+        with open(os.path.join(index_dir, META_FILE)) as fh:
+            meta = json.load(fh)
+
+        index = cls(
+            meta["feature_ids"],
+            {chrom: tuple(lohi) for chrom, lohi in meta["chroms"].items()},
+            *(
+                np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+                for name in ARRAYS
+            ),
+        )
+        index.index_dir = index_dir
+
+        return index
+
+    def feature_set(self, j):
+        """Return set j as a frozenset of feature indices"""
+        if j not in self._sets:
+            members = self.set_members[self.set_offsets[j] : self.set_offsets[j + 1]]
+            self._sets[j] = frozenset(members.tolist())
+
+        return self._sets[j]
+
+    def overlapping(self, chrom, start, end):
+        """Generator of the non-empty feature sets of the steps in [start, end)"""
+        lo, hi = self.chroms[chrom]
+
+        i = max(bisect.bisect_right(self.step_starts, start, lo, hi) - 1, lo)
+        while i < hi and self.step_starts[i] < end:
+            if self.step_sets[i]:
+                yield self.feature_set(int(self.step_sets[i]))
+            i += 1
+
+
+def _index_exists(bucket, s3_prefix):
+    client = s3u.get_client()
+    try:
+        client.head_object(Bucket=bucket, Key=posixpath.join(s3_prefix, META_FILE))
+    except client.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+    return True
+
+
+def _upload_index(index_dir, bucket, s3_prefix):
+    def upload(fn, callback):
+        s3u.get_client().upload_file(
+            Filename=os.path.join(index_dir, fn),
+            Bucket=bucket,
+            Key=posixpath.join(s3_prefix, fn),
+        )
+
+    # the metadata goes last: an index in S3 is complete once it's there
+    s3u.run_transfers(upload, [f"{name}.npy" for name in ARRAYS])
+    upload(META_FILE, None)
+
+
+def cached_index(gtf_path, id_attr, *, bucket=None, key=None, logger=None):
+    """Return the FeatureIndex of a local GTF file, building it only once.
+
+    Indexes are keyed by the MD5 of the GTF and the id attribute. They are
+    looked up in INDEX_CACHE_DIR first, then, if the GTF's bucket and key are
+    given, in S3 next to it under {key}.index/. A newly built index is saved
+    to both.
+    """
+
+    index_name = f"{s3u.file_md5(gtf_path)}.{id_attr}"
+    index_dir = os.path.join(INDEX_CACHE_DIR, index_name)
+    if os.path.exists(os.path.join(index_dir, META_FILE)):
+        return FeatureIndex.load(index_dir)
+
+    if bucket is not None:
+        s3_prefix = posixpath.join(f"{key}.index", index_name)
+    else:
+        s3_prefix = None
+
+    # build or download into a temporary folder, then move it in one step so
+    # concurrent jobs never load a partial index
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=INDEX_CACHE_DIR)
+    try:
+        if s3_prefix is not None and _index_exists(bucket, s3_prefix):
+            files = [f"{name}.npy" for name in ARRAYS] + [META_FILE]
+            s3u.download_files(
+                [posixpath.join(s3_prefix, fn) for fn in files],
+                [os.path.join(tmp_dir, fn) for fn in files],
+                bucket=bucket,
+                n_proc=len(files),
+            )
+        else:
+            if logger:
+                logger.info(f"Building the feature index of {gtf_path}")
+            FeatureIndex.from_gtf(gtf_path, id_attr).save(tmp_dir)
+
+            if s3_prefix is not None:
+                try:
+                    _upload_index(tmp_dir, bucket, s3_prefix)
+                except Exception as e:
+                    if logger:
+                        logger.warning(f"Couldn't upload the feature index: {e}")
+
+        try:
+            os.rename(tmp_dir, index_dir)
+        except OSError:
+            pass  # another job got there first
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return FeatureIndex.load(index_dir)
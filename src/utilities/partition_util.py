@@ -0,0 +1,40 @@
+import heapq
+
+
+def lpt_partition(sizes, num_partitions):
+    """Divide items into num_partitions groups of similar total size.
+
+    sizes - dict of item name -> size (e.g. total bytes of a sample's files)
+    num_partitions - number of groups to make
+
+    Uses the greedy LPT rule: items are placed largest first on the group with
+    the smallest load so far. Ties are broken by item name and by group index,
+    so every job that computes the plan from the same sizes gets the same
+    result. Return a list of num_partitions sorted lists of item names.
+    """
+
+    partitions = [[] for _ in range(num_partitions)]
+    loads = [(0, i) for i in range(num_partitions)]
+
+    for name in sorted(sizes, key=lambda name: (-sizes[name], name)):
+        load, i = heapq.heappop(loads)
+        partitions[i].append(name)
+        heapq.heappush(loads, (load + sizes[name], i))
+
+    return [sorted(partition) for partition in partitions]
+
+
+def partition_report(sizes, partitions):
+    """Return a table of the number of items and total size of each partition"""
+
+    loads = [sum(sizes[name] for name in partition) for partition in partitions]
+    mean_load = sum(loads) / max(len(loads), 1)
+
+    lines = ["partition\titems\tsize (MB)\tvs. mean"]
+    for i, (partition, load) in enumerate(zip(partitions, loads)):
+        lines.append(
+            f"{i}\t{len(partition)}\t{load / 1e6:.1f}"
+            f"\t{load / mean_load if mean_load else 0:.2f}"
+        )
+
+    return "\n".join(lines)
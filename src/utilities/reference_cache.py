@@ -0,0 +1,358 @@
+import contextlib
+import fcntl
+import hashlib
+import io
+import json
+import os
+import posixpath
+import shutil
+import subprocess
+import tarfile
+import time
+
+import utilities.s3_util as s3u
+
+
+# shared by every job on the instance: /mnt is the host's scratch volume, and
+# each job works in its own /mnt/$AWS_BATCH_JOB_ID
+REFERENCE_CACHE_DIR = "/mnt/reference_cache"
+REFERENCE_CACHE_GB = 500
+
+# expected size of an extracted reference relative to its .tgz, used to make
+# room before extracting
+EXTRACTED_RATIO = 3
+
+
+# decompressors to pipe archives through, best first; pigz decompresses with
+# separate threads for reading, inflating and writing
+DECOMPRESSORS = {
+    "gzip": (["pigz", "-dc"], ["gzip", "-dc"]),
+    "zstd": (["zstd", "-dc"],),
+}
+
+
+class Reference:
+    """The stored form of a reference tarball, found from its .tgz key.
+
+    Next to {stem}.tgz a reference can also be stored as {stem}.tar.zst, or
+    unpacked under {stem}/ (the tarball's contents, relative to the folder the
+    tarball is in). find() picks the fastest one available: unpacked, then
+    zstd, then gzip.
+    """
+
+    def __init__(self, bucket, key, layout, records):
+        self.bucket = bucket
+        self.key = key  # the archive, or the folder of an unpacked reference
+        self.layout = layout  # "unpacked", "zstd" or "gzip"
+        self.records = records  # listing records of the stored objects
+
+    @classmethod
+    def find(cls, bucket, key):
+        stem = key
+        for suffix in (".tgz", ".tar.gz"):
+            if key.endswith(suffix):
+                stem = key[: -len(suffix)]
+
+        records, sub_prefixes = s3u.list_level(bucket, stem)
+        if f"{stem}/" in sub_prefixes:
+            return cls(
+                bucket, f"{stem}/", "unpacked", s3u.list_prefix(bucket, f"{stem}/")
+            )
+
+        records = {r["Key"]: r for r in records}
+        for layout, archive_key in (("zstd", f"{stem}.tar.zst"), ("gzip", key)):
+            if archive_key in records:
+                return cls(bucket, archive_key, layout, [records[archive_key]])
+
+        raise FileNotFoundError(f"no reference at s3://{bucket}/{key}")
+
+    @property
+    def version(self):
+        """Changes whenever any stored object changes"""
+        md5 = hashlib.md5(f"{self.bucket}/{self.key}".encode())
+        for r in self.records:
+            md5.update(f"{r['Key']} {r['ETag']}\n".encode())
+        return md5.hexdigest()
+
+    @property
+    def size(self):
+        return sum(r["Size"] for r in self.records)
+
+    def fetch(self, dest_dir):
+        """Extract (or download) the reference into dest_dir"""
+        if self.layout == "unpacked":
+            self._download(dest_dir)
+            return
+
+        with s3u.RangedReader(self.bucket, self.key) as reader:
+            for command in DECOMPRESSORS[self.layout]:
+                if shutil.which(command[0]):
+                    _pipe_to_tar(reader.parts(), command, dest_dir)
+                    return
+
+            if self.layout != "gzip":
+                raise RuntimeError(f"{DECOMPRESSORS[self.layout][0][0]} not found")
+
+            with tarfile.open(fileobj=io.BufferedReader(reader), mode="r|gz") as tf:
+                tf.extractall(path=dest_dir)
+
+    def _download(self, dest_dir):
+        base = posixpath.dirname(self.key.rstrip("/"))
+        keys = [r["Key"] for r in self.records if not r["Key"].endswith("/")]
+        dests = [os.path.join(dest_dir, posixpath.relpath(k, base)) for k in keys]
+        for dest in dests:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+        s3u.download_files(keys, dests, bucket=self.bucket, force_download=True)
+
+
+def _pipe_to_tar(parts, command, dest_dir):
+    """Decompress parts with command and extract them with tar, all at once"""
+    decompress = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    tar = subprocess.Popen(
+        ["tar", "-x", "-f", "-", "-C", dest_dir], stdin=decompress.stdout
+    )
+    decompress.stdout.close()  # so tar sees EOF once the decompressor exits
+
+    try:
+        for part in parts:
+            decompress.stdin.write(part)
+    except BrokenPipeError:
+        pass  # the exit codes below say why
+    finally:
+        decompress.stdin.close()
+
+    if decompress.wait() or tar.wait():
+        raise RuntimeError(f"{command[0]} | tar failed for {dest_dir}")
+
+
+def fetch_reference(bucket, key, dest_dir):
+    """Extract the reference tarball s3://bucket/key into dest_dir, using the
+    fastest stored form of it (see Reference)"""
+    Reference.find(bucket, key).fetch(dest_dir)
+
+
+def _flock(fd, operation):
+    try:
+        fcntl.flock(fd, operation)
+    except BlockingIOError:
+        return False
+
+    return True
+
+
+class ReferenceCache:
+    """One extracted copy of each reference tarball, shared by the jobs on a host.
+
+    Entries are keyed by the ETags of the stored reference, so a re-uploaded
+    reference gets a new entry. Every entry has a lock file:
+    - the job that extracts an entry holds it exclusively, and jobs asking for
+      the same entry wait for it to finish
+    - jobs using an entry hold it shared until they exit (or close()), so it
+      is never evicted from under them
+    A manifest of the size of every file is written once extraction is
+    complete and checked before each use. When the cache is over quota bytes,
+    the least recently used entries that no job holds are removed.
+    """
+
+    def __init__(self, root=REFERENCE_CACHE_DIR, *, quota=None, logger=None):
+        self.root = root
+        self.quota = REFERENCE_CACHE_GB * 2 ** 30 if quota is None else quota
+        self.logger = logger
+
+        self.entries_dir = os.path.join(root, "entries")
+        self.locks_dir = os.path.join(root, "locks")
+        os.makedirs(self.entries_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+
+        self._held = {}  # entry name -> fd of its shared lock
+
+    def _log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+
+    def _lock_fd(self, name):
+        return os.open(
+            os.path.join(self.locks_dir, f"{name}.lock"), os.O_RDWR | os.O_CREAT
+        )
+
+    @contextlib.contextmanager
+    def _cache_lock(self):
+        """Held while the set of entries changes (eviction, adding an entry)"""
+        fd = self._lock_fd("_cache")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _manifest_path(self, name):
+        return os.path.join(self.entries_dir, f"{name}.json")
+
+    def _read_manifest(self, name):
+        try:
+            with open(self._manifest_path(name)) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+    def _is_valid(self, name):
+        manifest = self._read_manifest(name)
+        if manifest is None:
+            return False
+
+        entry_dir = os.path.join(self.entries_dir, name)
+        for path, size in manifest["files"].items():
+            try:
+                if os.path.getsize(os.path.join(entry_dir, path)) != size:
+                    return False
+            except OSError:
+                return False
+
+        return True
+
+    def _usage(self):
+        """Return [(last used, size, name)] of the complete entries"""
+        usage = []
+        for fn in os.listdir(self.entries_dir):
+            if fn.endswith(".json"):
+                name = fn[: -len(".json")]
+                manifest = self._read_manifest(name)
+                if manifest is not None:
+                    mtime = os.path.getmtime(self._manifest_path(name))
+                    usage.append((mtime, manifest["size"], name))
+
+        return sorted(usage)
+
+    def _remove(self, name):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._manifest_path(name))
+        shutil.rmtree(os.path.join(self.entries_dir, name), ignore_errors=True)
+        shutil.rmtree(
+            os.path.join(self.entries_dir, f"{name}.partial"), ignore_errors=True
+        )
+
+    def evict(self, needed=0, keep=()):
+        """Remove least recently used entries, until needed more bytes fit in the
+        quota or every remaining entry is in use. Call with the cache lock held."""
+
+        usage = self._usage()
+        total = sum(size for _, size, _ in usage)
+
+        for _, size, name in usage:
+            if total + needed <= self.quota:
+                break
+            if name in keep or name in self._held:
+                continue
+
+            fd = self._lock_fd(name)
+            try:
+                if not _flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                    continue  # another job is using it
+
+                self._log(f"Evicting reference {name} ({size / 2 ** 30:.1f} GB)")
+                self._remove(name)
+                total -= size
+            finally:
+                os.close(fd)
+
+        if total + needed > self.quota:
+            self._log(
+                f"Reference cache needs {(total + needed) / 2 ** 30:.1f} GB,"
+                f" over its quota of {self.quota / 2 ** 30:.1f} GB"
+            )
+
+    def get(self, bucket, key):
+        """Return the folder the tarball s3://bucket/key is extracted in.
+
+        The first job to ask for it fetches it (see Reference); the others
+        wait for it. The entry stays locked for this process until close() is
+        called or the process exits.
+        """
+
+        reference = Reference.find(bucket, key)
+        base = posixpath.basename(reference.key.rstrip("/")).split(".")[0]
+        name = f"{base}-{reference.version[:10]}"
+        entry_dir = os.path.join(self.entries_dir, name)
+
+        if name in self._held:
+            return entry_dir
+
+        fd = self._lock_fd(name)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            if not self._is_valid(name):
+                # upgrade to extract it, unless another job did while we waited
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if not self._is_valid(name):
+                    self._populate(reference, name)
+
+                # eviction only happens under the cache lock, so the entry
+                # can't be taken while the lock is downgraded
+                with self._cache_lock():
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+            else:
+                self._log(f"Using cached reference {entry_dir}")
+        except BaseException:
+            os.close(fd)
+            raise
+
+        os.utime(self._manifest_path(name))  # the LRU time
+        self._held[name] = fd
+        return entry_dir
+
+    def _populate(self, reference, name):
+        entry_dir = os.path.join(self.entries_dir, name)
+        partial_dir = f"{entry_dir}.partial"
+
+        if reference.layout == "unpacked":
+            needed = reference.size
+        else:
+            needed = reference.size * EXTRACTED_RATIO
+
+        with self._cache_lock():
+            self._remove(name)
+            self.evict(needed, keep=(name,))
+
+        self._log(
+            f"Fetching s3://{reference.bucket}/{reference.key} ({reference.layout})"
+            " into the reference cache"
+        )
+        start = time.monotonic()
+        os.makedirs(partial_dir)
+        reference.fetch(partial_dir)
+
+        files = {}
+        for dirpath, _, filenames in os.walk(partial_dir):
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                files[os.path.relpath(path, partial_dir)] = os.path.getsize(path)
+
+        manifest = {
+            "bucket": reference.bucket,
+            "key": reference.key,
+            "size": sum(files.values()),
+            "files": files,
+        }
+
+        with self._cache_lock():
+            os.rename(partial_dir, entry_dir)
+            with open(f"{self._manifest_path(name)}.tmp", "w") as out:
+                json.dump(manifest, out)
+            os.replace(f"{self._manifest_path(name)}.tmp", self._manifest_path(name))
+
+            self.evict(keep=(name,))
+
+        self._log(
+            f"Extracted {manifest['size'] / 2 ** 30:.1f} GB"
+            f" in {time.monotonic() - start:.0f}s"
+        )
+
+    def close(self):
+        """Release the entries this process has been using"""
+        for fd in self._held.values():
+            os.close(fd)
+        self._held = {}
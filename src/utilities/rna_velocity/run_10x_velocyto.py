@@ -4,14 +4,14 @@ import os
 import pathlib
 import sys
 import subprocess
-import tarfile
 import posixpath
 import datetime
 import time
 
 from utilities.log_util import get_logger, log_command
-
-import boto3
+from utilities.alignment.run_10x_count import fastq_includes, sample_fastqs
+import utilities.reference_cache as reference_cache
+import utilities.s3_util as s3u
 
 
 CURR_MIN_VER = datetime.datetime(2018, 10, 1, tzinfo=datetime.timezone.utc)
@@ -123,6 +123,21 @@ def get_parser():
         help="Use if 10x run was not demuxed locally (pre November 2019)",
     )
     parser.add_argument("--glacier", action="store_true")
+    parser.add_argument(
+        "--reference_cache",
+        nargs="?",
+        const=reference_cache.REFERENCE_CACHE_DIR,
+        default=None,
+        help="Share one extracted copy of the reference with the other jobs on"
+        " this host, in this folder (default path if no value)",
+    )
+    parser.add_argument(
+        "--reference_cache_gb",
+        type=float,
+        default=reference_cache.REFERENCE_CACHE_GB,
+        help="Disk quota of the reference cache; least recently used references"
+        " are removed to stay under it",
+    )
     #parser.add_argument("--root_dir", default="/mnt")
     parser.add_argument("--root_dir", default="/home/ec2-user/tmp")
     return parser
@@ -155,7 +170,6 @@ def main(logger):
     fastq_path.mkdir(parents=True, exist_ok=True)
 
     genome_base_dir = args.root_dir / "genome" / "STAR-2.7.9a"
-    genome_base_dir.mkdir(parents=True, exist_ok=True)
 
     barcode_base_dir = args.root_dir / "barcodes"
     barcode_base_dir.mkdir(parents=True, exist_ok=True)
@@ -192,20 +206,41 @@ def main(logger):
     )
 
 
-    s3 = boto3.resource("s3")
-
-
-    # download the reference barcode & genome data
-    
-    logger.info(f"Downloading and extracting genome data {genome_name}")
-    s3_genome_object = s3.Object(S3_REFERENCE[args.region], ref_genome_10x_file)
-
-    with tarfile.open(fileobj=s3_genome_object.get()["Body"], mode="r|gz") as tf:
-        tf.extractall(path=genome_base_dir)
+    if args.glacier:
+        # request restores first, so they thaw while the genome downloads
+        s3_input_bucket, _ = s3u.s3_bucket_and_key(args.s3_input_path)
+        restore_keys = sample_fastqs(
+            args.s3_input_path, args.sample_prefix, args.by_folder
+        )
+        watcher = s3u.RestoreWatcher(
+            args.root_dir / "restores.json", bucket=s3_input_bucket
+        )
+        watcher.request(restore_keys)
+
+    # download the reference genome data
+    if args.reference_cache:
+        cache = reference_cache.ReferenceCache(
+            args.reference_cache,
+            quota=args.reference_cache_gb * 2 ** 30,
+            logger=logger,
+        )
+        genome_dir = (
+            pathlib.Path(cache.get(S3_REFERENCE[args.region], ref_genome_10x_file))
+            / genome_name
+        )
+    else:
+        logger.info(f"Downloading and extracting genome data {genome_name}")
+        genome_base_dir.mkdir(parents=True, exist_ok=True)
+        reference_cache.fetch_reference(
+            S3_REFERENCE[args.region], ref_genome_10x_file, genome_base_dir
+        )
 
     sys.stdout.flush()
 
-    
+    if args.glacier:
+        logger.info("Waiting for archived fastq files to be restored")
+        for _ in watcher.watch_groups({args.sample_prefix: restore_keys}):
+            pass
 
     # download the fastq files
     command = [
@@ -216,8 +251,7 @@ def main(logger):
         "--recursive",
         "--exclude",
         "'*'",
-        "--include",
-        f"'*{args.sample_prefix}*'",
+        *fastq_includes(args.sample_prefix, args.by_folder),
         "--force-glacier-transfer" if args.glacier else "",
         args.s3_input_path,
         f"{fastq_path}",
@@ -12,6 +12,7 @@ import csv
 from collections import defaultdict
 
 import utilities.log_util as ut_log
+import utilities.partition_util as partition_util
 import utilities.s3_util as s3u
 
 import boto3
@@ -240,21 +241,41 @@ def main(logger):
 
     logger.info(f"number of samples: {len(sample_name_to_fastq_keys)}")
 
-    # download input fastqs from S3 to an EC2 instance
     fastq_dir = run_dir / "fastqs"
     fastq_dir.mkdir(parents=True)
 
-    for key in fastqs_key_to_name.keys():
-        s3c.download_file(
-            Bucket=s3_input_bucket,
-            Key=key,
-            Filename=str(fastq_dir / fastqs_key_to_name[key]),
+    # balance the partitions by the total fastq size of their samples
+    sample_totals = {sample: sum(sizes) for sample, sizes in fastq_sizes.items()}
+    partitions = partition_util.lpt_partition(sample_totals, args.num_partitions)
+    logger.info(
+        "Partition plan:\n" + partition_util.partition_report(sample_totals, partitions)
+    )
+    partition_samples = partitions[args.partition_id]
+
+    if args.glacier:
+        # process samples in the order their archived fastqs are restored
+        watcher = s3u.RestoreWatcher(run_dir / "restores.json", bucket=s3_input_bucket)
+        watcher.request(
+            key
+            for sample in partition_samples
+            for key in sample_name_to_fastq_keys[sample]
+        )
+        sample_order = watcher.watch_groups(
+            {sample: sample_name_to_fastq_keys[sample] for sample in partition_samples}
         )
+    else:
+        sample_order = partition_samples
 
     # run kallisto alignment and RNA velocity analysis on the valid fastq files
-    for sample in sorted(sample_name_to_fastq_keys)[
-        args.partition_id :: args.num_partitions
-    ]:
+    for sample in sample_order:
+        # download input fastqs from S3 to an EC2 instance
+        for key in sample_name_to_fastq_keys[sample]:
+            s3c.download_file(
+                Bucket=s3_input_bucket,
+                Key=key,
+                Filename=str(fastq_dir / fastqs_key_to_name[key]),
+            )
+
         result_path = run_dir / "results"
         result_path.mkdir(parents=True)
 
@@ -6,8 +6,11 @@ import re
 import subprocess
 import time
 
+import utilities.completion_index as completion_index
 import utilities.log_util as ut_log
+import utilities.partition_util as partition_util
 import utilities.s3_util as s3u
+import utilities.work_queue as work_queue
 from utilities.alignment.run_star_and_htseq import reference_genomes, deprecated
 
 import boto3
@@ -79,6 +82,20 @@ def get_parser():
         action="store_true",
         help="Process files even when results already exist",
     )
+    parser.add_argument(
+        "--listing_cache",
+        nargs="?",
+        const=s3u.LISTING_CACHE_PATH,
+        default=None,
+        help="Cache S3 listings in this SQLite file (default path if no value)",
+    )
+    parser.add_argument(
+        "--claim_queue",
+        default=None,
+        help="Instead of the static partition, claim bam files from a queue shared"
+        " by all jobs of the run (an s3:// prefix, or a local SQLite file)."
+        " --partition_id and --num_partitions are ignored",
+    )
 
     return parser
 
@@ -104,6 +121,8 @@ def run_sample(
         run_dir - Path local to the machine on EC2 under which alignment results
                   are stored before uploaded to S3
         logger - Logger object that exposes the interface the code directly uses
+
+        Return FAILED, a boolean value of whether velocyto failed
     """
 
     t_config = TransferConfig(num_download_attempts=25)
@@ -138,7 +157,7 @@ def run_sample(
     ):
         logger.info(f"velocyto failed on {sample_id}")
         os.remove(local_sample)
-        return
+        return True
 
     output_file = os.path.join(run_dir, f"{sample_id}.loom")
 
@@ -154,6 +173,8 @@ def run_sample(
     os.remove(local_sample)
     os.remove(output_file)
 
+    return False
+
 
 def main(logger):
     """ Download reference genome, run velocyto jobs, and upload results to S3.
@@ -210,6 +231,39 @@ def main(logger):
 
     s3_output_bucket, s3_output_prefix = s3u.s3_bucket_and_key(args.s3_output_path)
 
+    if args.listing_cache:
+        listing_cache = s3u.ListingCache(args.listing_cache)
+    else:
+        listing_cache = None
+
+    def list_outputs():
+        """Sample ids of the looms in the output folder, to seed its completion
+        index the first time. Listed without the cache, which may be stale"""
+        logger.info("No completion index yet, listing the output folder")
+        output = s3u.prefix_gen(
+            s3_output_bucket, s3_output_prefix, lambda r: (r["LastModified"], r["Key"])
+        )
+
+        return {
+            (os.path.basename(fn).split(".")[0],)
+            for dt, fn in output
+            if fn.endswith(".loom") and dt > CURR_MIN_VER
+        }
+
+    # Check the output folder for existing runs, once for all the input folders
+    done_index = completion_index.CompletionIndex(s3_output_bucket, s3_output_prefix)
+    if args.force_redo:
+        done_index.load()
+        output_files = set()
+    else:
+        output_files = {entry[0] for entry in done_index.load(seed=list_outputs)}
+
+    if args.claim_queue:
+        claim_queue = work_queue.open_queue(args.claim_queue)
+        logger.info(f"Claiming bam files from {args.claim_queue}")
+    else:
+        claim_queue = None
+
     for input_dir in args.input_dirs:
         logger.info(
             "Running partition {} of {} for {}".format(
@@ -217,70 +271,56 @@ def main(logger):
             )
         )
 
-        # Check the output folder for existing runs
-        if not args.force_redo:
-            output = s3u.prefix_gen(
-                s3_output_bucket,
-                s3_output_prefix,
-                lambda r: (r["LastModified"], r["Key"]),
+        # STAR alignment result files are either stored directly under the input
+        # folder or in sample sub-folders, so list it recursively
+        sample_sizes = {
+            fn: size
+            for fn, size in s3u.get_size(
+                s3_input_bucket,
+                os.path.join(s3_input_prefix, input_dir),
+                cache=listing_cache,
             )
-        else:
-            output = []
-
-        output_files = {
-            os.path.basename(fn).split(".")[0]
-            for dt, fn in output
-            if fn.endswith(".loom") and dt > CURR_MIN_VER
+            if fn.endswith(f"{args.taxon}.Aligned.out.sorted.bam")
         }
 
-        # STAR alignment result files are either stored directly under the s3 input folder, or in sample sub-folders under the s3 input foloder
-        if list(s3u.get_files(s3_input_bucket, s3_input_prefix)):
-            print(
-                "plain", list(s3u.get_files(s3_input_bucket, s3_input_prefix))
-            )  # testing
-            sample_files = [
+        # Run velocyto on the alignment results of specific plates if specified. Otherwise run velocyto on all input alignment results
+        plate_sizes = {}
+
+        for fn, size in sample_sizes.items():
+            matched = sample_re.search(os.path.basename(fn))
+            if len(plate_set) == 0 or matched.group(1).split("_")[1] in plate_set:
+                plate_sizes[fn] = size
+
+        if claim_queue is not None:
+            # work through all the bam files, largest first, taking the ones
+            # no live job has claimed
+            plate_samples = [
                 fn
-                for fn in s3u.get_files(
-                    s3_input_bucket, os.path.join(s3_input_prefix, input_dir)
-                )
-                if fn.endswith(f"{args.taxon}.Aligned.out.sorted.bam")
+                for fn in sorted(plate_sizes, key=plate_sizes.get, reverse=True)
+                if sample_re.search(os.path.basename(fn)).group(1) not in output_files
             ]
+            logger.info(f"number of bam files to claim from: {len(plate_samples)}")
+            plate_samples = claim_queue.claim_items(plate_samples)
         else:
-            print(
-                "sub-folders", list(s3u.get_files(s3_input_bucket, s3_input_prefix))
-            )  # testing
-            sample_folder_paths = s3u.get_folders(
-                s3_input_bucket, os.path.join(s3_input_prefix, input_dir)
+            # balance the partitions by bam size, then skip existing results
+            partitions = partition_util.lpt_partition(
+                plate_sizes, args.num_partitions
+            )
+            logger.info(
+                "Partition plan:\n"
+                + partition_util.partition_report(plate_sizes, partitions)
             )
-            for folder in sample_folder_paths:
-                if not folder.endswith("/"):
-                    folder += "/"
-            sample_files = []
-            for sample in sample_folder_paths:
-                sample_files = [
-                    fn
-                    for fn in s3u.get_files(
-                        s3_input_bucket, os.path.join(s3_input_prefix, input_dir)
-                    )
-                    if fn.endswith(f"{args.taxon}.Aligned.out.sorted.bam")
-                ]
-                sample_files += files
-
-        # Run velocyto on the alignment results of specific plates if specified. Otherwise run velocyto on all input alignment results
-        plate_samples = []
 
-        for fn in sample_files:
-            matched = sample_re.search(os.path.basename(fn))
-            if matched.group(1) not in output_files:
-                if len(plate_set) == 0 or matched.group(1).split("_")[1] in plate_set:
-                    plate_samples.append(fn)
+            plate_samples = [
+                fn
+                for fn in partitions[args.partition_id]
+                if sample_re.search(os.path.basename(fn)).group(1) not in output_files
+            ]
 
-        logger.info(f"number of bam files: {len(plate_samples)}")
+            logger.info(f"number of bam files: {len(plate_samples)}")
 
-        for sample_name in sorted(plate_samples)[
-            args.partition_id :: args.num_partitions
-        ]:
-            run_sample(
+        for sample_name in plate_samples:
+            failed = run_sample(
                 sample_name,
                 mask_path,
                 gtf_path,
@@ -290,10 +330,17 @@ def main(logger):
                 run_dir,
                 logger,
             )
+            if not failed:
+                done_index.add(os.path.basename(sample_name).split(".")[0])
+            if claim_queue is not None:
+                claim_queue.complete(sample_name)
             time.sleep(30)
 
         logger.info("Job completed")
 
+    if claim_queue is not None:
+        claim_queue.close()
+
 
 if __name__ == "__main__":
     mainlogger, log_file, file_handler = ut_log.get_logger(__name__)
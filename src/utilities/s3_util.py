@@ -1,15 +1,59 @@
+import collections
+import datetime
+import functools
+import hashlib
+import io
 import itertools
+import json
 import os
+import posixpath
+import sqlite3
+import threading
+import time
 
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-from boto3.s3.transfer import TransferConfig
 
+# boto3 is imported on first use, and clients and resources are built per
+# thread, so importing this module stays cheap. Use configure() to change the
+# region or endpoint before the first call.
+N_THREADS = 16
+MAX_POOL_CONNECTIONS = 32
+MAX_ATTEMPTS = 10
 
-s3c = boto3.client("s3")
-s3r = boto3.resource("s3")
-bucket_resource = s3r.Bucket("czbiohub-seqbot")
+# number of folder levels prefix_gen splits into concurrently listed shards
+LIST_DEPTH = 1
+
+# objects larger than COPY_PART_SIZE are copied in parts, by a pool of
+# COPY_PART_THREADS threads shared by all copies. CopyObject is limited to 5 GiB,
+# so COPY_PART_SIZE can't be larger.
+COPY_PART_SIZE = 256 * 2 ** 20
+COPY_PART_THREADS = 2 * N_THREADS
+MAX_PARTS = 10000
+
+# downloads are retried (resuming where they stopped) and written in chunks
+DOWNLOAD_ATTEMPTS = 25
+DOWNLOAD_CHUNK_SIZE = 2 ** 20
+
+# streamed reads (RangedReader) fetch this many parts of this size at once
+RANGE_PART_SIZE = 32 * 2 ** 20
+RANGE_THREADS = 8
+
+# seconds between progress messages for long transfers
+PROGRESS_EVERY = 30
+
+# storage classes that need a restore before they can be read
+ARCHIVE_CLASSES = ("GLACIER", "DEEP_ARCHIVE")
+
+# default location and freshness of the local listing cache
+LISTING_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "czb-util", "s3_listing.sqlite"
+)
+LISTING_TTL = 3600
+
+_thread_local = threading.local()
+_settings = {"region_name": None, "endpoint_url": None}
+_generation = 0
 
 
 # cribbed from https://github.com/chanzuckerberg/s3mi/blob/master/scripts/s3mi
@@ -27,10 +71,22 @@ def s3_bucket_and_key(s3_uri, require_prefix=False):
     return s3_uri[len(prefix) :].split("/", 1)
 
 
-def get_folders(bucket="czb-seqbot", prefix=None):
+def get_folders(bucket="czb-seqbot", prefix=None, cache=None):
     """List the folders under a specific path in a bucket. Prefix should end with a /
+
+    If a ListingCache is given, the folders are read from its cached listing.
     """
-    paginator = s3c.get_paginator("list_objects_v2")
+    if cache is not None:
+        prefix = prefix or ""
+        folders = {
+            prefix + r["Key"][len(prefix) :].split("/", 1)[0] + "/"
+            for r in cache.records(bucket, prefix)
+            if "/" in r["Key"][len(prefix) :]
+        }
+        yield from sorted(folders)
+        return
+
+    paginator = get_client().get_paginator("list_objects_v2")
 
     response_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/")
 
@@ -46,140 +102,1231 @@ def list_s3_keys(bucket="czb-seqbot", prefix=None, suffix=''):
     if isinstance(prefix, str):                                                                                                                                                                                                                                           
         params['Prefix'] = prefix                                                                                                                                                                                                                                         
                                                                                                                                                                                                                                                                            
-    paginator = s3c.get_paginator('list_objects_v2')                                                                                                                                                                                                                
+    paginator = get_client().get_paginator('list_objects_v2')                                                                                                                                                                                                                
     for result in paginator.paginate(**params):                                                                                                                                                                                                                           
         for obj in result['Contents']:                                                                                                                                                                                                                                    
             key = obj['Key']                                                                                                                                                                                                                                              
             if key.startswith(prefix) and key.endswith(suffix):                                                                                                                                                                                                           
                 yield key
 
-def prefix_gen(bucket, prefix, fn=None):
-    """Generic generator of fn(result) from an S3 paginator"""
+def prefix_gen(
+    bucket, prefix, fn=None, *, depth=LIST_DEPTH, n_threads=N_THREADS, cache=None
+):
+    """Generic generator of fn(result) from an S3 paginator
 
-    paginator = s3c.get_paginator("list_objects_v2")
+    With depth > 0 the prefix is split into sub-folder shards (see
+    list_sharded) that are paged concurrently; results come out in key order
+    either way. depth=0 walks a single paginator. If a ListingCache is given,
+    the records come from it instead.
+    """
+
+    if fn is None:
+        fn = lambda r: r
+
+    if cache is not None:
+        yield from map(fn, cache.records(bucket, prefix))
+        return
+
+    if depth > 0:
+        yield from map(
+            fn, list_sharded(bucket, prefix, depth=depth, n_threads=n_threads)
+        )
+        return
+
+    paginator = get_client().get_paginator("list_objects_v2")
 
-    response_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix)
+    response_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix or "")
 
     for result in response_iterator:
         if "Contents" in result:
             yield from (fn(r) for r in result["Contents"])
 
 
-def get_files(bucket="czb-seqbot", prefix=None):
-    """Generator of keys for a given S3 prefix. Be careful that the first element of the generator output is simply the input prefix. Keys of files start from the second element of the generator output."""
-    yield from prefix_gen(bucket, prefix, lambda r: r["Key"])
+def get_files(bucket="czb-seqbot", prefix=None, **kwargs):
+    """Generator of keys for a given S3 prefix. Be careful that the first element of the generator output is simply the input prefix. Keys of files start from the second element of the generator output. Keyword arguments are passed to prefix_gen."""
+    yield from prefix_gen(bucket, prefix, lambda r: r["Key"], **kwargs)
 
 
-def get_size(bucket="czb-seqbot", prefix=None):
-    """Generator of (key,size) for a given S3 prefix. Unlike get_files, the first element of the generator output is not a tuple with input prefix as key and 0 as size, but rather the (key,size) pair for the first file under the input prefix."""
-    yield from prefix_gen(bucket, prefix, lambda r: (r["Key"], r["Size"]))
+def get_size(bucket="czb-seqbot", prefix=None, **kwargs):
+    """Generator of (key,size) for a given S3 prefix. Unlike get_files, the first element of the generator output is not a tuple with input prefix as key and 0 as size, but rather the (key,size) pair for the first file under the input prefix. Keyword arguments are passed to prefix_gen."""
+    yield from prefix_gen(bucket, prefix, lambda r: (r["Key"], r["Size"]), **kwargs)
 
 
-def get_status(file_list, bucket_name="czb-seqbot"):
+def get_status(file_list, bucket_name="czb-seqbot", *, n_proc=N_THREADS):
     """Print the storage/restore status for a list of keys"""
 
-    for fn in file_list:
-        obj = s3r.Object(bucket_name, fn)
-        print(obj.key, obj.storage_class, obj.restore)
+    for fn, (storage_class, restore) in plan_restores(
+        file_list, bucket=bucket_name, n_proc=n_proc
+    ).items():
+        print(fn, storage_class, restore)
+
+
+def configure(*, region=None, endpoint_url=None):
+    """Set the region and endpoint used for clients built after this call"""
+    global _generation
+
+    _settings.update(region_name=region, endpoint_url=endpoint_url)
+    _generation += 1
+
+
+def _thread_cache():
+    """Return the calling thread's client cache, resetting it after a fork or
+    a call to configure()"""
+    state = (os.getpid(), _generation)
+    if getattr(_thread_local, "state", None) != state:
+        _thread_local.state = state
+        _thread_local.cache = {}
+    return _thread_local.cache
+
+
+def get_client():
+    """Return an S3 client owned by the calling thread.
+
+    Each thread keeps one client (and its connection pool) for its whole
+    lifetime, so connections are reused across keys instead of re-opened.
+    """
+    cache = _thread_cache()
+    if "client" not in cache:
+        import boto3
+        import botocore.config
+
+        cache["client"] = boto3.session.Session().client(
+            "s3",
+            config=botocore.config.Config(
+                max_pool_connections=MAX_POOL_CONNECTIONS,
+                retries={"max_attempts": MAX_ATTEMPTS, "mode": "adaptive"},
+            ),
+            **_settings,
+        )
+    return cache["client"]
+
+
+def get_resource():
+    """Return an S3 service resource owned by the calling thread"""
+    cache = _thread_cache()
+    if "resource" not in cache:
+        import boto3
+
+        cache["resource"] = boto3.session.Session().resource("s3", **_settings)
+    return cache["resource"]
+
+
+def __getattr__(name):
+    # the module-level clients this module used to create at import time
+    if name == "s3c":
+        return get_client()
+    elif name == "s3r":
+        return get_resource()
+    elif name == "bucket_resource":
+        return get_resource().Bucket("czbiohub-seqbot")
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def transfer_config(**kwargs):
+    """Build a boto3 TransferConfig without importing boto3 at module load"""
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(**kwargs)
+
+
+class TransferStats:
+    """Thread-safe counter of finished objects and transferred bytes"""
+
+    def __init__(self, total=None, progress_every=PROGRESS_EVERY):
+        self._lock = threading.Lock()
+        self.n_objects = 0
+        self.n_bytes = 0
+        self.start = time.monotonic()
+        self.total = total
+        self.progress_every = progress_every
+        self._last_progress = self.start
+
+    def add_bytes(self, n):
+        """Count n bytes; usable as a boto3 transfer Callback"""
+        with self._lock:
+            self.n_bytes += n
+
+    def add_object(self):
+        with self._lock:
+            self.n_objects += 1
+
+            now = time.monotonic()
+            if self.total and now - self._last_progress >= self.progress_every:
+                self._last_progress = now
+                print(self.progress())
+
+    def progress(self):
+        """Describe how many of total objects are done, with an ETA"""
+        rate = self.n_objects / max(time.monotonic() - self.start, 1e-9)
+        eta = (self.total - self.n_objects) / rate if rate else float("inf")
+        return f"{self.n_objects}/{self.total} objects done, ETA {eta:.0f}s"
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return (
+            f"{self.n_objects} objects, {self.n_bytes / 2 ** 20:.1f} MiB"
+            f" in {elapsed:.1f}s ({self.n_objects / elapsed:.1f} objects/s,"
+            f" {self.n_bytes / 2 ** 20 / elapsed:.1f} MiB/s)"
+        )
+
+
+def run_transfers(fn, *iterables, n_threads=N_THREADS, max_in_flight=None, total=None):
+    """Call fn(*args, callback=...) for each set of args from iterables on a thread pool.
+
+    At most max_in_flight calls (default 4 * n_threads) are queued or running at
+    once, so long key lists are never materialized as futures all at once. The
+    callback counts transferred bytes. If the number of calls (total) is given,
+    progress and an ETA are printed periodically. Returns the list of results,
+    in order, after printing the object and byte rates.
+    """
+
+    if max_in_flight is None:
+        max_in_flight = 4 * n_threads
+
+    stats = TransferStats(total)
+    slots = threading.BoundedSemaphore(max_in_flight)
+
+    def call(args):
+        try:
+            return fn(*args, callback=stats.add_bytes)
+        finally:
+            stats.add_object()
+            slots.release()
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for args in zip(*iterables):
+            slots.acquire()
+            futures.append(executor.submit(call, args))
+
+    results = [f.result() for f in futures]
+    print(stats.report())
+
+    return results
+
+
+def list_prefix(bucket, prefix, *, delimiter=None, start_after=None):
+    """List the objects directly under prefix with the calling thread's client.
+
+    Returns a list of list_objects_v2 records. With delimiter="/" the listing
+    stops at the first folder level; with start_after only keys sorting after
+    it are listed.
+    """
+    params = {"Bucket": bucket, "Prefix": prefix}
+    if delimiter:
+        params["Delimiter"] = delimiter
+    if start_after:
+        params["StartAfter"] = start_after
+
+    paginator = get_client().get_paginator("list_objects_v2")
+
+    return [
+        r for result in paginator.paginate(**params) for r in result.get("Contents", ())
+    ]
+
+
+def list_level(bucket, prefix):
+    """List one folder level under prefix.
+
+    Returns (records, sub_prefixes): the objects directly under prefix and the
+    sub-folders found with Delimiter="/".
+    """
+    paginator = get_client().get_paginator("list_objects_v2")
+
+    records, sub_prefixes = [], []
+    for result in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        records.extend(result.get("Contents", ()))
+        sub_prefixes.extend(c["Prefix"] for c in result.get("CommonPrefixes", ()))
 
+    return records, sub_prefixes
 
-def restore_file(k):
-    obj = s3r.Object("czbiohub-seqbot", k)
-    if obj.storage_class == "GLACIER" and not obj.restore:
-        bucket_resource.meta.client.restore_object(
-            Bucket="czbiohub-seqbot", Key=k, RestoreRequest={"Days": 7}
+
+def list_sharded(bucket, prefix, *, depth=LIST_DEPTH, n_threads=N_THREADS):
+    """Generator of every listing record under prefix, in key order.
+
+    Sub-folders are discovered with delimited listings down to depth levels,
+    then each folder at the last level (a shard) is paged on its own thread.
+    At most 2 * n_threads shards are listed ahead of the consumer.
+    """
+
+    records, shards = [], [prefix or ""]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for _ in range(depth):
+            levels = list(executor.map(lambda p: list_level(bucket, p), shards))
+            shards = sorted(sp for _, sub_prefixes in levels for sp in sub_prefixes)
+            records.extend(r for level_records, _ in levels for r in level_records)
+            if not shards:
+                break
+
+        records.sort(key=lambda r: r["Key"])
+        shards = iter(shards)
+        pending = collections.deque(
+            (shard, executor.submit(list_prefix, bucket, shard))
+            for shard in itertools.islice(shards, 2 * n_threads)
         )
 
+        i = 0
+        while pending:
+            shard, future = pending.popleft()
+            next_shard = next(shards, None)
+            if next_shard is not None:
+                pending.append(
+                    (next_shard, executor.submit(list_prefix, bucket, next_shard))
+                )
+
+            # objects found during discovery sort between the shards
+            while i < len(records) and records[i]["Key"] < shard:
+                yield records[i]
+                i += 1
+
+            yield from future.result()
+
+        yield from records[i:]
+
+
+def list_prefixes(bucket, prefixes, *, delimiter="/", n_threads=N_THREADS):
+    """Generator of listing records for several prefixes, listed in parallel"""
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for records in executor.map(
+            lambda p: list_prefix(bucket, p, delimiter=delimiter), sorted(prefixes)
+        ):
+            yield from records
+
+
+def _etag(record):
+    return record["ETag"].strip('"')
+
+
+class ObjectIndex:
+    """Index of key -> (size, ETag) used to skip work that is already done.
+
+    Build one with from_s3 (one delimited listing per distinct folder of the
+    keys, run in parallel) or from_manifest (a JSON file written earlier by
+    save_manifest). Anything with an is_done(key, size, etag) method can be
+    passed to copy_files/download_files in place of this class.
+    """
+
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+
+    @classmethod
+    def from_records(cls, records):
+        return cls({r["Key"]: (r["Size"], _etag(r)) for r in records})
+
+    @classmethod
+    def from_s3(cls, bucket, keys, *, n_threads=N_THREADS):
+        """Index the objects that share a folder with any of keys"""
+        folders = {posixpath.dirname(k) for k in keys}
+        return cls.from_records(
+            list_prefixes(
+                bucket,
+                [f"{f}/" if f else "" for f in folders],
+                n_threads=n_threads,
+            )
+        )
+
+    @classmethod
+    def from_manifest(cls, path):
+        with open(path) as fh:
+            return cls({k: tuple(v) for k, v in json.load(fh).items()})
+
+    def save_manifest(self, path):
+        with open(path, "w") as fh:
+            json.dump(self.entries, fh)
+
+    def get(self, key):
+        """Return (size, etag) for key, or (None, None) if it isn't indexed"""
+        return self.entries.get(key, (None, None))
+
+    def is_done(self, key, size=None, etag=None):
+        if key not in self.entries:
+            return False
+
+        known_size, known_etag = self.entries[key]
+        if size is not None and size != known_size:
+            return False
+
+        # multipart ETags depend on the part size, so they can't be compared
+        if etag and known_etag and "-" not in etag + known_etag:
+            return etag == known_etag
+
+        return True
+
+
+class LocalIndex:
+    """Treat a local file as done if it exists with the expected size"""
+
+    def is_done(self, path, size=None, etag=None):
+        try:
+            st_size = os.stat(path).st_size
+        except FileNotFoundError:
+            return False
+
+        return size is None or st_size == size
+
+
+class ListingCache:
+    """SQLite cache of S3 listings, keyed by bucket and prefix.
+
+    A cached listing is used as-is for ttl seconds, then listed again in full:
+    one delimited listing finds the objects directly under the prefix and its
+    sub-folders (shards), which are listed concurrently.
+
+    With incremental=True an expired listing is refreshed incrementally
+    instead: new shards are listed in full, but known shards only after their
+    last cached key (StartAfter). New samples and runs land in new shards or
+    sort after the existing keys, so this picks them up, but keys added
+    before the last one of a shard, overwritten or deleted are only noticed
+    by a full refresh (refresh=True). Use it only for listings that can be a
+    little stale, e.g. of fastq files that are never rewritten, and not to
+    decide which outputs exist.
+    """
+
+    # bumped when the tables change; older caches are dropped and re-listed
+    SCHEMA_VERSION = 1
+
+    def __init__(
+        self,
+        path=LISTING_CACHE_PATH,
+        ttl=LISTING_TTL,
+        n_threads=N_THREADS,
+        *,
+        incremental=False,
+    ):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.n_threads = n_threads
+        self.incremental = incremental
+        self.db = sqlite3.connect(path)
+        with self.db:
+            if self.db.execute("PRAGMA user_version").fetchone()[0] != (
+                self.SCHEMA_VERSION
+            ):
+                self.db.executescript(
+                    """
+                    DROP TABLE IF EXISTS listings;
+                    DROP TABLE IF EXISTS shards;
+                    DROP TABLE IF EXISTS objects;
+                    """
+                )
+                self.db.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+            # an object's shard is the sub-folder of the prefix it's in, or ""
+            # for the objects directly under the prefix
+            self.db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS listings (
+                    bucket TEXT, prefix TEXT, listed_at REAL,
+                    PRIMARY KEY (bucket, prefix)
+                );
+                CREATE TABLE IF NOT EXISTS shards (
+                    bucket TEXT, prefix TEXT, shard TEXT,
+                    PRIMARY KEY (bucket, prefix, shard)
+                );
+                CREATE TABLE IF NOT EXISTS objects (
+                    bucket TEXT, prefix TEXT, key TEXT, size INTEGER, etag TEXT,
+                    last_modified TEXT, storage_class TEXT, shard TEXT,
+                    PRIMARY KEY (bucket, prefix, key)
+                );
+                CREATE INDEX IF NOT EXISTS objects_shard
+                    ON objects (bucket, prefix, shard, key);
+                """
+            )
+
+    def records(self, bucket, prefix, *, refresh=False):
+        """Return the listing records under prefix, in key order"""
+
+        prefix = prefix or ""
+        row = self.db.execute(
+            "SELECT listed_at FROM listings WHERE bucket = ? AND prefix = ?",
+            (bucket, prefix),
+        ).fetchone()
+
+        if refresh or row is None:
+            self._list_full(bucket, prefix)
+        elif time.time() - row[0] > self.ttl:
+            if self.incremental:
+                self._list_incremental(bucket, prefix)
+            else:
+                self._list_full(bucket, prefix)
+
+        return [
+            {
+                "Key": key,
+                "Size": size,
+                "ETag": etag,
+                "LastModified": datetime.datetime.fromisoformat(last_modified),
+                "StorageClass": storage_class,
+            }
+            for key, size, etag, last_modified, storage_class in self.db.execute(
+                "SELECT key, size, etag, last_modified, storage_class FROM objects"
+                " WHERE bucket = ? AND prefix = ? ORDER BY key",
+                (bucket, prefix),
+            )
+        ]
+
+    def _list_full(self, bucket, prefix):
+        records, shards = list_level(bucket, prefix)
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            for shard_records in executor.map(
+                lambda shard: list_prefix(bucket, shard), shards
+            ):
+                records.extend(shard_records)
+
+        with self.db:
+            self.db.execute(
+                "DELETE FROM objects WHERE bucket = ? AND prefix = ?", (bucket, prefix)
+            )
+            self.db.execute(
+                "DELETE FROM shards WHERE bucket = ? AND prefix = ?", (bucket, prefix)
+            )
+            self._store(bucket, prefix, records, shards)
+
+    def _list_incremental(self, bucket, prefix):
+        records, shards = list_level(bucket, prefix)
+        known_shards = {
+            shard: None
+            for shard, in self.db.execute(
+                "SELECT shard FROM shards WHERE bucket = ? AND prefix = ?",
+                (bucket, prefix),
+            )
+        }
+        known_shards.update(
+            self.db.execute(
+                "SELECT shard, max(key) FROM objects"
+                " WHERE bucket = ? AND prefix = ? AND shard != '' GROUP BY shard",
+                (bucket, prefix),
+            )
+        )
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            for shard_records in executor.map(
+                lambda shard: list_prefix(
+                    bucket, shard, start_after=known_shards.get(shard)
+                ),
+                shards,
+            ):
+                records.extend(shard_records)
+
+        with self.db:
+            # direct children are always re-listed, as are shards that vanished
+            self.db.execute(
+                "DELETE FROM objects WHERE bucket = ? AND prefix = ? AND shard = ''",
+                (bucket, prefix),
+            )
+            for shard in set(known_shards) - set(shards):
+                self.db.execute(
+                    "DELETE FROM objects WHERE bucket = ? AND prefix = ? AND shard = ?",
+                    (bucket, prefix, shard),
+                )
+                self.db.execute(
+                    "DELETE FROM shards WHERE bucket = ? AND prefix = ? AND shard = ?",
+                    (bucket, prefix, shard),
+                )
+            self._store(bucket, prefix, records, shards)
+
+    @staticmethod
+    def _shard(prefix, key):
+        folder, sep, _ = key[len(prefix) :].partition("/")
+        return f"{prefix}{folder}/" if sep else ""
+
+    def _store(self, bucket, prefix, records, shards):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    bucket,
+                    prefix,
+                    r["Key"],
+                    r["Size"],
+                    r["ETag"],
+                    r["LastModified"].isoformat(),
+                    r.get("StorageClass", "STANDARD"),
+                    self._shard(prefix, r["Key"]),
+                )
+                for r in records
+            ),
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO shards VALUES (?, ?, ?)",
+            ((bucket, prefix, shard) for shard in shards),
+        )
+        self.db.execute(
+            "INSERT OR REPLACE INTO listings VALUES (?, ?, ?)",
+            (bucket, prefix, time.time()),
+        )
+
+
+def head_restore(bucket, key, *, callback=None):
+    """Return the Restore header of an object, or None if it was never restored"""
+    return get_client().head_object(Bucket=bucket, Key=key).get("Restore")
+
 
-def copy_file(bucket, new_bucket, key, new_key):
-    s3c.copy(
-        CopySource={"Bucket": bucket, "Key": key},
+def plan_restores(file_list, *, bucket="czbiohub-seqbot", n_proc=N_THREADS):
+    """Return {key: (storage_class, restore)} for a list of keys.
+
+    Storage classes are read from listings of the keys' folders. Only objects
+    in an archive class get a HEAD request, run on a thread pool, to read
+    their restore status. restore is None for every other object. Keys that
+    don't exist are left out.
+    """
+
+    classes = {
+        r["Key"]: r.get("StorageClass", "STANDARD")
+        for r in list_prefixes(
+            bucket,
+            {f"{posixpath.dirname(k)}/" if "/" in k else "" for k in file_list},
+            n_threads=n_proc,
+        )
+    }
+    plan = {k: (classes[k], None) for k in file_list if k in classes}
+
+    archived = [k for k, (c, _) in plan.items() if c in ARCHIVE_CLASSES]
+    print(f"checking restore status of {len(archived)} archived files")
+    for k, restore in zip(
+        archived,
+        run_transfers(
+            head_restore,
+            itertools.repeat(bucket),
+            archived,
+            n_threads=n_proc,
+            total=len(archived),
+        ),
+    ):
+        plan[k] = (plan[k][0], restore)
+
+    return plan
+
+
+def restore_file(
+    k, *, bucket="czbiohub-seqbot", days=7, tier="Standard", callback=None
+):
+    """Request a restore of an archived object for the given number of days"""
+    try:
+        get_client().restore_object(
+            Bucket=bucket,
+            Key=k,
+            RestoreRequest={"Days": days, "GlacierJobParameters": {"Tier": tier}},
+        )
+    except get_client().exceptions.ClientError as e:
+        if e.response["Error"]["Code"] != "RestoreAlreadyInProgress":
+            raise
+
+
+def copy_file(
+    bucket,
+    new_bucket,
+    key,
+    new_key,
+    *,
+    size=None,
+    part_size=COPY_PART_SIZE,
+    callback=None,
+):
+    """Server-side copy of one object, choosing a strategy by its size.
+
+    Objects up to part_size are copied with a single CopyObject call. Larger
+    objects are copied with UploadPartCopy (see multipart_copy). If size isn't
+    known it is read with a HEAD request.
+    """
+
+    head = None
+    if size is None:
+        head = get_client().head_object(Bucket=bucket, Key=key)
+        size = head["ContentLength"]
+
+    if size <= part_size:
+        get_client().copy_object(
+            CopySource={"Bucket": bucket, "Key": key}, Bucket=new_bucket, Key=new_key
+        )
+        if callback:
+            callback(size)
+    else:
+        multipart_copy(
+            bucket,
+            new_bucket,
+            key,
+            new_key,
+            size=size,
+            head=head,
+            part_size=part_size,
+            callback=callback,
+        )
+
+
+_part_pool = None  # (pid, executor)
+_part_pool_lock = threading.Lock()
+
+
+def _copy_part_pool():
+    """The thread pool that copies the parts of every multipart_copy. It's
+    shared, so concurrent copies (e.g. from copy_files) reuse its threads and
+    their clients instead of each starting a pool of its own"""
+    global _part_pool
+    with _part_pool_lock:
+        if _part_pool is None or _part_pool[0] != os.getpid():
+            _part_pool = (
+                os.getpid(),
+                ThreadPoolExecutor(
+                    max_workers=COPY_PART_THREADS, thread_name_prefix="copy_part"
+                ),
+            )
+        return _part_pool[1]
+
+
+def multipart_copy(
+    bucket,
+    new_bucket,
+    key,
+    new_key,
+    *,
+    size,
+    head=None,
+    part_size=COPY_PART_SIZE,
+    callback=None,
+):
+    """Copy one large object of size bytes with UploadPartCopy requests, run on
+    the shared part pool. head is the source's HEAD response, if the caller
+    has it, for the content type and metadata that are copied along"""
+
+    if head is None:
+        head = get_client().head_object(Bucket=bucket, Key=key)
+
+    # S3 allows at most 10000 parts per upload
+    part_size = max(part_size, -(-size // MAX_PARTS))
+    ranges = [(i, min(i + part_size, size) - 1) for i in range(0, size, part_size)]
+
+    upload_id = get_client().create_multipart_upload(
         Bucket=new_bucket,
         Key=new_key,
-        Config=TransferConfig(use_threads=False),
-    )
+        ContentType=head.get("ContentType", "binary/octet-stream"),
+        Metadata=head.get("Metadata", {}),
+    )["UploadId"]
+
+    def copy_part(part_number, byte_range):
+        first, last = byte_range
+        response = get_client().upload_part_copy(
+            CopySource={"Bucket": bucket, "Key": key},
+            CopySourceRange=f"bytes={first}-{last}",
+            Bucket=new_bucket,
+            Key=new_key,
+            PartNumber=part_number,
+            UploadId=upload_id,
+        )
+        if callback:
+            callback(last - first + 1)
+        return {"ETag": response["CopyPartResult"]["ETag"], "PartNumber": part_number}
+
+    futures = [
+        _copy_part_pool().submit(copy_part, part_number, byte_range)
+        for part_number, byte_range in enumerate(ranges, 1)
+    ]
+    try:
+        parts = [future.result() for future in futures]
+
+        get_client().complete_multipart_upload(
+            Bucket=new_bucket,
+            Key=new_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        get_client().abort_multipart_upload(
+            Bucket=new_bucket, Key=new_key, UploadId=upload_id
+        )
+        raise
+
+
+def remove_file(bucket, key, *, callback=None):
+    get_client().delete_object(Bucket=bucket, Key=key)
+
+
+def download_file(bucket, key, dest, *, attempts=DOWNLOAD_ATTEMPTS, callback=None):
+    """Download one object to dest, resuming a previous partial download.
+
+    Data is written to dest.part, next to a small journal (dest.part.json)
+    recording which object version the partial file belongs to. If both are
+    left over from an interrupted download of the same ETag, only the
+    missing bytes are fetched with a ranged GET. The file is renamed to dest
+    after its size, and its MD5 for single-part uploads, match the object.
+    """
+
+    import botocore.exceptions
+
+    head = get_client().head_object(Bucket=bucket, Key=key)
+    size, etag = head["ContentLength"], head["ETag"].strip('"')
+
+    part_path, journal_path = f"{dest}.part", f"{dest}.part.json"
+    journal = {"bucket": bucket, "key": key, "size": size, "etag": etag}
+
+    try:
+        with open(journal_path) as fh:
+            resumable = json.load(fh) == journal
+    except (FileNotFoundError, ValueError):
+        resumable = False
+
+    if not (resumable and os.path.exists(part_path)):
+        with open(part_path, "wb"), open(journal_path, "w") as fh:
+            json.dump(journal, fh)
+
+    for attempt in range(attempts):
+        offset = os.path.getsize(part_path)
+        if offset >= size:
+            break
+
+        try:
+            body = get_client().get_object(
+                Bucket=bucket, Key=key, Range=f"bytes={offset}-", IfMatch=etag
+            )["Body"]
+            with open(part_path, "ab") as fh:
+                for chunk in body.iter_chunks(DOWNLOAD_CHUNK_SIZE):
+                    fh.write(chunk)
+                    if callback:
+                        callback(len(chunk))
+        except (botocore.exceptions.BotoCoreError, OSError):
+            if attempt == attempts - 1:
+                raise
+
+    part_size = os.path.getsize(part_path)
+    if part_size != size:
+        raise IOError(f"{dest}: expected {size} bytes, got {part_size}")
+
+    # multipart ETags aren't an MD5 of the content, so only the size is checked
+    if "-" not in etag and file_md5(part_path) != etag:
+        os.remove(journal_path)
+        raise IOError(f"{dest}: MD5 does not match ETag {etag}")
+
+    os.replace(part_path, dest)
+    os.remove(journal_path)
+
+
+class RangedReader(io.RawIOBase):
+    """Read-only, sequential file object over an S3 object.
+
+    The object is fetched in part_size ranged GETs, n_threads at a time and
+    ahead of the reader, so at most n_threads + 1 parts are held in memory.
+    Every GET is pinned to the object's ETag, and a part is retried from the
+    start if its connection drops. parts() yields the parts themselves, for
+    feeding a pipe without copying.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        key,
+        *,
+        part_size=RANGE_PART_SIZE,
+        n_threads=RANGE_THREADS,
+        attempts=DOWNLOAD_ATTEMPTS,
+    ):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.attempts = attempts
+
+        head = get_client().head_object(Bucket=bucket, Key=key)
+        self.size, self.etag = head["ContentLength"], head["ETag"]
+
+        self._ranges = (
+            (i, min(i + part_size, self.size) - 1)
+            for i in range(0, self.size, part_size)
+        )
+        self._executor = ThreadPoolExecutor(max_workers=n_threads)
+        self._futures = collections.deque()
+        for _ in range(n_threads):
+            self._submit()
+
+        self._buffer = memoryview(b"")
+
+    def _submit(self):
+        byte_range = next(self._ranges, None)
+        if byte_range is not None:
+            self._futures.append(self._executor.submit(self._fetch, *byte_range))
+
+    def _fetch(self, first, last):
+        import botocore.exceptions
+
+        for attempt in range(self.attempts):
+            try:
+                return get_client().get_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Range=f"bytes={first}-{last}",
+                    IfMatch=self.etag,
+                )["Body"].read()
+            except (botocore.exceptions.BotoCoreError, OSError):
+                if attempt == self.attempts - 1:
+                    raise
+
+    def _next_part(self):
+        if not self._futures:
+            return None
+
+        part = self._futures.popleft().result()
+        self._submit()
+        return part
+
+    def parts(self):
+        """Generator of the remaining parts of the object, in order"""
+        if self._buffer:
+            yield bytes(self._buffer)
+            self._buffer = memoryview(b"")
 
+        for part in iter(self._next_part, None):
+            yield part
 
-def remove_file(bucket, key):
-    s3c.delete_object(Bucket=bucket, Key=key)
+    def readable(self):
+        return True
 
+    def readinto(self, b):
+        if not self._buffer:
+            part = self._next_part()
+            if part is None:
+                return 0
+            self._buffer = memoryview(part)
 
-def download_file(bucket, key, dest):
-    s3c.download_file(
-        Bucket=bucket, Key=key, Filename=dest, Config=TransferConfig(use_threads=False)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        super().close()
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(DOWNLOAD_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def restore_files(
+    file_list,
+    *,
+    bucket="czbiohub-seqbot",
+    days=7,
+    tier="Standard",
+    n_proc=N_THREADS,
+):
+    """Restore a list of files from czbiohub-seqbot in parallel
+
+    Only archived files without a restore in progress or done are requested.
+    tier is one of "Expedited", "Standard" or "Bulk". Returns the restored keys.
+    """
+
+    plan = plan_restores(file_list, bucket=bucket, n_proc=n_proc)
+    to_restore = [
+        k for k, (c, restore) in plan.items() if c in ARCHIVE_CLASSES and not restore
+    ]
+
+    print(f"restoring {len(to_restore)} files")
+    run_transfers(
+        functools.partial(restore_file, bucket=bucket, days=days, tier=tier),
+        to_restore,
+        n_threads=n_proc,
+        total=len(to_restore),
     )
 
+    return to_restore
+
+
+def is_restored(restore):
+    """True if a Restore header says the restored copy is ready to read"""
+    return bool(restore) and 'ongoing-request="false"' in restore
+
+
+class RestoreWatcher:
+    """Request Glacier restores and yield keys as they become readable.
+
+    Pending keys are recorded in a JSON state file, so a restarted job picks up
+    the restores it already requested instead of asking again. Pending keys
+    are polled with HEAD requests; the delay between polls grows by backoff up
+    to max_delay and resets whenever something thaws.
+    """
+
+    def __init__(
+        self, state_path, *, bucket, days=7, tier="Standard", n_proc=N_THREADS
+    ):
+        self.state_path = str(state_path)
+        self.bucket = bucket
+        self.days = days
+        self.tier = tier
+        self.n_proc = n_proc
+
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as fh:
+                state = json.load(fh)
+            assert state["bucket"] == bucket, f"{state_path} tracks another bucket"
+            self.pending, self.ready = set(state["pending"]), set(state["ready"])
+        else:
+            self.pending, self.ready = set(), set()
+
+    def _save(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(
+                {
+                    "bucket": self.bucket,
+                    "pending": sorted(self.pending),
+                    "ready": sorted(self.ready),
+                },
+                fh,
+            )
+        os.replace(tmp_path, self.state_path)
+
+    def request(self, keys):
+        """Restore the archived keys that aren't readable yet and track them.
+
+        Raises FileNotFoundError if any of the keys doesn't exist.
+        """
+
+        keys = [k for k in keys if k not in self.pending and k not in self.ready]
+        plan = plan_restores(keys, bucket=self.bucket, n_proc=self.n_proc)
+
+        missing = sorted(set(keys) - set(plan))
+        if missing:
+            print(f"{len(missing)} files to restore don't exist:")
+            print("\n".join(missing))
+            raise FileNotFoundError(
+                f"{len(missing)} files to restore don't exist, e.g. {missing[0]}"
+            )
+
+        for k, (storage_class, restore) in plan.items():
+            if storage_class not in ARCHIVE_CLASSES or is_restored(restore):
+                self.ready.add(k)
+            else:
+                self.pending.add(k)
+
+        to_restore = [k for k in self.pending if k in plan and not plan[k][1]]
+        print(f"restoring {len(to_restore)} files, {len(self.pending)} pending")
+        run_transfers(
+            functools.partial(
+                restore_file, bucket=self.bucket, days=self.days, tier=self.tier
+            ),
+            to_restore,
+            n_threads=self.n_proc,
+        )
+        self._save()
+
+    def watch(self, *, delay=60, backoff=1.5, max_delay=900, timeout=None):
+        """Generator of tracked keys as they become readable.
+
+        Keys that are ready already come first. Raises TimeoutError if keys are
+        still frozen after timeout seconds.
+        """
+
+        start = time.monotonic()
+        yield from sorted(self.ready)
+        yielded = set(self.ready)
+
+        wait = delay
+        while self.pending:
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f"{len(self.pending)} files are still frozen")
+
+            time.sleep(wait)
 
-def restore_files(file_list, *, n_proc=16):
-    """Restore a list of files from czbiohub-seqbot in parallel"""
+            pending = sorted(self.pending)
+            thawed = [
+                k
+                for k, restore in zip(
+                    pending,
+                    run_transfers(
+                        head_restore,
+                        itertools.repeat(self.bucket),
+                        pending,
+                        n_threads=self.n_proc,
+                    ),
+                )
+                if is_restored(restore)
+            ]
+
+            if thawed:
+                self.pending.difference_update(thawed)
+                self.ready.update(thawed)
+                self._save()
+                wait = delay
+            else:
+                wait = min(wait * backoff, max_delay)
+
+            print(f"{len(thawed)} files thawed, {len(self.pending)} pending")
+            for k in thawed:
+                if k not in yielded:
+                    yielded.add(k)
+                    yield k
+
+    def watch_groups(self, groups, **kwargs):
+        """Generator of the names in groups ({name: keys}) as soon as all of
+        their keys are readable. Keyword arguments are passed to watch.
+
+        Raises ValueError if a group has keys that were never requested, as
+        it would never be yielded.
+        """
+
+        tracked = self.pending | self.ready
+        untracked = {
+            name: sorted(k for k in keys if k not in tracked)
+            for name, keys in groups.items()
+        }
+        untracked = {name: keys for name, keys in untracked.items() if keys}
+        if untracked:
+            for name, keys in sorted(untracked.items()):
+                print(f"{name}: {', '.join(keys)} not requested")
+            raise ValueError(
+                f"{len(untracked)} groups have keys that were never requested:"
+                f" {', '.join(sorted(untracked))}"
+            )
+
+        missing = {name: set(keys) for name, keys in groups.items()}
+        for name in sorted(n for n, keys in missing.items() if not keys):
+            yield name
 
-    print(f"restoring {len(file_list)} files")
-    with ProcessPoolExecutor(max_workers=n_proc) as executor:
-        list(executor.map(restore_file, file_list, chunksize=64))
+        for k in self.watch(**kwargs):
+            for name, keys in missing.items():
+                if k in keys:
+                    keys.discard(k)
+                    if not keys:
+                        yield name
 
 
-def copy_files(src_list, dest_list, *, b, nb, force_copy=False, n_proc=16):
+def copy_files(
+    src_list,
+    dest_list,
+    *,
+    b,
+    nb,
+    force_copy=False,
+    n_proc=N_THREADS,
+    index=None,
+    part_size=COPY_PART_SIZE,
+):
     """
     Copy a list of files from src_list to dest_list.
     b - original bucket
     nb - destination bucket
+    index - index of objects already in nb (see ObjectIndex). By default it is
+            built by listing the folders of dest_list
+    part_size - objects larger than this are copied in parts (see copy_file)
     """
 
-    if not force_copy:
-        existing_files = set(
-            get_files(bucket=nb, prefix=os.path.commonprefix(dest_list))
-        ) & set(dest_list)
-        src_list, dest_list = zip(
-            *[
-                (src, dest)
-                for src, dest in zip(src_list, dest_list)
-                if dest not in existing_files
-            ]
+    if force_copy:
+        sizes = itertools.repeat(None)
+    else:
+        if index is None:
+            index = ObjectIndex.from_s3(nb, dest_list, n_threads=n_proc)
+        src_index = ObjectIndex.from_s3(b, src_list, n_threads=n_proc)
+
+        src_list, dest_list = _pending(
+            (src, dest)
+            for src, dest in zip(src_list, dest_list)
+            if src not in src_index.entries
+            or not index.is_done(dest, *src_index.get(src))
         )
+        sizes = [src_index.get(src)[0] for src in src_list]
 
     print(f"copying {len(src_list)} files")
-    with ProcessPoolExecutor(max_workers=n_proc) as executor:
-        list(
-            executor.map(
-                copy_file,
-                itertools.repeat(b),
-                itertools.repeat(nb),
-                src_list,
-                dest_list,
-                chunksize=64,
-            )
-        )
+    run_transfers(
+        lambda src, dest, size, callback: copy_file(
+            b, nb, src, dest, size=size, part_size=part_size, callback=callback
+        ),
+        src_list,
+        dest_list,
+        sizes,
+        n_threads=n_proc,
+    )
+
+
+def remove_batch(bucket, keys, *, callback=None):
+    """Delete up to 1000 keys with one DeleteObjects call, returning the errors"""
+    response = get_client().delete_objects(
+        Bucket=bucket,
+        Delete={"Objects": [{"Key": k} for k in keys], "Quiet": True},
+    )
+    return response.get("Errors", [])
 
 
-def remove_files(file_list, *, b, really=False, n_proc=16):
-    """Remove a list of file keys from S3"""
+def remove_files(
+    file_list, *, b, really=False, n_proc=N_THREADS, bulk=True, batch_size=1000
+):
+    """Remove a list of file keys from S3
+
+    With bulk=True (the default), keys are deleted in batches of batch_size
+    (at most 1000) using DeleteObjects, and the batches are sent concurrently.
+    Returns a summary dict with the number of keys removed and a list of
+    (key, error code, error message) tuples for the keys that failed.
+    """
 
     assert really
 
     print(f"Removing {len(file_list)} files!")
-    with ProcessPoolExecutor(max_workers=n_proc) as executor:
-        list(executor.map(remove_file, itertools.repeat(b), file_list, chunksize=64))
+    if not bulk:
+        run_transfers(remove_file, itertools.repeat(b), file_list, n_threads=n_proc)
+        return {"removed": len(file_list), "errors": []}
+
+    assert 0 < batch_size <= 1000, "DeleteObjects takes at most 1000 keys"
+
+    file_list = list(file_list)
+    batches = [
+        file_list[i : i + batch_size] for i in range(0, len(file_list), batch_size)
+    ]
+    errors = [
+        (e["Key"], e.get("Code"), e.get("Message"))
+        for batch_errors in run_transfers(
+            remove_batch, itertools.repeat(b), batches, n_threads=n_proc
+        )
+        for e in batch_errors
+    ]
+
+    summary = {"removed": len(file_list) - len(errors), "errors": errors}
+    print(f"removed {summary['removed']} files, {len(errors)} errors")
+
+    return summary
+
 
+def download_files(
+    src_list,
+    dest_list,
+    *,
+    bucket,
+    force_download=False,
+    n_proc=N_THREADS,
+    index=None,
+):
+    """Download a list of file to local storage
 
-def download_files(src_list, dest_list, *, bucket, force_download=False, n_proc=16):
-    """Download a list of file to local storage"""
+    Files are skipped when index (a LocalIndex by default) reports the
+    destination as done for the size of the source object. Sources that
+    aren't in the listing are never skipped, so a missing key fails in the
+    download instead of being silently ignored.
+    """
 
     if not force_download:
-        src_list, dest_list = zip(
-            *[
-                (src, dest)
-                for src, dest in zip(src_list, dest_list)
-                if not os.path.exists(dest)
-            ]
-        )
+        if index is None:
+            index = LocalIndex()
+        src_index = ObjectIndex.from_s3(bucket, src_list, n_threads=n_proc)
 
-    with ProcessPoolExecutor(max_workers=n_proc) as executor:
-        list(
-            executor.map(
-                download_file,
-                itertools.repeat(bucket),
-                src_list,
-                dest_list,
-                chunksize=64,
-            )
+        src_list, dest_list = _pending(
+            (src, dest)
+            for src, dest in zip(src_list, dest_list)
+            if src not in src_index.entries
+            or not index.is_done(dest, *src_index.get(src))
         )
+
+    run_transfers(
+        download_file, itertools.repeat(bucket), src_list, dest_list, n_threads=n_proc
+    )
+
+
+def _pending(pairs):
+    """Split (src, dest) pairs into two lists, which may be empty"""
+    pairs = list(pairs)
+    return [src for src, _ in pairs], [dest for _, dest in pairs]
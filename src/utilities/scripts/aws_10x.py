@@ -4,9 +4,13 @@ import argparse
 import warnings
 import posixpath
 import glob, os
+import shlex
+import sys
 
 from utilities.alignment.run_10x_count import reference_genomes, deprecated
+import utilities.log_util as ut_log
 import utilities.s3_util as s3u
+import utilities.scripts.evros as evros
 
 def main():
     parser = argparse.ArgumentParser(
@@ -52,6 +56,8 @@ def main():
         "--branch", default="master", help="Branch of utilities repo to use"
     )
 
+    evros.add_submit_arguments(parser)
+
     parser.add_argument(
         "script_args",
         nargs=argparse.REMAINDER,
@@ -59,7 +65,21 @@ def main():
     )
 
     parser.add_argument("--glacier", action="store_true")
+    parser.add_argument(
+        "--listing_cache",
+        nargs="?",
+        const=s3u.LISTING_CACHE_PATH,
+        default=None,
+        help="Cache S3 listings in this SQLite file (default path if no value)",
+    )
     args = parser.parse_args()
+    evros.check_submit_arguments(parser, args)
+
+    if args.listing_cache:
+        # fastq files are never rewritten, so new runs are all it must find
+        listing_cache = s3u.ListingCache(args.listing_cache, incremental=True)
+    else:
+        listing_cache = None
 
     # check if the input genome is valid
     if args.taxon in reference_genomes:
@@ -76,7 +96,10 @@ def main():
         s3_input_bucket, s3_input_prefix = s3u.s3_bucket_and_key(args.s3_input_path)
 
         sample_folder_paths = [
-            folder_path for folder_path in s3u.get_folders(s3_input_bucket, s3_input_prefix)
+            folder_path
+            for folder_path in s3u.get_folders(
+                s3_input_bucket, s3_input_prefix, cache=listing_cache
+            )
         ]
         complete_input_paths = [
             "s3://" + s3_input_bucket + "/" + path for path in sample_folder_paths
@@ -84,15 +107,13 @@ def main():
 
         num_partitions = len(complete_input_paths)
         glacier_flag = '--glacier' if args.glacier else ''
+        job_args = []
         for i in range(num_partitions):
             s3_input_path = complete_input_paths[i]
             sample_fastq_prefix = s3_input_path.split("/")[-2]
-            print(
+            job_args.append(
                 " ".join(
                     (
-                        "evros",
-                        f"--branch {args.branch}",
-                        "alignment.run_10x_count",
                         glacier_flag,
                         f"--taxon {args.taxon}",
                         f"--num_partitions {num_partitions}",
@@ -105,13 +126,17 @@ def main():
                     )
                 )
             )
-            print("sleep 10")
+        evros_options = f"--branch {args.branch}"
 
     else:
     # get the list of sample fastq paths under the input folder
         s3_input_bucket, s3_input_prefix = s3u.s3_bucket_and_key(args.s3_input_path)
         sample_fastq_paths = [
-            fastq_path for fastq_path in s3u.list_s3_keys(s3_input_bucket, s3_input_prefix, "fastq.gz")
+            fastq_path
+            for fastq_path in s3u.get_files(
+                s3_input_bucket, s3_input_prefix, cache=listing_cache
+            )
+            if fastq_path.endswith("fastq.gz")
         ]
 
         sample_fastq_prefixes = {
@@ -127,15 +152,12 @@ def main():
         num_partitions = len(sample_fastq_prefixes)
         glacier_flag = '--glacier' if args.glacier else ''
 
+        job_args = []
         for i in range(num_partitions):
             sample_fastq_prefix = sample_fastq_prefixes[i]
-            print(
+            job_args.append(
                 " ".join(
                     (
-                        "evros",
-                        f"--image {args.image}",
-                        f"--branch {args.branch}",
-                        "alignment.run_10x_count",
                         glacier_flag,
                         f"--taxon {args.taxon}",
                         f"--num_partitions {num_partitions}",
@@ -147,6 +169,23 @@ def main():
                     )
                 )
             )
-            print("sleep 10")
+        evros_options = f"--image {args.image} --branch {args.branch}"
+
+    if args.job_definition:
+        failed = evros.submit_script(
+            "alignment.run_10x_count",
+            [shlex.split(sample_args) for sample_args in job_args],
+            args,
+            ut_log.get_logger(__name__)[0],
+        )
+        if failed:
+            sys.exit(f"{failed} jobs could not be submitted")
+        return
+
+    for sample_args in job_args:
+        print(f"evros {evros_options} alignment.run_10x_count {sample_args}")
+        print("sleep 10")
+
+
 if __name__ == "__main__":
     main()
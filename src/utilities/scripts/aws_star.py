@@ -1,9 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import datetime
+import shlex
+import sys
 import warnings
 
-from utilities.alignment.run_star_and_htseq import reference_genomes, deprecated
+import utilities.log_util as ut_log
+import utilities.s3_util as s3u
+import utilities.scripts.evros as evros
+from utilities.alignment.run_star_and_htseq import (
+    reference_genomes,
+    deprecated,
+    get_parser,
+    make_plan,
+    save_plan,
+)
 
 
 def main():
@@ -46,6 +58,20 @@ def main():
         "--branch", default="master", help="Branch of utilities repo to use"
     )
 
+    parser.add_argument(
+        "--plan_path",
+        default=None,
+        help="S3 path to upload the sample plan to, which the jobs read instead of"
+        " each listing the input folder (default: under s3_output_path/_plans/)",
+    )
+    parser.add_argument(
+        "--no_plan",
+        action="store_true",
+        help="Don't make a plan; every job lists and groups the fastq files itself",
+    )
+
+    evros.add_submit_arguments(parser)
+
     parser.add_argument(
         "script_args",
         nargs=argparse.REMAINDER,
@@ -53,6 +79,7 @@ def main():
     )
 
     args = parser.parse_args()
+    evros.check_submit_arguments(parser, args)
 
     # check if the input genome is valid
     if args.taxon in reference_genomes:
@@ -64,21 +91,79 @@ def main():
     else:
         raise ValueError(f"unknown taxon {args.taxon}")
 
-    # print input arguments for running alignment.run_star_and_htseq for each group of sample
-    for i in range(args.num_partitions):
+    script_args = list(args.script_args)
+
+    if not args.no_plan:
+        # list and group the fastq files once, instead of once per job
+        star_args = get_parser().parse_args(
+            [
+                f"--taxon={args.taxon}",
+                f"--num_partitions={args.num_partitions}",
+                "--partition_id=0",
+                f"--s3_input_path={args.s3_input_path}",
+                f"--s3_output_path={args.s3_output_path}",
+                *args.script_args,
+            ]
+        )
+        if star_args.listing_cache:
+            # fastq files are never rewritten, so new runs are all it must find
+            listing_cache = s3u.ListingCache(star_args.listing_cache, incremental=True)
+        else:
+            listing_cache = None
+
+        s3_input_bucket, s3_input_prefix = s3u.s3_bucket_and_key(
+            args.s3_input_path.rstrip("/")
+        )
+        plan = make_plan(
+            s3_input_bucket,
+            s3_input_prefix,
+            min_size=star_args.min_size,
+            num_partitions=args.num_partitions,
+            cache=listing_cache,
+        )
+
+        plan_path = args.plan_path or (
+            f"{args.s3_output_path.rstrip('/')}/_plans/"
+            f"plan-{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+        )
+        save_plan(plan, plan_path)
         print(
-            " ".join(
-                (
-                    "evros",
-                    f"--branch {args.branch}",
-                    "alignment.run_star_and_htseq",
-                    f"--taxon {args.taxon}",
-                    f"--num_partitions {args.num_partitions}",
-                    f"--partition_id {i}",
-                    f"--s3_input_path {args.s3_input_path}",
-                    f"--s3_output_path {args.s3_output_path}",
-                    " ".join(args.script_args),
-                )
+            f"{len(plan['samples'])} samples to align, {len(plan['skipped'])}"
+            f" skipped, {len(plan['unmatched'])} unmatched fastq files;"
+            f" plan saved to {plan_path}",
+            file=sys.stderr,
+        )
+        script_args.append(f"--plan {plan_path}")
+
+    # input arguments for running alignment.run_star_and_htseq for each group of sample
+    job_args = [
+        " ".join(
+            (
+                f"--taxon {args.taxon}",
+                f"--num_partitions {args.num_partitions}",
+                f"--partition_id {i}",
+                f"--s3_input_path {args.s3_input_path}",
+                f"--s3_output_path {args.s3_output_path}",
+                " ".join(script_args),
             )
         )
+        for i in range(args.num_partitions)
+    ]
+
+    if args.job_definition:
+        failed = evros.submit_script(
+            "alignment.run_star_and_htseq",
+            [shlex.split(partition_args) for partition_args in job_args],
+            args,
+            ut_log.get_logger(__name__)[0],
+        )
+        if failed:
+            sys.exit(f"{failed} jobs could not be submitted")
+        return
+
+    for partition_args in job_args:
+        print(
+            f"evros --branch {args.branch} alignment.run_star_and_htseq"
+            f" {partition_args}"
+        )
         print("sleep 10")
@@ -5,12 +5,22 @@ import importlib.util
 import json
 import re
 import subprocess
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 import utilities.log_util as ut_log
 
 
 REPO_ADDRESS = "https://github.com/thsuanwu/utilities.git"
 
+# SubmitJob is throttled at about 50 requests per second per account; stay
+# under it, and let the client back off (adaptive retries) if it's shared
+SUBMIT_RATE = 20
+SUBMIT_THREADS = 16
+MAX_ATTEMPTS = 10
+
 
 # helper function to check arguments are within a given range
 def resource_range(name, min_val, max_val):
@@ -27,6 +37,249 @@ def resource_range(name, min_val, max_val):
     return range_validator
 
 
+def load_script(script_name):
+    """Import a script by its name in the utilities package, e.g. demux.bcl2fastq"""
+    if not script_name.startswith("."):
+        script_name = f".{script_name}"
+    return importlib.import_module(script_name, "utilities")
+
+
+def check_script_args(script_name, script_module, script_args):
+    """Parse script_args with the script's parser, which exits if they're bad"""
+    if not hasattr(script_module, "get_parser"):
+        raise NotImplementedError(
+            f"{script_name} must have a 'get_parser' method to test args"
+        )
+
+    script_module.get_parser().parse_args(script_args)
+
+
+def job_command(script_name, script_args):
+    """The shell command a job runs: install the repo and run the script"""
+    return "; ".join(
+        (
+            "PATH=/opt/conda/bin:/opt/cellranger-7.0.1:${PATH}",
+            "echo $PATH",
+            "conda activate utilities-env",
+            "git clone {}".format(REPO_ADDRESS),
+            "cd utilities",
+            "python setup.py install",
+            f"python -m utilities.{script_name.lstrip('.')} {' '.join(script_args)}",
+        )
+    )
+
+
+def job_name(script_name, suffix=None):
+    """A valid Batch job name (letters, digits, - and _) for the script"""
+    name = re.sub(r"[^\w-]", "_", script_name.lstrip("."))
+    if suffix is not None:
+        name = f"{name}-{suffix}"
+    return name[:128]
+
+
+def job_request(
+    name, command, *, queue, job_definition, vcpus, memory, environment=None
+):
+    """Return the SubmitJob parameters of a job running command in bash.
+
+    The job definition (a name, name:revision or ARN) sets the image, volumes
+    and ulimits; vcpus, memory (in MB) and environment (["NAME=value", ...])
+    override it unless they're None.
+    """
+
+    overrides = {
+        "command": ["bash", "-c", command],
+        "resourceRequirements": [
+            {"type": resource, "value": str(value)}
+            for resource, value in (("VCPU", vcpus), ("MEMORY", memory))
+            if value is not None
+        ],
+    }
+    if environment:
+        overrides["environment"] = [
+            dict(zip(("name", "value"), env.split("=", 1))) for env in environment
+        ]
+
+    return {
+        "jobName": name,
+        "jobQueue": queue,
+        "jobDefinition": job_definition,
+        "containerOverrides": overrides,
+    }
+
+
+def script_requests(
+    script_name,
+    arg_lists,
+    *,
+    queue,
+    job_definition,
+    vcpus=None,
+    memory=None,
+    environment=None,
+):
+    """Return the SubmitJob parameters of one job per list of script args.
+
+    The args are checked with the script's parser; vcpus and memory default to
+    the script's get_default_requirements().
+    """
+
+    script_module = load_script(script_name)
+    if hasattr(script_module, "get_default_requirements"):
+        script_reqs = script_module.get_default_requirements()
+        vcpus = vcpus or script_reqs.vcpus
+        memory = memory or script_reqs.memory
+
+    requests = []
+    for i, script_args in enumerate(arg_lists):
+        check_script_args(script_name, script_module, script_args)
+        requests.append(
+            job_request(
+                job_name(script_name, i if len(arg_lists) > 1 else None),
+                job_command(script_name, script_args),
+                queue=queue,
+                job_definition=job_definition,
+                vcpus=vcpus,
+                memory=memory,
+                environment=environment,
+            )
+        )
+
+    return requests
+
+
+class RateLimiter:
+    """Lets callers through at most rate times per second, from any thread"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+
+        time.sleep(slot - now)
+
+
+def batch_client(*, n_threads=SUBMIT_THREADS, endpoint_url=None):
+    """Return a Batch client with a connection for each of n_threads threads.
+
+    endpoint_url can point the client at a local stub of the Batch API.
+    """
+    import boto3
+    import botocore.config
+
+    return boto3.session.Session().client(
+        "batch",
+        config=botocore.config.Config(
+            max_pool_connections=n_threads,
+            retries={"max_attempts": MAX_ATTEMPTS, "mode": "adaptive"},
+        ),
+        endpoint_url=endpoint_url,
+    )
+
+
+def submit_jobs(
+    requests, *, client=None, n_threads=SUBMIT_THREADS, rate=SUBMIT_RATE, logger=None
+):
+    """Submit jobs concurrently and return their job IDs, in order.
+
+    requests are SubmitJob parameters, e.g. from job_request(). n_threads
+    threads share one client (boto3 clients are thread-safe) and submit at
+    most rate jobs per second. A job that can't be submitted gets None, after
+    the error is logged.
+    """
+
+    if client is None:
+        client = batch_client(n_threads=n_threads)
+    limiter = RateLimiter(rate)
+
+    def submit(request):
+        limiter.wait()
+        try:
+            job_id = client.submit_job(**request)["jobId"]
+        except Exception as exc:
+            if logger is not None:
+                logger.error(f"Failed to submit {request['jobName']}: {exc}")
+            return None
+
+        if logger is not None:
+            logger.debug(f"Submitted {request['jobName']}: {job_id}")
+        return job_id
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(submit, requests))
+
+
+def add_submit_arguments(parser):
+    """Add the options of submit_script() to a parser"""
+    submit_group = parser.add_argument_group("submit the jobs directly")
+    submit_group.add_argument(
+        "--job_definition",
+        default=None,
+        help="Submit the jobs to AWS Batch with this job definition (which sets"
+        " the image, volumes and ulimits) and print their IDs, instead of"
+        " printing evros commands",
+    )
+    submit_group.add_argument(
+        "--queue", default="aegea_batch", help="Queue to submit the jobs"
+    )
+    submit_group.add_argument(
+        "--submit_rate",
+        type=float,
+        default=SUBMIT_RATE,
+        help="Most jobs to submit per second",
+    )
+    submit_group.add_argument(
+        "--endpoint_url", default=None, help="Batch endpoint, e.g. a local stub"
+    )
+
+
+def check_submit_arguments(parser, args):
+    """Exit with a usage error if --image, --storage or --ulimits are given with
+    --job_definition: they're only applied by aegea, and a submitted job gets
+    them from its job definition"""
+
+    if not args.job_definition:
+        return
+
+    ignored = [
+        f"--{name}"
+        for name in ("image", "storage", "ulimits")
+        if getattr(args, name, None) not in (None, parser.get_default(name))
+    ]
+    if ignored:
+        parser.error(
+            f"{', '.join(ignored)} can't be used with --job_definition,"
+            " set them in the job definition instead"
+        )
+
+
+def submit_script(script_name, arg_lists, args, logger):
+    """Submit a job of the script for each list of args, with the options from
+    add_submit_arguments(). Prints the name and ID of each job and returns the
+    number that failed."""
+
+    requests = script_requests(
+        script_name, arg_lists, queue=args.queue, job_definition=args.job_definition
+    )
+    job_ids = submit_jobs(
+        requests,
+        client=batch_client(endpoint_url=args.endpoint_url),
+        rate=args.submit_rate,
+        logger=logger,
+    )
+
+    for request, job_id in zip(requests, job_ids):
+        print(f"{request['jobName']}\t{job_id or 'FAILED'}")
+
+    return job_ids.count(None)
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog="evros",
@@ -63,6 +316,13 @@ def main():
     instance_group.add_argument(
         "--queue", default="aegea_batch", help="Queue to submit the job"
     )
+    instance_group.add_argument(
+        "--job_definition",
+        default=None,
+        help="Submit the job directly to AWS Batch with this job definition,"
+        " instead of through aegea. The job definition sets the image, storage"
+        " and ulimits, so --image, --storage and --ulimits can't be used",
+    )
     instance_group.add_argument(
         "--vcpus",
         type=resource_range("vcpus", 1, 64),
@@ -103,6 +363,11 @@ def main():
     other_group.add_argument(
         "--branch", default="master", help="branch of utilities repo to use"
     )
+    other_group.add_argument(
+        "--endpoint_url",
+        default=None,
+        help="Batch endpoint for --job_definition, e.g. a local stub",
+    )
     other_group.add_argument(
         "-d", "--debug", action="store_true", help="Set logging to debug level"
     )
@@ -111,13 +376,12 @@ def main():
     )
 
     args = parser.parse_args()
+    check_submit_arguments(parser, args)
 
     logger = ut_log.get_logger(__name__, args.debug, args.dryrun)[0]
 
     logger.debug("Importing script as a module")
-    if not args.script_name.startswith("."):
-        args.script_name = f".{args.script_name}"
-    script_module = importlib.import_module(args.script_name, "utilities")
+    script_module = load_script(args.script_name)
 
     logger.debug("Checking for script default requirements")
 
@@ -130,33 +394,39 @@ def main():
 
     logger.debug("Testing script args")
 
-    if hasattr(script_module, "get_parser"):
-        script_parser = script_module.get_parser()
-        try:
-            script_parser.parse_args(args.script_args)
-        except:
-            logger.error(
-                f"{args.script_name} failed with the given arg string\n\t{args.script_args}"
-            )
-            raise
-    else:
-        raise NotImplementedError(
-            f"{args.script_name} must have a 'get_parser' method to test args"
+    try:
+        check_script_args(args.script_name, script_module, args.script_args)
+    except:
+        logger.error(
+            f"{args.script_name} failed with the given arg string\n\t{args.script_args}"
         )
+        raise
 
     logger.debug("Script parsed args successfully")
 
-    job_command = "; ".join(
-        (
-            "PATH=/opt/conda/bin:/opt/cellranger-7.0.1:${PATH}",
-            "echo $PATH",
-            "conda activate utilities-env",
-            "git clone {}".format(REPO_ADDRESS),
-            "cd utilities",
-            "python setup.py install",
-            f"python -m utilities.{args.script_name} {' '.join(args.script_args)}",
+    command = job_command(args.script_name, args.script_args)
+
+    if args.job_definition:
+        request = job_request(
+            job_name(args.script_name),
+            command,
+            queue=args.queue,
+            job_definition=args.job_definition,
+            vcpus=args.vcpus,
+            memory=args.memory,
+            environment=args.environment,
         )
-    )
+        logger.info(f"submitting job:\n\t{json.dumps(request)}")
+        if not args.dryrun:
+            job_id = submit_jobs(
+                [request],
+                client=batch_client(n_threads=1, endpoint_url=args.endpoint_url),
+                logger=logger,
+            )[0]
+            if job_id is None:
+                raise RuntimeError("Failed to submit the job")
+            logger.info(f"Launched job with jobId: {job_id}")
+        return
 
     aegea_command = [
         "aegea",
@@ -181,7 +451,7 @@ def main():
     if args.environment:
         aegea_command.extend(["--environment", " ".join(args.environment)])
 
-    aegea_command.extend(["--command", f"'{job_command}'"])
+    aegea_command.extend(["--command", f"'{command}'"])
 
     logger.info(f"executing command:\n\t{' '.join(aegea_command)}")
     if not args.dryrun:
@@ -5,10 +5,8 @@ import csv
 import io
 import os
 
-import boto3
-
 from utilities.log_util import get_logger
-from utilities.s3_util import s3_bucket_and_key
+from utilities.s3_util import get_client, prefix_gen, s3_bucket_and_key
 
 
 def get_htseq_counts(client, bucket, htseq_file):
@@ -64,31 +62,19 @@ def gene_cell_table(args, logger, dryrun):
         )
 
     logger.info("Starting S3 client")
-    client = boto3.client("s3")
-    paginator = client.get_paginator("list_objects")
-
-    htseq_files = []
-    log_files = []
+    client = get_client()
 
     s3_input_bucket, s3_input_prefix = s3_bucket_and_key(args.s3_input_path)
 
     logger.info("Getting htseq file list")
-    response_iterator = paginator.paginate(
-        Bucket=s3_input_bucket, Prefix=s3_input_prefix
-    )
-    for result in response_iterator:
-        if "Contents" in result:
-            htseq_files.extend(
-                r["Key"]
-                for r in result["Contents"]
-                if r["Key"].endswith("htseq-count.txt")
-            )
-            if not args.no_log:
-                log_files.extend(
-                    r["Key"]
-                    for r in result["Contents"]
-                    if r["Key"].endswith("log.final.out")
-                )
+    # not cached: the outputs to collect may have changed since any listing
+    keys = list(prefix_gen(s3_input_bucket, s3_input_prefix, lambda r: r["Key"]))
+
+    htseq_files = [k for k in keys if k.endswith("htseq-count.txt")]
+    if args.no_log:
+        log_files = []
+    else:
+        log_files = [k for k in keys if k.endswith("log.final.out")]
     logger.info("{} htseq files found".format(len(htseq_files)))
 
     sample_names = tuple(os.path.basename(fn)[:-16] for fn in htseq_files)
@@ -135,20 +121,23 @@ def gene_cell_table(args, logger, dryrun):
         logger.info("Done!")
         return
 
+    # keyed by sample, as not every sample has a log: samples aligned in a
+    # batch only have the batch's log (.log.final.out.batch), and their
+    # columns are left empty
     log_metrics = set()
-    log_values = list()
+    log_values = dict()
 
     for log_file in log_files:
         logger.debug("Downloading {}".format(log_file))
         if not dryrun:
             metric_names, values = get_log_file(client, s3_input_bucket, log_file)
             log_metrics.add(metric_names)
-            log_values.append(values)
+            log_values[os.path.basename(log_file)[: -len(".log.final.out")]] = values
 
     logger.info("Downloaded {} files".format(len(log_files)))
     if not dryrun:
-        assert len(log_metrics) == 1
-        log_metrics = log_metrics.pop()
+        assert len(log_metrics) <= 1
+        log_metrics = log_metrics.pop() if log_metrics else ()
 
     log_file = ".log".join(os.path.splitext(args.output_file))
 
@@ -158,7 +147,13 @@ def gene_cell_table(args, logger, dryrun):
             wtr = csv.writer(OUT, delimiter=sep)
             wtr.writerow(("metric",) + sample_names)
             for i, m in enumerate(log_metrics):
-                wtr.writerow((m,) + tuple(mv[i] for mv in log_values))
+                wtr.writerow(
+                    (m,)
+                    + tuple(
+                        log_values[sample_name][i] if sample_name in log_values else ""
+                        for sample_name in sample_names
+                    )
+                )
 
     logger.info("Done!")
 
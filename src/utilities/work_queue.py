@@ -0,0 +1,292 @@
+import datetime
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import utilities.s3_util as s3u
+
+
+# a claimed item is free to take again when its lease hasn't been renewed for
+# LEASE_SECONDS; holders renew every LEASE_SECONDS / 3
+LEASE_SECONDS = 600
+
+
+def default_worker_id():
+    return os.environ.get("AWS_BATCH_JOB_ID", f"{socket.gethostname()}-{os.getpid()}")
+
+
+def open_queue(location, **kwargs):
+    """Open an S3WorkQueue for an s3:// location, otherwise a SQLiteWorkQueue"""
+    if location.startswith("s3://"):
+        return S3WorkQueue(location, **kwargs)
+    else:
+        return SQLiteWorkQueue(location, **kwargs)
+
+
+class WorkQueue:
+    """Shared queue that lets any number of jobs split a list of items.
+
+    Every job computes the same list of items (e.g. sample names) and calls
+    claim_items, which yields the items it manages to lease. Leases are
+    renewed by a heartbeat thread until the item is completed or released,
+    so when a job is killed its items become free again after lease_seconds
+    and are picked up by the jobs still running.
+
+    Subclasses store the leases: SQLiteWorkQueue in a local file (for tests
+    and single hosts), S3WorkQueue in S3 with conditional puts.
+    """
+
+    def __init__(self, *, worker_id=None, lease_seconds=LEASE_SECONDS):
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+
+        self.held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_leases, daemon=True)
+        self._heartbeat.start()
+
+    def claim_items(self, items):
+        """Generator of the items this worker leased, in the order given.
+
+        Passes over the items are repeated until every item is done or held
+        by this worker, or the queue is closed. A pass that claims nothing is
+        followed by a pause of lease_seconds / 3, so items leased by a job
+        that was killed are picked up once their lease expires.
+        """
+
+        items = list(items)
+        while not self._stop.is_set():
+            with self._lock:
+                self._refresh()
+                skip = self._done_items() | self.held
+                pending = [item for item in items if item not in skip]
+            if not pending:
+                return
+
+            claimed = False
+            for item in pending:
+                with self._lock:
+                    if item in self.held or not self._claim(item):
+                        continue
+                    self.held.add(item)
+
+                claimed = True
+                yield item
+
+            if not claimed:
+                self._stop.wait(self.lease_seconds / 3)
+
+    def complete(self, item):
+        """Mark a claimed item as done, so no other worker will take it"""
+        with self._lock:
+            self._complete(item)
+            self.held.discard(item)
+
+    def release(self, item):
+        """Give up the lease on a claimed item without finishing it"""
+        with self._lock:
+            self._release(item)
+            self.held.discard(item)
+
+    def close(self):
+        """Stop the heartbeat and release every item still held"""
+        self._stop.set()
+        self._heartbeat.join()
+        for item in list(self.held):
+            self.release(item)
+
+    def _renew_leases(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._lock:
+                for item in list(self.held):
+                    if not self._renew(item):
+                        self.held.discard(item)
+
+    # storage-specific operations, called with self._lock held
+    def _refresh(self):
+        pass
+
+    def _done_items(self):
+        raise NotImplementedError
+
+    def _claim(self, item):
+        raise NotImplementedError
+
+    def _renew(self, item):
+        raise NotImplementedError
+
+    def _complete(self, item):
+        raise NotImplementedError
+
+    def _release(self, item):
+        raise NotImplementedError
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """WorkQueue kept in a SQLite file, shared by processes on one host"""
+
+    def __init__(self, path, **kwargs):
+        self.db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            " item TEXT PRIMARY KEY, owner TEXT, expires REAL, done INTEGER DEFAULT 0)"
+        )
+        super().__init__(**kwargs)
+
+    def _update(self, sql, *params):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self.db.execute(sql, params)
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+        return cursor.rowcount == 1
+
+    def _done_items(self):
+        rows = self.db.execute("SELECT item FROM items WHERE done")
+        return {item for item, in rows}
+
+    def _claim(self, item):
+        self.db.execute("INSERT OR IGNORE INTO items (item) VALUES (?)", (item,))
+        return self._update(
+            "UPDATE items SET owner = ?, expires = ? WHERE item = ? AND NOT done"
+            " AND (owner IS NULL OR expires < ?)",
+            self.worker_id,
+            time.time() + self.lease_seconds,
+            item,
+            time.time(),
+        )
+
+    def _renew(self, item):
+        return self._update(
+            "UPDATE items SET expires = ? WHERE item = ? AND owner = ? AND NOT done",
+            time.time() + self.lease_seconds,
+            item,
+            self.worker_id,
+        )
+
+    def _complete(self, item):
+        self._update(
+            "UPDATE items SET done = 1, owner = NULL WHERE item = ? AND owner = ?",
+            item,
+            self.worker_id,
+        )
+
+    def _release(self, item):
+        self._update(
+            "UPDATE items SET owner = NULL WHERE item = ? AND owner = ?",
+            item,
+            self.worker_id,
+        )
+
+
+class S3WorkQueue(WorkQueue):
+    """WorkQueue kept in S3 as lock objects, using conditional puts.
+
+    A lease is the object {location}/claims/{item}, created with If-None-Match
+    so only one worker can create it. Its LastModified time is the last
+    renewal; an expired lease is taken over with an If-Match put on the ETag
+    that was seen. Finished items get a {location}/done/{item} marker.
+    """
+
+    def __init__(self, location, **kwargs):
+        self.bucket, prefix = s3u.s3_bucket_and_key(location, require_prefix=True)
+        self.prefix = prefix.rstrip("/")
+        self.etags = {}
+        self.done = set()
+        self.claims = {}
+        super().__init__(**kwargs)
+
+    def _key(self, kind, item):
+        return f"{self.prefix}/{kind}/{item}"
+
+    def _list(self, kind):
+        start = len(self._key(kind, ""))
+        return {
+            r["Key"][start:]: r
+            for r in s3u.prefix_gen(self.bucket, self._key(kind, ""), depth=0)
+        }
+
+    def _put(self, item, **conditions):
+        """Write our claim object, returning False if a condition failed"""
+        client = s3u.get_client()
+        try:
+            response = client.put_object(
+                Bucket=self.bucket,
+                Key=self._key("claims", item),
+                # the time makes every write's ETag unique, for If-Match
+                Body=f"{self.worker_id} {time.time()}".encode(),
+                **conditions,
+            )
+        except client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+            ):
+                return False
+            raise
+
+        self.etags[item] = response["ETag"]
+        return True
+
+    def _is_done(self, item):
+        client = s3u.get_client()
+        try:
+            client.head_object(Bucket=self.bucket, Key=self._key("done", item))
+        except client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+        return True
+
+    def _refresh(self):
+        self.done = set(self._list("done"))
+        self.claims = self._list("claims")
+
+    def _done_items(self):
+        return self.done
+
+    def _claim(self, item):
+        if item in self.done:
+            return False
+
+        if item not in self.claims:
+            claimed = self._put(item, IfNoneMatch="*")
+        else:
+            claim = self.claims[item]
+            age = datetime.datetime.now(datetime.timezone.utc) - claim["LastModified"]
+            if age.total_seconds() < self.lease_seconds:
+                return False
+            claimed = self._put(item, IfMatch=claim["ETag"])
+
+        # the item may have been finished since the done markers were listed
+        if claimed and self._is_done(item):
+            self._release(item)
+            return False
+
+        return claimed
+
+    def _renew(self, item):
+        return self._put(item, IfMatch=self.etags[item])
+
+    def _complete(self, item):
+        s3u.get_client().put_object(
+            Bucket=self.bucket,
+            Key=self._key("done", item),
+            Body=self.worker_id.encode(),
+        )
+        self._release(item)
+
+    def _release(self, item):
+        s3u.get_client().delete_object(
+            Bucket=self.bucket, Key=self._key("claims", item)
+        )
+        self.etags.pop(item, None)